@@ -0,0 +1,66 @@
+import asyncio
+import threading
+from typing import TYPE_CHECKING, Coroutine, List, Optional, Tuple
+
+from src.utils.logging import getLogger
+
+if TYPE_CHECKING:
+    from elasticsearch import AsyncElasticsearch
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+
+async def gather_searches(client: "AsyncElasticsearch", searches: List[Tuple[str, dict]]) -> List[dict]:
+    """Run (index, body) searches concurrently, e.g. the same kNN search on several indices or aliases.
+
+    Args:
+        client (AsyncElasticsearch): asyncio elasticsearch client
+        searches (List[Tuple[str, dict]]): index and arguments of every
+            search request, see `knn_search_body`.
+
+    Returns:
+        the responses, in the order of the searches.
+    """
+    return await asyncio.gather(*(client.search(index=index_name, **body) for index_name, body in searches))
+
+
+class AsyncSearchRunner:
+    """Run coroutines of an `AsyncElasticsearch` client from synchronous code.
+
+    The client and its connection pool live on an event loop running in a
+    background thread, so threads of the search service can share them.
+
+    Example:
+        runner = AsyncSearchRunner()
+        responses = runner.run(gather_searches(runner.client, [("es0", body), ("es1", body)]))
+        runner.close()
+    """
+
+    def __init__(self, client: Optional["AsyncElasticsearch"] = None):
+        """
+        Args:
+            client (AsyncElasticsearch): asyncio elasticsearch client, created
+                with `get_async_client` if not given.
+        """
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="async-search", daemon=True)
+        self._thread.start()
+        if client is None:
+            from src.utils.es_client import get_async_client
+
+            client = get_async_client()
+        self.client = client
+
+    def run(self, coroutine: Coroutine, timeout: Optional[float] = None):
+        """Run a coroutine on the event loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(timeout)
+
+    def close(self):
+        """Close the client connections and stop the event loop."""
+        try:
+            self.run(self.client.close())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
@@ -0,0 +1,492 @@
+import argparse
+import json
+import os
+import sys
+import textwrap
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    TextIO,
+    Union,
+)
+
+import argcomplete
+
+from src.dataset.cache import EmbeddingCache
+from src.dataset.fusion import FUSION_METHODS, fuse, hit_key, passage_key
+from src.dataset.projection import Projection, index_projection
+from src.dataset.search import (
+    AGGREGATIONS,
+    SEARCH_MODES,
+    SearchResult,
+    collect_hits,
+    knn_search_body,
+    lexical_search_body,
+    metadata_filters,
+    parse_filters,
+)
+from src.dataset.vector_store import BACKENDS, VectorStore, as_vector_store, open_store
+from src.utils import constants
+from src.utils.logging import getLogger
+from src.utils.metrics import metrics, timer
+from src.utils.registry import get_model
+from src.utils.utils import batched, l2_normalize
+
+if TYPE_CHECKING:
+    from elasticsearch import Elasticsearch
+    from sentence_transformers import SentenceTransformer
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+
+@dataclass
+class BatchQuery:
+    """A query of a batch, with the id its results are written under."""
+
+    id: str
+    query: str
+    # ES queries the results of this query must match, on top of the batch ones.
+    filters: List[dict] = field(default_factory=list)
+
+
+def read_queries(lines: Iterable[str]) -> Iterator[BatchQuery]:
+    """Queries of a file, one per line.
+
+    A line is either the query text, whose id is its line number, or a JSON
+    object {"id": ..., "query": ..., "filters": ...} with optional id and
+    filters, see `metadata_filters`.  Blank lines are skipped.
+    """
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith("{"):
+            yield BatchQuery(str(number), line)
+            continue
+        entry = json.loads(line)
+        if not isinstance(entry.get("query"), str) or not entry["query"].strip():
+            raise ValueError(f'Line {number} has no "query"')
+        yield BatchQuery(str(entry.get("id", number)), entry["query"], metadata_filters(entry.get("filters")))
+
+
+def completed_ids(output_path: str) -> Set[str]:
+    """Ids of the queries already answered in an output file of a previous run.
+
+    The file is rewritten without the queries that failed and a line cut
+    short by an interruption, so they are run again and appended.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    done, kept = set(), []
+    with open(output_path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if "error" not in entry and entry.get("id") not in done:
+                done.add(entry["id"])
+                kept.append(line if line.endswith("\n") else line + "\n")
+    temporary = f"{output_path}.tmp"
+    with open(temporary, "w") as f:
+        f.writelines(kept)
+    os.replace(temporary, output_path)
+    return done
+
+
+class BatchSearcher:
+    """Answer a stream of queries in bulk and write their results as JSON lines.
+
+    Queries are encoded `encode_batch_size` at a time with a single
+    `model.encode` call, and searched `msearch_size` at a time, each chunk in
+    a single `_msearch` request.  Up to `inflight` chunks are searched
+    concurrently while the next queries are encoded.  Results are written in
+    the order of the queries, one line per query.
+
+    Example:
+        searcher = BatchSearcher(store, "es0", model)
+        with open("results.jsonl", "a") as output:
+            searcher.run(read_queries(open("queries.txt")), output)
+        logger.info(searcher.stats())
+    """
+
+    def __init__(
+        self,
+        client: Union["Elasticsearch", VectorStore],
+        index_name: str,
+        model: Optional["SentenceTransformer"] = None,
+        k: int = 5,
+        aggregation: str = constants.CHUNK_AGGREGATION,
+        inner_hits: int = constants.INNER_HITS_SIZE,
+        mode: str = "knn",
+        fusion: str = constants.FUSION_METHOD,
+        lexical_weight: float = constants.LEXICAL_WEIGHT,
+        vector_weight: float = constants.VECTOR_WEIGHT,
+        depth: int = constants.HYBRID_DEPTH,
+        num_candidates: int = constants.NUM_CANDIDATES,
+        rank_constant: int = constants.RRF_RANK_CONSTANT,
+        filters: Union[Dict[str, object], List[dict], None] = None,
+        cache: Optional[EmbeddingCache] = None,
+        projection: Optional[Projection] = None,
+        encode_batch_size: int = constants.BATCH_ENCODE_SIZE,
+        msearch_size: int = constants.MSEARCH_SIZE,
+        inflight: int = constants.MSEARCH_INFLIGHT,
+        progress_interval: float = constants.BATCH_PROGRESS_INTERVAL,
+    ):
+        """
+        Args:
+            client (Elasticsearch): elasticsearch client, or the `VectorStore` to search.
+            index_name (str): index or alias searched.
+            model (SentenceTransformer): the model encoding the queries, not needed in lexical mode.
+            k (int): number of results per query.
+            aggregation (str): "max", "sum" or "none", see `perform_search`.
+            inner_hits (int): number of best passages returned with each document.
+            mode (str): one of `SEARCH_MODES`.
+            fusion (str): "rrf" or "weighted", how hybrid rankings are fused.
+            lexical_weight (float): weight of the BM25 ranking in hybrid mode.
+            vector_weight (float): weight of the kNN ranking in hybrid mode.
+            depth (int): hits fetched from each ranking before fusion in hybrid mode.
+            num_candidates (int): kNN candidates explored per shard.
+            rank_constant (int): rank constant of reciprocal rank fusion.
+            filters: conditions every result must match, see `metadata_filters`.
+            cache (EmbeddingCache): optional embedding cache of the query vectors.
+            projection (Projection): projection of the vectors of the index, see `index_projection`.
+            encode_batch_size (int): queries encoded together.
+            msearch_size (int): queries searched in a single `_msearch` request.
+            inflight (int): `_msearch` requests sent concurrently.
+            progress_interval (float): seconds between two progress logs.
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode {mode}, expected one of {SEARCH_MODES}")
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation {aggregation}, expected one of {AGGREGATIONS}")
+        if mode != "lexical" and model is None:
+            model = get_model()
+        self.store = as_vector_store(client)
+        self.index_name = index_name
+        self.model = model
+        self.k = k
+        self.aggregation = aggregation
+        self.inner_hits = inner_hits
+        self.mode = mode
+        self.fusion = fusion
+        self.weights = [vector_weight, lexical_weight]
+        self.depth = depth
+        self.num_candidates = num_candidates
+        self.rank_constant = rank_constant
+        self.filters = metadata_filters(filters)
+        self.cache = cache
+        self.projection = projection
+        self.encode_batch_size = encode_batch_size
+        self.msearch_size = msearch_size
+        self.inflight = max(inflight, 1)
+        self.progress_interval = progress_interval
+        self.answered = 0
+        self.failed = 0
+        self.encode_seconds = 0.0
+        self.elapsed = 0.0
+
+    def encode(self, queries: List[BatchQuery]) -> list:
+        """Query vectors of a batch, projected and normalized as `encode_query` does."""
+        if self.mode == "lexical":
+            return [None] * len(queries)
+        texts = [query.query for query in queries]
+        start = time.perf_counter()
+        with timer("batch_encode"):
+            if self.cache is not None:
+                vectors = self.cache.encode(
+                    texts, lambda misses: self.model.encode(misses, batch_size=self.encode_batch_size)
+                )
+            else:
+                vectors = self.model.encode(texts, batch_size=self.encode_batch_size)
+            if self.projection is not None:
+                vectors = self.projection.apply(vectors)
+            vectors = l2_normalize(vectors)
+        self.encode_seconds += time.perf_counter() - start
+        return list(vectors)
+
+    def bodies(self, query: BatchQuery, query_emb) -> List[dict]:
+        """The kNN and BM25 requests of a query, as `search_hits` sends them."""
+        ranking_size = max(self.depth, self.k) if self.mode == "hybrid" else self.k
+        options = dict(
+            aggregation=self.aggregation, inner_hits=self.inner_hits, filters=self.filters + query.filters
+        )
+        bodies = []
+        if self.mode in ("knn", "hybrid"):
+            bodies.append(
+                knn_search_body(query_emb, k=ranking_size, num_candidates=self.num_candidates, **options)
+            )
+        if self.mode in ("lexical", "hybrid"):
+            bodies.append(lexical_search_body(query.query, k=ranking_size, **options))
+        return bodies
+
+    def results(self, responses: List[dict]) -> List[SearchResult]:
+        """Results of a query from the responses to its requests."""
+        ranking_size = max(self.depth, self.k) if self.mode == "hybrid" else self.k
+        rankings = []
+        for res in responses:
+            hits = collect_hits(res, k=ranking_size, aggregation=self.aggregation, inner_hits=self.inner_hits)
+            for hit in hits:
+                hit.setdefault("_index", self.index_name)
+            rankings.append(hits)
+        hits = rankings[0]
+        if self.mode == "hybrid":
+            hits = fuse(
+                rankings,
+                size=self.k,
+                method=self.fusion,
+                weights=self.weights,
+                rank_constant=self.rank_constant,
+                key=passage_key if self.aggregation == "none" else hit_key,
+            )
+        return [SearchResult.from_hit(hit, self.aggregation) for hit in hits[: self.k]]
+
+    def search_chunk(self, queries: List[BatchQuery], vectors: list) -> List[dict]:
+        """Search a chunk of queries in a single `_msearch` request; one output entry per query."""
+        searches, counts = [], []
+        for query, query_emb in zip(queries, vectors):
+            bodies = self.bodies(query, query_emb)
+            searches.extend((self.index_name, body) for body in bodies)
+            counts.append(len(bodies))
+        start = time.perf_counter()
+        try:
+            responses = self.store.search_many(searches)
+        except Exception as e:
+            # Left out of the completed queries, so a resumed run retries them.
+            return [{"id": query.id, "query": query.query, "error": str(e)} for query in queries]
+        finally:
+            metrics.observe("msearch", time.perf_counter() - start)
+        entries, position = [], 0
+        for query, count in zip(queries, counts):
+            query_responses = responses[position : position + count]
+            position += count
+            try:
+                results = [asdict(result) for result in self.results(query_responses)]
+                entries.append({"id": query.id, "query": query.query, "results": results})
+            except Exception as e:
+                entries.append({"id": query.id, "query": query.query, "error": str(e)})
+        return entries
+
+    def run(self, queries: Iterable[BatchQuery], output: TextIO, skip: Optional[Set[str]] = None) -> int:
+        """Answer the queries and write their results to `output`.
+
+        Args:
+            queries (Iterable[BatchQuery]): the queries, read lazily.
+            output (TextIO): where the JSON lines are written, flushed after every chunk.
+            skip (Set[str]): ids of queries already answered, see `completed_ids`.
+
+        Returns:
+            number of queries answered.
+        """
+        skip = skip or set()
+        start = last_progress = time.perf_counter()
+        pending = deque()
+
+        def write(future: Future):
+            for entry in future.result():
+                if "error" in entry:
+                    self.failed += 1
+                    logger.error(f"Query {entry['id']} failed: {entry['error']}")
+                else:
+                    self.answered += 1
+                output.write(json.dumps(entry, default=str) + "\n")
+            output.flush()
+
+        with ThreadPoolExecutor(max_workers=self.inflight, thread_name_prefix="msearch") as executor:
+            todo = (query for query in queries if query.id not in skip)
+            for batch in batched(todo, self.encode_batch_size):
+                vectors = self.encode(batch)
+                for position in range(0, len(batch), self.msearch_size):
+                    chunk = slice(position, position + self.msearch_size)
+                    # Wait for the oldest chunk rather than queueing without bound.
+                    while len(pending) >= self.inflight:
+                        write(pending.popleft())
+                    pending.append(executor.submit(self.search_chunk, batch[chunk], vectors[chunk]))
+                now = time.perf_counter()
+                if now - last_progress >= self.progress_interval:
+                    last_progress = now
+                    logger.info(
+                        f"Answered {self.answered} queries ({self.rate(now - start):.1f} queries/sec)."
+                    )
+            while pending:
+                write(pending.popleft())
+        self.elapsed = time.perf_counter() - start
+        return self.answered
+
+    def rate(self, seconds: float) -> float:
+        return (self.answered + self.failed) / seconds if seconds > 0 else 0.0
+
+    def stats(self) -> dict:
+        """Throughput of the last run."""
+        return {
+            "answered": self.answered,
+            "failed": self.failed,
+            "elapsed_s": round(self.elapsed, 3),
+            "queries_per_sec": round(self.rate(self.elapsed), 1),
+            "encode_s": round(self.encode_seconds, 3),
+            "stages": metrics.summary() if metrics.enabled else {},
+        }
+
+
+if __name__ == "__main__":
+
+    # Get the parser arguments
+    parser = argparse.ArgumentParser(
+        description="script to run a file of queries in bulk and write their results as JSON lines.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=textwrap.dedent(
+            ''''
+        Current arguments are:
+
+        --index_name="es0"
+        --input="queries.txt"
+        --output="results.jsonl"
+        --k=10
+        --aggregation="max"
+        --mode="knn"
+        --fusion="rrf"
+        --depth=50
+        --num_candidates=100
+        --filter="metadata.tenant=acme"
+        --encode_batch_size=256
+        --msearch_size=64
+        --inflight=4
+        --cache_dir=".cache/embeddings"
+        --backend="elasticsearch"
+        --faiss_dir=".cache/faiss"
+        --restart
+
+        Example Usage
+        -------------
+        python %(prog)s --index_name es0 --input queries.txt --output results.jsonl
+        cat queries.jsonl | python %(prog)s --index_name es0 --output results.jsonl --k 100 --inflight 8
+        python %(prog)s --index_name es0 --input queries.txt --output results.jsonl --mode hybrid
+
+        Queries are one per line, as text or as {"id": ..., "query": ..., "filters": {...}}.
+        Running again with the same output resumes after the queries already answered.
+
+        '''
+        ),
+    )
+    parser.add_argument('--index_name', help='index or alias searched.', type=str, required=True)
+    parser.add_argument('--input', help='file of queries, stdin if not given or -.', type=str, default="-")
+    parser.add_argument(
+        '--output', help='JSON lines file the results are written to.', type=str, required=True
+    )
+    parser.add_argument('--k', help='number of results per query.', type=int, default=5)
+    parser.add_argument(
+        '--aggregation',
+        help='how passage scores are combined into document scores.',
+        choices=AGGREGATIONS,
+        default=constants.CHUNK_AGGREGATION,
+    )
+    parser.add_argument('--mode', help='kNN, BM25 or both fused.', choices=SEARCH_MODES, default="knn")
+    parser.add_argument(
+        '--fusion',
+        help='how hybrid rankings are fused.',
+        choices=FUSION_METHODS,
+        default=constants.FUSION_METHOD,
+    )
+    parser.add_argument(
+        '--depth',
+        help='hits fetched from each ranking before fusion.',
+        type=int,
+        default=constants.HYBRID_DEPTH,
+    )
+    parser.add_argument(
+        '--num_candidates',
+        help='kNN candidates explored per shard.',
+        type=int,
+        default=constants.NUM_CANDIDATES,
+    )
+    parser.add_argument(
+        '--filter',
+        help='condition every result must match, field=value, field=a,b or field>=bound; repeatable.',
+        action='append',
+        default=[],
+    )
+    parser.add_argument(
+        '--encode_batch_size',
+        help='queries encoded together.',
+        type=int,
+        default=constants.BATCH_ENCODE_SIZE,
+    )
+    parser.add_argument(
+        '--msearch_size',
+        help='queries searched per _msearch request.',
+        type=int,
+        default=constants.MSEARCH_SIZE,
+    )
+    parser.add_argument(
+        '--inflight',
+        help='_msearch requests sent concurrently.',
+        type=int,
+        default=constants.MSEARCH_INFLIGHT,
+    )
+    parser.add_argument('--cache_dir', help='embedding cache folder, no cache if not given.', type=str)
+    parser.add_argument(
+        '--backend',
+        help='where the passages are searched.',
+        choices=BACKENDS,
+        default=constants.VECTOR_BACKEND,
+    )
+    parser.add_argument('--faiss_dir', help='folder of the faiss indices.', type=str)
+    parser.add_argument(
+        '--restart', help='answer every query again instead of resuming the output.', action='store_true'
+    )
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+    try:
+        filters = parse_filters(args.filter)
+    except ValueError as e:
+        parser.error(str(e))
+
+    logger.info(f'Opening the {args.backend} vector store.')
+    store = open_store(args.backend, faiss_dir=args.faiss_dir, mmap=True)
+    cache = EmbeddingCache(args.cache_dir, constants.MAIN_EMBEDDING) if args.cache_dir else None
+    source = sys.stdin if args.input == "-" else open(args.input, "r")
+    try:
+        if args.restart and os.path.exists(args.output):
+            os.remove(args.output)
+        done = completed_ids(args.output)
+        if done:
+            logger.info(f"Resuming {args.output}, skipping the {len(done)} queries already answered.")
+        searcher = BatchSearcher(
+            store,
+            args.index_name,
+            k=args.k,
+            aggregation=args.aggregation,
+            mode=args.mode,
+            fusion=args.fusion,
+            depth=args.depth,
+            num_candidates=args.num_candidates,
+            filters=filters,
+            cache=cache,
+            projection=index_projection(store, args.index_name),
+            encode_batch_size=args.encode_batch_size,
+            msearch_size=args.msearch_size,
+            inflight=args.inflight,
+        )
+        with open(args.output, "a") as output:
+            searcher.run(read_queries(source), output, skip=done)
+        logger.info(f"Batch search stats: {searcher.stats()}")
+    except Exception as e:
+        logger.error(f"Could not run the batch search due to error {e}")
+        print(traceback.format_exc())
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if cache is not None:
+            cache.close()
+        store.close()
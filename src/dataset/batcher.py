@@ -0,0 +1,141 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, List
+
+import numpy as np
+
+from src.utils import constants
+from src.utils.logging import getLogger
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+# Number of recent samples the batch size and queueing delay statistics are computed over.
+_STATS_WINDOW = 10_000
+
+
+class QueryBatcher:
+    """Encode concurrent queries together in dynamic micro-batches.
+
+    Callers block on `encode` while a background thread collects queries for
+    up to `max_wait_ms` after the first one arrives, or until `max_batch_size`
+    queries are waiting, then encodes them with a single `model.encode` call
+    and hands every caller its own vector.  It exposes `encode` like the model
+    it wraps, so it can be passed to `perform_search` as the model.
+
+    Example:
+        batcher = QueryBatcher(model, max_batch_size=32, max_wait_ms=3)
+        vector = batcher.encode("what is semantic search?")
+        logger.info(batcher.stats())
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size: int = constants.QUERY_BATCH_SIZE,
+        max_wait_ms: float = constants.QUERY_BATCH_WAIT_MS,
+    ):
+        """
+        Args:
+            model (SentenceTransformer): the model encoding the queries.
+            max_batch_size (int): maximum number of queries encoded together.
+            max_wait_ms (float): how long the first query of a batch waits for others.
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._queries = 0
+        self._batch_sizes = deque(maxlen=_STATS_WINDOW)
+        self._delays_ms = deque(maxlen=_STATS_WINDOW)
+        self._thread = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+        self._thread.start()
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts, **kwargs) -> np.ndarray:
+        """Encode a query or a list of queries, batched with the other callers.
+
+        Keyword arguments of `SentenceTransformer.encode` are ignored, every
+        batch is encoded with the same settings.
+        """
+        single = isinstance(texts, str)
+        futures = []
+        for text in [texts] if single else texts:
+            future = Future()
+            self._queue.put((text, future, time.perf_counter()))
+            futures.append(future)
+        vectors = [future.result() for future in futures]
+        if single:
+            return vectors[0]
+        if not vectors:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        return np.stack(vectors)
+
+    def _collect(self) -> List[tuple]:
+        """Wait for a query, then for more until the batch is full or the window closes."""
+        batch = [self._queue.get()]
+        if batch[0] is None:
+            return []
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Finish the current batch, then stop.
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if not batch:
+                return
+            started = time.perf_counter()
+            try:
+                vectors = self.model.encode([text for text, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), vector in zip(batch, vectors):
+                future.set_result(vector)
+            with self._lock:
+                self._batches += 1
+                self._queries += len(batch)
+                self._batch_sizes.append(len(batch))
+                self._delays_ms.extend((started - enqueued) * 1000 for _, _, enqueued in batch)
+
+    def stats(self) -> Dict[str, float]:
+        """Batch size and queueing delay over the recent batches."""
+        with self._lock:
+            sizes = np.array(self._batch_sizes, dtype=np.float64)
+            delays = np.array(self._delays_ms, dtype=np.float64)
+            batches, queries = self._batches, self._queries
+        if not len(sizes):
+            return {"batches": 0, "queries": 0}
+        return {
+            "batches": batches,
+            "queries": queries,
+            "batch_size_mean": float(sizes.mean()),
+            "batch_size_max": float(sizes.max()),
+            "queue_delay_ms_p50": float(np.percentile(delays, 50)),
+            "queue_delay_ms_p99": float(np.percentile(delays, 99)),
+            "queue_delay_ms_max": float(delays.max()),
+        }
+
+    def close(self):
+        """Stop the batching thread once the waiting queries are encoded."""
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,560 @@
+import argparse
+import hashlib
+import json
+import re
+import shutil
+import subprocess
+import tempfile
+import textwrap
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+import argcomplete
+import numpy as np
+
+from src.dataset.chunking import STRATEGIES, Chunker
+from src.dataset.corpus import read_text_files
+from src.dataset.embeddings import local_text_embedding
+from src.dataset.memory_store import MemoryStore
+from src.dataset.profiles import PROFILES, get_profile
+from src.dataset.search import perform_search
+from src.dataset.vector_store import (
+    BACKENDS,
+    FAISS_INDEX_TYPES,
+    VectorStore,
+    open_store,
+)
+from src.utils import constants
+from src.utils.logging import getLogger
+from src.utils.metrics import metrics
+from src.utils.utils import l2_normalize
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+BENCHMARK_BACKENDS = ("memory", *BACKENDS)
+ENCODERS = ("stub", "model")
+
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+_WORD = re.compile(r"[A-Za-z]+")
+
+
+def _token_hash(token: str) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class StubTokenizer:
+    """Splits texts into words and punctuation, with the call interface of a huggingface tokenizer."""
+
+    def __init__(self, vocab_size: int = 30_522):
+        self.vocab_size = vocab_size
+
+    def _encode(self, text: str, add_special_tokens: bool, max_length: Optional[int]):
+        spans = [match.span() for match in _TOKEN.finditer(text)]
+        ids = [103 + _token_hash(text[start:end].lower()) % (self.vocab_size - 103) for start, end in spans]
+        if add_special_tokens:
+            ids, spans = [101, *ids, 102], [(0, 0), *spans, (0, 0)]
+        if max_length is not None:
+            ids, spans = ids[:max_length], spans[:max_length]
+        return ids, spans
+
+    def __call__(
+        self,
+        texts,
+        add_special_tokens: bool = True,
+        truncation: bool = False,
+        max_length: Optional[int] = None,
+        return_offsets_mapping: bool = False,
+        **kwargs,
+    ) -> dict:
+        single = isinstance(texts, str)
+        encoded = [
+            self._encode(text, add_special_tokens, max_length if truncation else None)
+            for text in ([texts] if single else texts)
+        ]
+        result = {"input_ids": [ids for ids, _ in encoded]}
+        if return_offsets_mapping:
+            result["offset_mapping"] = [spans for _, spans in encoded]
+        return {name: values[0] for name, values in result.items()} if single else result
+
+
+class StubEncoder:
+    """A deterministic stand-in for the embedding model, with its interface.
+
+    A text is embedded as the normalized sum of a fixed random vector per
+    word, seeded by the word itself: texts sharing words are close, the
+    vectors are the same on every machine and run, and encoding costs next
+    to nothing, so benchmarks measure the pipeline and the vector store
+    rather than the model, without downloading it.
+
+    Example:
+        encoder = StubEncoder(dims=384)
+        local_text_embedding(MemoryStore(), "bench", data_path, model=encoder)
+    """
+
+    def __init__(self, dims: int = constants.STUB_EMBEDDING_DIMS, max_seq_length: int = 256):
+        """
+        Args:
+            dims (int): dimension of the vectors.
+            max_seq_length (int): words of a text taken into account.
+        """
+        self.dims = dims
+        self.max_seq_length = max_seq_length
+        self.tokenizer = StubTokenizer()
+        self._words: Dict[str, np.ndarray] = {}
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dims
+
+    def _word_vector(self, word: str) -> np.ndarray:
+        vector = self._words.get(word)
+        if vector is None:
+            vector = np.random.default_rng(_token_hash(word)).standard_normal(self.dims).astype(np.float32)
+            self._words[word] = vector
+        return vector
+
+    def encode(self, texts, batch_size: int = constants.ENCODE_BATCH_SIZE, **kwargs) -> np.ndarray:
+        """Encode a text or a list of texts; `batch_size` and the other arguments are ignored."""
+        if isinstance(texts, str):
+            return self.encode([texts])[0]
+        embeddings = np.zeros((len(texts), self.dims), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in _WORD.findall(text.lower())[: self.max_seq_length]:
+                embeddings[i] += self._word_vector(word)
+        return l2_normalize(embeddings)
+
+
+def generate_corpus(
+    output_dir: str,
+    documents: int,
+    seed: int = constants.BENCHMARK_SEED,
+    sample_path: str = constants.BENCHMARK_SAMPLE_DATA,
+) -> Path:
+    """Write a synthetic corpus of text files in the style of the sample data.
+
+    Words are drawn from the vocabulary of the sample documents with their
+    frequencies, in sentences and documents of the sample lengths.  The
+    corpus only depends on the sample, the size and the seed, and an
+    existing corpus generated with the same ones is reused.
+
+    Args:
+        output_dir (str): folder of the corpus, files are spread over sub-folders of 1000.
+        documents (int): number of documents.
+        seed (int): seed of the random generator.
+        sample_path (str): folder of the sample documents.
+
+    Returns:
+        the corpus folder.
+    """
+    output_dir = Path(output_dir)
+    words, sentence_lengths, document_lengths = [], [], []
+    for chunk in read_text_files(str(sample_path)):
+        for document in chunk:
+            sentences = [sentence for sentence in re.split(r"(?<=[.!?])\s+", document.content) if sentence]
+            document_lengths.append(len(sentences))
+            for sentence in sentences:
+                sentence_words = _WORD.findall(sentence.lower())
+                sentence_lengths.append(len(sentence_words))
+                words.extend(sentence_words)
+    if not words:
+        raise ValueError(f"No sample documents in {sample_path}")
+    vocabulary, counts = np.unique(words, return_counts=True)
+    description = {
+        "documents": documents,
+        "seed": seed,
+        "sample": hashlib.blake2b(" ".join(words).encode("utf-8"), digest_size=8).hexdigest(),
+    }
+    marker = output_dir / "corpus.json"
+    if marker.exists() and json.loads(marker.read_text()) == description:
+        return output_dir
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+
+    rng = np.random.default_rng(seed)
+    probabilities = counts / counts.sum()
+    for i in range(documents):
+        sentences = []
+        for _ in range(int(rng.choice(document_lengths))):
+            sentence = " ".join(
+                rng.choice(vocabulary, size=max(int(rng.choice(sentence_lengths)), 1), p=probabilities)
+            )
+            sentences.append(sentence[:1].upper() + sentence[1:] + ".")
+        path = output_dir / f"part_{i // 1000:04d}" / f"document_{i}.txt"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(" ".join(sentences), encoding="utf-8")
+    marker.write_text(json.dumps(description))
+    logger.info(f"Generated {documents} documents in {output_dir}.")
+    return output_dir
+
+
+def sample_queries(
+    data_path: str, count: int = constants.BENCHMARK_QUERIES, seed: int = constants.BENCHMARK_SEED
+) -> List[str]:
+    """Queries made of the first words of random sentences of the corpus."""
+    rng = np.random.default_rng(seed)
+    # Sorted, the folder walk order depends on the file system.
+    documents = sorted(
+        (document for chunk in read_text_files(str(data_path)) for document in chunk),
+        key=lambda document: document.doc_id,
+    )
+    queries = []
+    for i in rng.integers(0, len(documents), size=count):
+        sentences = [sentence for sentence in re.split(r"(?<=[.!?])\s+", documents[i].content) if sentence]
+        words = sentences[int(rng.integers(0, len(sentences)))].split()
+        queries.append(" ".join(words[: int(rng.integers(3, 9))]))
+    return queries
+
+
+def exact_neighbours(
+    data_path: str,
+    queries: Sequence[str],
+    encoder,
+    k: int = constants.BENCHMARK_K,
+    chunk_strategy: str = constants.CHUNK_STRATEGY,
+) -> List[List[str]]:
+    """Ids of the `k` documents closest to every query, by brute force over all the passages.
+
+    Passages are split and encoded as by ingestion, and a document is scored
+    by its best passage, like `perform_search` with the "max" aggregation.
+    """
+    chunker = Chunker(chunk_strategy, tokenizer=encoder.tokenizer)
+    texts, parents = [], []
+    for chunk in read_text_files(str(data_path)):
+        for document in chunk:
+            for passage in chunker.split(document.content):
+                texts.append(passage)
+                parents.append(document.doc_id)
+    passages = l2_normalize(encoder.encode(texts, batch_size=constants.ENCODE_BATCH_SIZE))
+    parent_ids, parent_rows = np.unique(parents, return_inverse=True)
+
+    neighbours = []
+    for query_emb in l2_normalize(encoder.encode(list(queries))):
+        document_scores = np.full(len(parent_ids), -np.inf, dtype=np.float32)
+        np.maximum.at(document_scores, parent_rows, passages @ query_emb)
+        neighbours.append([str(parent_ids[i]) for i in np.argsort(-document_scores, kind="stable")[:k]])
+    return neighbours
+
+
+def _latency_stats(latencies_ms: Sequence[float]) -> Dict[str, float]:
+    latencies = np.asarray(latencies_ms, dtype=np.float64)
+    return {
+        "mean": float(latencies.mean()),
+        "p50": float(np.percentile(latencies, 50)),
+        "p95": float(np.percentile(latencies, 95)),
+        "p99": float(np.percentile(latencies, 99)),
+    }
+
+
+def bench_search(search: Callable[[str], list], queries: Sequence[str], concurrency: int) -> Dict[str, float]:
+    """Run every query from `concurrency` threads and measure the latencies and throughput."""
+
+    def timed(query):
+        start = time.perf_counter()
+        search(query)
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed, queries))
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "queries": len(queries),
+        "qps": len(queries) / elapsed,
+        "latency_ms": _latency_stats(latencies),
+    }
+
+
+def _open_benchmark_store(backend: str, index_name: str, dims: int, work_dir: Path, **options) -> VectorStore:
+    if backend == "memory":
+        return MemoryStore()
+    if backend == "faiss":
+        return open_store("faiss", faiss_dir=str(work_dir / "faiss"), index_type=options["faiss_index_type"])
+    store = open_store("elasticsearch")
+    profile = get_profile(options["profile"])
+    store.client.indices.create(
+        index=index_name, settings=profile.settings(), mappings=profile.mappings(dims)
+    )
+    return store
+
+
+def _close_benchmark_store(store: VectorStore, backend: str, index_name: str):
+    if backend == "elasticsearch":
+        store.client.indices.delete(index=index_name, ignore_unavailable=True)
+    store.close()
+
+
+def run_benchmark(
+    sizes: Sequence[int] = constants.BENCHMARK_SIZES,
+    backend: str = "memory",
+    encoder=None,
+    queries: int = constants.BENCHMARK_QUERIES,
+    concurrency: Sequence[int] = constants.BENCHMARK_CONCURRENCY,
+    k: int = constants.BENCHMARK_K,
+    seed: int = constants.BENCHMARK_SEED,
+    corpus_dir: str = constants.BENCHMARK_DIR / "corpora",
+    batch_size: int = constants.ENCODE_BATCH_SIZE,
+    max_tokens: Optional[int] = constants.ENCODE_MAX_TOKENS,
+    chunk_strategy: str = constants.CHUNK_STRATEGY,
+    faiss_index_type: str = constants.FAISS_INDEX_TYPE,
+    profile: str = "default",
+) -> dict:
+    """Benchmark ingestion and search on synthetic corpora of several sizes.
+
+    For every size a corpus is generated, ingested with
+    `local_text_embedding` into a new index, and searched with
+    `perform_search` at every concurrency level.  The results of the first
+    level are compared to the exact nearest documents for recall.
+
+    Args:
+        sizes (Sequence[int]): numbers of documents of the corpora.
+        backend (str): "memory" for an in-memory exact store, "faiss" or
+            "elasticsearch", where a temporary index is created.
+        encoder: the embedding model, a `StubEncoder` by default.
+        queries (int): number of queries.
+        concurrency (Sequence[int]): numbers of concurrent searches.
+        k (int): number of results per query.
+        seed (int): seed of the corpora and queries.
+        corpus_dir (str): folder of the generated corpora, kept between runs.
+        batch_size (int): batch size of the encoding, without `max_tokens`.
+        max_tokens (int): token budget of an encode batch.
+        chunk_strategy (str): how documents are split into passages.
+        faiss_index_type (str): index type of the faiss backend.
+        profile (str): index profile of the elasticsearch backend.
+
+    Returns:
+        the configuration and, per corpus size, ingestion throughput, recall
+        at k, search latency and throughput per concurrency level and the
+        stage timings.
+    """
+    if backend not in BENCHMARK_BACKENDS:
+        raise ValueError(f"Unknown benchmark backend {backend}, expected one of {BENCHMARK_BACKENDS}")
+    encoder = encoder if encoder is not None else StubEncoder()
+    report = {
+        "commit": _git_commit(),
+        "config": {
+            "backend": backend,
+            "encoder": type(encoder).__name__,
+            "dims": encoder.get_sentence_embedding_dimension(),
+            "queries": queries,
+            "k": k,
+            "seed": seed,
+            "batch_size": batch_size,
+            "max_tokens": max_tokens,
+            "chunk_strategy": chunk_strategy,
+            **({"faiss_index_type": faiss_index_type} if backend == "faiss" else {}),
+            **({"profile": profile} if backend == "elasticsearch" else {}),
+        },
+        "runs": [],
+    }
+    for size in sizes:
+        data_path = generate_corpus(Path(corpus_dir) / f"corpus-{size}-{seed}", size, seed=seed)
+        index_name = f"benchmark-{size}"
+        work_dir = Path(tempfile.mkdtemp(prefix="benchmark-"))
+        store = _open_benchmark_store(
+            backend,
+            index_name,
+            encoder.get_sentence_embedding_dimension(),
+            work_dir,
+            faiss_index_type=faiss_index_type,
+            profile=profile,
+        )
+        # Stage timings of this corpus only.
+        metrics.reset()
+        try:
+            start = time.perf_counter()
+            indexed = local_text_embedding(
+                store,
+                index_name,
+                str(data_path),
+                model=encoder,
+                batch_size=batch_size,
+                max_tokens=max_tokens,
+                chunk_strategy=chunk_strategy,
+            )
+            seconds = time.perf_counter() - start
+            if backend == "elasticsearch":
+                store.client.indices.refresh(index=index_name)
+
+            query_texts = sample_queries(data_path, queries, seed=seed)
+
+            def search(query):
+                return perform_search(query, store, index_name, encoder, k=k)
+
+            truth = exact_neighbours(data_path, query_texts, encoder, k=k, chunk_strategy=chunk_strategy)
+            found = [[result.parent_id or result.id for result in search(query)] for query in query_texts]
+            recall = float(
+                np.mean(
+                    [len(set(ids) & set(expected)) / len(expected) for ids, expected in zip(found, truth)]
+                )
+            )
+            run = {
+                "documents": size,
+                "indexed": indexed,
+                "ingestion": {"seconds": seconds, "docs_per_sec": indexed / seconds if seconds > 0 else 0.0},
+                f"recall@{k}": recall,
+                "search": [bench_search(search, query_texts, level) for level in concurrency],
+                "stages": metrics.summary(),
+            }
+        finally:
+            _close_benchmark_store(store, backend, index_name)
+            shutil.rmtree(work_dir, ignore_errors=True)
+        logger.info(
+            f"{size} documents: {run['ingestion']['docs_per_sec']:.1f} docs/sec, recall@{k} {recall:.3f}, "
+            + ", ".join(
+                f"{level['qps']:.1f} qps p99 {level['latency_ms']['p99']:.1f}ms at {level['concurrency']}"
+                for level in run["search"]
+            )
+        )
+        report["runs"].append(run)
+    return report
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=constants.PROJECT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+if __name__ == "__main__":
+
+    # Get the parser arguments
+    parser = argparse.ArgumentParser(
+        description="script to benchmark ingestion and search.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=textwrap.dedent(
+            ''''
+        Current arguments are:
+
+        --sizes=1000,10000
+        --backend="memory"
+        --encoder="stub"
+        --queries=200
+        --concurrency=1,4,16
+        --k=10
+        --seed=0
+        --batch_size=32
+        --max_tokens=8192
+        --chunk_strategy="none"
+        --faiss_index_type="hnsw"
+        --profile="default"
+        --corpus_dir=".cache/benchmarks/corpora"
+        --output=".cache/benchmarks/<commit>.json"
+
+        Example Usage
+        -------------
+        python %(prog)s
+        python %(prog)s --sizes 1000 --concurrency 1,8 --output before.json
+        python %(prog)s --backend faiss --faiss_index_type ivfpq --sizes 100000
+        python %(prog)s --backend elasticsearch --encoder model --profile compact
+
+        '''
+        ),
+    )
+    parser.add_argument(
+        '--sizes',
+        help='comma separated numbers of documents of the corpora.',
+        type=_int_list,
+        default=list(constants.BENCHMARK_SIZES),
+    )
+    parser.add_argument(
+        '--backend',
+        help='where the corpora are indexed; memory is an exact in-process store.',
+        choices=BENCHMARK_BACKENDS,
+        default="memory",
+    )
+    parser.add_argument(
+        '--encoder',
+        help='stub is a deterministic hashing encoder, model the embedding model.',
+        choices=ENCODERS,
+        default="stub",
+    )
+    parser.add_argument('--queries', help='number of queries.', type=int, default=constants.BENCHMARK_QUERIES)
+    parser.add_argument(
+        '--concurrency',
+        help='comma separated numbers of concurrent searches.',
+        type=_int_list,
+        default=list(constants.BENCHMARK_CONCURRENCY),
+    )
+    parser.add_argument('--k', help='number of results per query.', type=int, default=constants.BENCHMARK_K)
+    parser.add_argument(
+        '--seed', help='seed of the corpora and queries.', type=int, default=constants.BENCHMARK_SEED
+    )
+    parser.add_argument(
+        '--batch_size',
+        help='batch size of the model encoding.',
+        type=int,
+        default=constants.ENCODE_BATCH_SIZE,
+    )
+    parser.add_argument(
+        '--max_tokens',
+        help='token budget of an encode batch, 0 encodes --batch_size passages at a time.',
+        type=int,
+        default=constants.ENCODE_MAX_TOKENS,
+    )
+    parser.add_argument(
+        '--chunk_strategy',
+        help='how documents are split into passages.',
+        choices=STRATEGIES,
+        default=constants.CHUNK_STRATEGY,
+    )
+    parser.add_argument(
+        '--faiss_index_type',
+        help='index type of the faiss backend.',
+        choices=FAISS_INDEX_TYPES,
+        default=constants.FAISS_INDEX_TYPE,
+    )
+    parser.add_argument(
+        '--profile',
+        help='index profile of the elasticsearch backend.',
+        choices=list(PROFILES),
+        default="default",
+    )
+    parser.add_argument(
+        '--corpus_dir',
+        help='folder of the generated corpora, reused between runs.',
+        type=str,
+        default=str(constants.BENCHMARK_DIR / "corpora"),
+    )
+    parser.add_argument('--output', help='JSON file of the results.', type=str)
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+
+    if args.encoder == "model":
+        from src.utils.registry import get_model
+
+        encoder = get_model()
+    else:
+        encoder = StubEncoder()
+    report = run_benchmark(
+        sizes=args.sizes,
+        backend=args.backend,
+        encoder=encoder,
+        queries=args.queries,
+        concurrency=args.concurrency,
+        k=args.k,
+        seed=args.seed,
+        corpus_dir=args.corpus_dir,
+        batch_size=args.batch_size,
+        max_tokens=args.max_tokens,
+        chunk_strategy=args.chunk_strategy,
+        faiss_index_type=args.faiss_index_type,
+        profile=args.profile,
+    )
+    output = Path(args.output or constants.BENCHMARK_DIR / f"{report['commit'] or 'benchmark'}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, sort_keys=True) + "\n")
+    logger.info(f"Wrote the benchmark results to {output}.")
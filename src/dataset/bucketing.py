@@ -0,0 +1,157 @@
+import threading
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from src.utils import constants
+from src.utils.logging import getLogger
+from src.utils.metrics import timer
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+
+def token_budget_batches(
+    lengths: Sequence[int],
+    max_tokens: int = constants.ENCODE_MAX_TOKENS,
+    max_batch_size: int = constants.ENCODE_MAX_BATCH_SIZE,
+) -> List[np.ndarray]:
+    """Group texts of similar length into batches whose padded size fits a token budget.
+
+    Texts are sorted by decreasing length, so every batch is padded to its
+    first text and the largest batch runs first.  A text longer than the
+    budget gets a batch of its own.
+
+    Args:
+        lengths (Sequence[int]): token length of every text.
+        max_tokens (int): maximum of batch size times longest text of a batch.
+        max_batch_size (int): maximum number of texts of a batch.
+
+    Returns:
+        the positions of the texts of every batch.
+    """
+    order = np.argsort(-np.asarray(lengths, dtype=np.int64), kind="stable")
+    batches, start = [], 0
+    while start < len(order):
+        longest = max(int(lengths[order[start]]), 1)
+        size = min(max(max_tokens // longest, 1), max_batch_size)
+        batches.append(order[start : start + size])
+        start += size
+    return batches
+
+
+def padded_tokens(lengths: Sequence[int], batches: Sequence[Sequence[int]]) -> int:
+    """Tokens the forward passes of the batches process, padding included."""
+    return sum(len(batch) * max(int(lengths[i]) for i in batch) for batch in batches if len(batch))
+
+
+class LengthBucketedEncoder:
+    """Encode texts in batches of similar token length under a token budget.
+
+    Batches built in reading order pad every short text to the longest one of
+    its batch.  This wrapper tokenizes the texts to measure them, encodes
+    them in `token_budget_batches`, one forward pass each, and returns the
+    vectors in the original order.  A model with an `encode_batches` method,
+    like `EncoderPool`, gets all the batches at once to spread them over its
+    workers.  It exposes the model interface, so it can be used in its place.
+
+    Example:
+        encoder = LengthBucketedEncoder(model, max_tokens=8192)
+        embeddings = encoder.encode(texts)
+        logger.info(encoder.stats())
+    """
+
+    def __init__(
+        self,
+        model,
+        max_tokens: int = constants.ENCODE_MAX_TOKENS,
+        max_batch_size: int = constants.ENCODE_MAX_BATCH_SIZE,
+    ):
+        """
+        Args:
+            model (SentenceTransformer): the model, or an encoder exposing the same interface.
+            max_tokens (int): token budget of a batch, padding included.
+            max_batch_size (int): maximum number of texts of a batch.
+        """
+        self.model = model
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._texts = 0
+        self._batches = 0
+        self._tokens = 0
+        self._padded = 0
+        # Padded tokens of fixed size batches in reading order, for comparison.
+        self._unsorted_padded = 0
+
+    @property
+    def tokenizer(self):
+        return self.model.tokenizer
+
+    @property
+    def max_seq_length(self) -> int:
+        return self.model.max_seq_length
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def token_lengths(self, texts: List[str]) -> np.ndarray:
+        """Token length of the texts as the model sees them, special tokens included and truncated."""
+        with timer("tokenize"):
+            encoded = self.tokenizer(texts, truncation=True, max_length=self.max_seq_length)
+        return np.array([len(ids) for ids in encoded["input_ids"]], dtype=np.int64)
+
+    def encode(self, texts, batch_size: int = constants.ENCODE_BATCH_SIZE, **kwargs) -> np.ndarray:
+        """Encode a text or a list of texts.
+
+        Args:
+            texts: a text or a list of texts.
+            batch_size (int): size of the fixed batches the padding is compared to.
+            kwargs: other arguments of `SentenceTransformer.encode`.
+        """
+        if isinstance(texts, str):
+            return self.encode([texts], batch_size=batch_size, **kwargs)[0]
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        lengths = self.token_lengths(texts)
+        batches = token_budget_batches(lengths, self.max_tokens, self.max_batch_size)
+        batch_texts = [[texts[i] for i in batch] for batch in batches]
+        if hasattr(self.model, "encode_batches"):
+            encoded = self.model.encode_batches(batch_texts, **kwargs)
+        else:
+            encoded = [self.model.encode(batch, batch_size=len(batch), **kwargs) for batch in batch_texts]
+
+        embeddings = np.empty((len(texts), encoded[0].shape[1]), dtype=np.float32)
+        for batch, vectors in zip(batches, encoded):
+            embeddings[batch] = vectors
+
+        unsorted = [
+            range(start, min(start + batch_size, len(texts))) for start in range(0, len(texts), batch_size)
+        ]
+        with self._lock:
+            self._texts += len(texts)
+            self._batches += len(batches)
+            self._tokens += int(lengths.sum())
+            self._padded += padded_tokens(lengths, batches)
+            self._unsorted_padded += padded_tokens(lengths, unsorted)
+        return embeddings
+
+    def stats(self) -> Dict[str, float]:
+        """Padding efficiency: the share of the processed tokens that are real ones, not padding."""
+        with self._lock:
+            texts, batches, tokens, padded, unsorted = (
+                self._texts,
+                self._batches,
+                self._tokens,
+                self._padded,
+                self._unsorted_padded,
+            )
+        return {
+            "texts": texts,
+            "batches": batches,
+            "tokens": tokens,
+            "padded_tokens": padded,
+            "padding_efficiency": tokens / padded if padded else 1.0,
+            "unsorted_padding_efficiency": tokens / unsorted if unsorted else 1.0,
+        }
@@ -0,0 +1,322 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from src.utils import constants
+from src.utils.logging import getLogger
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+# Number of rows the vector file starts with; it doubles when full.
+_INITIAL_ROWS = 1024
+
+
+def normalize_text(text: str) -> str:
+    """Normalize a text before hashing it so whitespace-only edits hit the same entry."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def text_key(text: str, model_name: str, backend: str = constants.ENCODER_BACKEND) -> str:
+    """Hash of the model id, the encoder backend and the normalized text used as the cache key."""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(model_name.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(backend.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(normalize_text(text).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent, content-addressed cache of text embeddings.
+
+    Vectors are stored as float32 or float16 rows in a memory-mapped file and
+    an sqlite table maps each key (model id + encoder backend + hash of the
+    normalized text) to its row.  Once `max_entries` is reached the least
+    recently used entries are evicted and their rows are reused.  Backends
+    don't share entries, quantized and ONNX encoders don't produce exactly
+    the vectors of torch.
+
+    Several processes can share a cache: every write is a short sqlite
+    transaction in WAL mode, and rows are handed out through the database,
+    so two writers never get the same row.  A row is reserved and its
+    previous key deleted in one transaction, its vector written and flushed,
+    and only then is its new key recorded; a crash in between leaves an
+    unused row, never a key pointing at another text's vector.
+
+    Example:
+        cache = EmbeddingCache(".cache/embeddings", constants.MAIN_EMBEDDING, dims=768)
+        vectors = cache.encode(texts, lambda misses: model.encode(misses))
+        cache.close()
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        model_name: str,
+        dims: Optional[int] = None,
+        max_entries: int = constants.EMBEDDING_CACHE_MAX_ENTRIES,
+        dtype: str = constants.EMBEDDING_CACHE_DTYPE,
+        backend: str = constants.ENCODER_BACKEND,
+    ):
+        """Open the cache, creating it if needed.
+
+        Args:
+            cache_dir (str): root folder of the cache; each model and backend
+                gets a sub-folder.
+            model_name (str): id of the model that produces the vectors.
+            dims (int): embedding vector dimension, taken from the first stored
+                vectors if not given.
+            max_entries (int): maximum number of vectors kept on disk.
+            dtype (str): storage type of the vectors, "float32" or "float16".
+            backend (str): encoder backend that produces the vectors, see
+                `ENCODER_BACKENDS`.
+        """
+        if dtype not in ("float32", "float16"):
+            raise ValueError(f"Unsupported cache dtype {dtype}, expected float32 or float16")
+        self.model_name = model_name
+        self.backend = backend
+        self.dims = dims
+        self.max_entries = max_entries
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        self.path = Path(cache_dir) / model_name.replace("/", "__") / backend
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Transactions are explicit, see `_transaction`.
+        self._db = sqlite3.connect(
+            str(self.path / "index.sqlite"),
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=constants.EMBEDDING_CACHE_LOCK_TIMEOUT,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._transaction():
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, row INTEGER, last_used INTEGER)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            self._check_meta()
+
+        self._vectors_path = self.path / f"vectors.{dtype}"
+        self._vectors = None
+        if self.dims is not None:
+            self._vectors = self._open_vectors(max(_INITIAL_ROWS, int(self._get_meta("next_row", 0))))
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """A write transaction; it takes the write lock up front so concurrent writers wait their turn."""
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def _get_meta(self, name: str, default=None):
+        row = self._db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else default
+
+    def _set_meta(self, name: str, value):
+        self._db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, str(value)))
+
+    def _check_meta(self):
+        """Make sure an existing cache was built for the same vector layout."""
+        if self.dims is None and self._get_meta("dims") is not None:
+            self.dims = int(self._get_meta("dims"))
+        expected = {
+            "model_name": self.model_name,
+            "backend": self.backend,
+            "dims": self.dims,
+            "dtype": self.dtype.name,
+        }
+        for name, value in expected.items():
+            stored = self._get_meta(name)
+            if value is None:
+                continue
+            value = str(value)
+            if stored is None:
+                self._set_meta(name, value)
+            elif stored != value:
+                raise ValueError(f"Cache at {self.path} has {name}={stored}, expected {value}")
+
+    def _open_vectors(self, rows: int) -> np.memmap:
+        """Memory-map the vector file, growing it to hold at least `rows` rows.
+
+        The file never shrinks, it may already be larger if another process grew it.
+        """
+        size = rows * self.dims * self.dtype.itemsize
+        if not self._vectors_path.exists():
+            self._vectors_path.touch()
+        current = os.path.getsize(self._vectors_path)
+        if current < size:
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(size)
+        rows = max(size, current) // (self.dims * self.dtype.itemsize)
+        return np.memmap(self._vectors_path, dtype=self.dtype, mode="r+", shape=(rows, self.dims))
+
+    def _ensure_rows(self, rows: int):
+        """Remap the vector file if it must hold more rows than mapped, grown by this or another process."""
+        if self._vectors is None:
+            # Another process stored the first vectors.
+            self._check_meta()
+            self._vectors = self._open_vectors(max(_INITIAL_ROWS, rows))
+        elif rows > self._vectors.shape[0]:
+            self._vectors.flush()
+            self._vectors = self._open_vectors(min(self.max_entries, max(rows, 2 * self._vectors.shape[0])))
+
+    def _allocate_rows(self, count: int) -> List[int]:
+        """Reserve `count` free rows, evicting the least recently used entries if needed.
+
+        Runs in a transaction of its own: the next free row is read and bumped
+        in the database, and the evicted keys are deleted before their rows
+        are overwritten.
+        """
+        with self._transaction():
+            next_row = int(self._get_meta("next_row", 0))
+            fresh = max(min(count, self.max_entries - next_row), 0)
+            rows = list(range(next_row, next_row + fresh))
+            self._set_meta("next_row", next_row + fresh)
+            # Grown under the write lock, so concurrent processes don't race on the file size.
+            self._ensure_rows(next_row + fresh)
+
+            evict = count - fresh
+            if evict > 0:
+                victims = self._db.execute(
+                    "SELECT key, row FROM entries ORDER BY last_used LIMIT ?", (evict,)
+                ).fetchall()
+                self._db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in victims])
+                rows.extend(row for _, row in victims)
+                self.evictions += len(victims)
+        return rows
+
+    def _lookup(self, keys: Sequence[str]) -> Dict[str, int]:
+        """Map the cached keys among `keys` to their rows."""
+        found: Dict[str, int] = {}
+        # Stay below the sqlite limit on the number of query parameters.
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(
+                self._db.execute(f"SELECT key, row FROM entries WHERE key IN ({placeholders})", chunk)
+            )
+        return found
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Look up the vectors of the given texts, None for the ones not cached."""
+        keys = [text_key(text, self.model_name, self.backend) for text in texts]
+        # The vectors are copied before the transaction ends, so another
+        # process can't evict an entry and overwrite its row in between.
+        with self._lock, self._transaction():
+            found = self._lookup(keys)
+            if found:
+                self._db.executemany(
+                    "UPDATE entries SET last_used = ? WHERE key = ?", [(time.time_ns(), key) for key in found]
+                )
+                self._ensure_rows(max(found.values()) + 1)
+            results = [
+                np.array(self._vectors[found[key]], dtype=np.float32) if key in found else None
+                for key in keys
+            ]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return results
+
+    def put_many(self, texts: Sequence[str], vectors: np.ndarray):
+        """Store the vectors of the given texts."""
+        if self.dims is None:
+            with self._lock, self._transaction():
+                self.dims = int(np.shape(vectors)[1])
+                self._check_meta()
+                self._vectors = self._open_vectors(_INITIAL_ROWS)
+        key_to_vector = {
+            text_key(text, self.model_name, self.backend): vector for text, vector in zip(texts, vectors)
+        }
+        keys = list(key_to_vector)
+        # Never store more than the cache can hold.
+        keys = keys[-self.max_entries :]
+        with self._lock:
+            # Entries cached meanwhile, by this or another process, keep their
+            # vectors.  Mark them as used first so they can't be evicted to
+            # make room for the new ones.
+            with self._transaction():
+                existing = self._lookup(keys)
+                self._db.executemany(
+                    "UPDATE entries SET last_used = ? WHERE key = ?",
+                    [(time.time_ns(), key) for key in existing],
+                )
+            new_keys = [key for key in keys if key not in existing]
+            if not new_keys:
+                return
+            rows = dict(zip(new_keys, self._allocate_rows(len(new_keys))))
+            for key in new_keys:
+                self._vectors[rows[key]] = key_to_vector[key]
+            # The vectors are on disk before any key points to them.
+            self._vectors.flush()
+            used = time.time_ns()
+            with self._transaction():
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO entries (key, row, last_used) VALUES (?, ?, ?)",
+                    [(key, rows[key], used) for key in new_keys],
+                )
+
+    def encode(self, texts: Sequence[str], encode_fn: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """Return the vectors of the texts, encoding only the ones not cached.
+
+        Args:
+            texts (Sequence[str]): the texts to embed.
+            encode_fn (Callable): encodes a list of texts into a 2D array.
+        """
+        cached = self.get_many(texts)
+        # Texts that normalize to the same key are encoded once.
+        missing: Dict[str, List[int]] = {}
+        for i, vector in enumerate(cached):
+            if vector is None:
+                missing.setdefault(text_key(texts[i], self.model_name, self.backend), []).append(i)
+        if missing:
+            unique_texts = [texts[positions[0]] for positions in missing.values()]
+            encoded = np.asarray(encode_fn(unique_texts), dtype=np.float32)
+            self.put_many(unique_texts, encoded)
+            for positions, vector in zip(missing.values(), encoded):
+                for i in positions:
+                    cached[i] = vector
+        if not cached:
+            return np.zeros((0, self.dims or 0), dtype=np.float32)
+        return np.stack(cached)
+
+    def stats(self) -> Dict[str, float]:
+        """Hit/miss counters of this process and the size of the cache."""
+        lookups = self.hits + self.misses
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+        }
+
+    def flush(self):
+        """Persist the vectors; the key index is committed by every write."""
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+
+    def close(self):
+        self.flush()
+        self._db.close()
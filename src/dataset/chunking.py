@@ -0,0 +1,114 @@
+import re
+from typing import List, Optional, Tuple
+
+from src.utils import constants
+
+# A sentence ends with ., ! or ? followed by white space.
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+STRATEGIES = ("none", "sentences", "tokens", "max_tokens")
+
+
+def split_sentences(text: str) -> List[str]:
+    """Split a text into sentences."""
+    return [sentence.strip() for sentence in _SENTENCE_END.split(text) if sentence.strip()]
+
+
+class Chunker:
+    """Split documents into passages that are embedded separately.
+
+    Strategies:
+        none       : the whole document is a single passage.
+        sentences  : windows of `chunk_size` sentences, overlapping by `overlap` sentences.
+        tokens     : windows of `chunk_size` tokens, overlapping by `overlap` tokens.
+        max_tokens : whole sentences packed into passages of at most `chunk_size`
+                     tokens; sentences longer than that are split into token windows.
+
+    Tokens are counted with the tokenizer of the embedding model, so passages
+    fit in the model input instead of being silently truncated.
+
+    Example:
+        chunker = Chunker("max_tokens", tokenizer=model.tokenizer, chunk_size=model.max_seq_length - 2)
+        passages = chunker.split(text)
+    """
+
+    def __init__(
+        self,
+        strategy: str = constants.CHUNK_STRATEGY,
+        tokenizer=None,
+        chunk_size: Optional[int] = None,
+        overlap: Optional[int] = None,
+    ):
+        """
+        Args:
+            strategy (str): one of `STRATEGIES`.
+            tokenizer: huggingface tokenizer of the model, required for the token strategies.
+            chunk_size (int): sentences per passage for `sentences`, tokens otherwise.
+            overlap (int): sentences or tokens shared by consecutive windows.
+        """
+        if chunk_size is None:
+            chunk_size = constants.CHUNK_SENTENCES if strategy == "sentences" else constants.CHUNK_SIZE
+        if overlap is None:
+            overlap = 0 if strategy == "sentences" else constants.CHUNK_OVERLAP
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown chunk strategy {strategy}, expected one of {STRATEGIES}")
+        if strategy in ("tokens", "max_tokens") and tokenizer is None:
+            raise ValueError(f"The {strategy} chunk strategy needs the model tokenizer")
+        if strategy != "none" and not 0 <= overlap < chunk_size:
+            raise ValueError(f"Chunk overlap must be in [0, {chunk_size}), got {overlap}")
+        self.strategy = strategy
+        self.tokenizer = tokenizer
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+
+    def _windows(self, count: int) -> List[Tuple[int, int]]:
+        """(start, end) of the overlapping windows covering `count` items."""
+        step = self.chunk_size - self.overlap
+        starts = range(0, max(count - self.overlap, 1), step)
+        return [(start, min(start + self.chunk_size, count)) for start in starts]
+
+    def _token_offsets(self, text: str) -> List[Tuple[int, int]]:
+        """Character offsets of the tokens of a text."""
+        encoding = self.tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True, truncation=False, verbose=False
+        )
+        return encoding["offset_mapping"]
+
+    def _token_windows(self, text: str) -> List[str]:
+        offsets = self._token_offsets(text)
+        if not offsets:
+            return [text]
+        return [text[offsets[start][0] : offsets[end - 1][1]] for start, end in self._windows(len(offsets))]
+
+    def _pack_sentences(self, text: str) -> List[str]:
+        passages, current, current_tokens = [], [], 0
+        for sentence in split_sentences(text):
+            tokens = len(self._token_offsets(sentence))
+            if tokens > self.chunk_size:
+                # Too long to fit in a passage on its own.
+                if current:
+                    passages.append(" ".join(current))
+                    current, current_tokens = [], 0
+                passages.extend(self._token_windows(sentence))
+                continue
+            if current_tokens + tokens > self.chunk_size:
+                passages.append(" ".join(current))
+                current, current_tokens = [], 0
+            current.append(sentence)
+            current_tokens += tokens
+        if current:
+            passages.append(" ".join(current))
+        return passages
+
+    def split(self, text: str) -> List[str]:
+        """Split a document into passages; a document always has at least one passage."""
+        if self.strategy == "sentences":
+            sentences = split_sentences(text)
+            passages = [" ".join(sentences[start:end]) for start, end in self._windows(len(sentences))]
+        elif self.strategy == "tokens":
+            passages = self._token_windows(text)
+        elif self.strategy == "max_tokens":
+            passages = self._pack_sentences(text)
+        else:
+            passages = [text]
+        return [passage for passage in passages if passage] or [text]
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional, Tuple
+
+from src.utils import constants
+from src.utils.logging import getLogger
+from src.utils.utils import batched
+
+# Instantiate the logger
+logger = getLogger(__name__, rate_limit=constants.LOG_RATE_LIMIT)
+
+
+@dataclass
+class TextDocument:
+    """A text file of the corpus and what is needed to index it."""
+
+    doc_id: str
+    name: str
+    path: str
+    content: str
+    mtime_ns: int
+    size: int
+    content_hash: str
+    # number of passages the document was split into when indexed
+    chunks: int = 0
+    # fields of the sidecar JSON file of the document, if any
+    metadata: dict = field(default_factory=dict)
+    # mtime and size of the file and its sidecar together, see `file_signature`
+    signature: Tuple[int, int] = (0, 0)
+
+
+def document_id(relative_path: str) -> str:
+    """Stable document id derived from the path of the file in the corpus."""
+    return hashlib.sha1(relative_path.replace(os.sep, "/").encode("utf-8")).hexdigest()
+
+
+def passage_id(doc_id: str, passage: int) -> str:
+    """Id of the `passage`-th passage of a document in the index."""
+    return f"{doc_id}-{passage}"
+
+
+def content_hash(content: str) -> str:
+    """Hash of the file content used to detect changes."""
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=20).hexdigest()
+
+
+def scan_text_files(data_path: str) -> Iterator[str]:
+    """Walk a folder tree lazily and yield the paths of its text files.
+
+    Directories are visited with `os.scandir` using an explicit stack, so only
+    the entries of the directories being walked are held in memory.
+
+    Args:
+        data_path (str): the root folder of the corpus.
+    """
+    stack = [data_path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                # Check if the file is a text file
+                elif entry.name.endswith(".txt") and entry.is_file():
+                    yield entry.path
+
+
+def sidecar_path(file_path: str) -> str:
+    """Path of the optional JSON metadata of a text file, `report.json` for `report.txt`."""
+    return os.path.splitext(file_path)[0] + constants.SIDECAR_SUFFIX
+
+
+def file_signature(file_path: str, stat: Optional[os.stat_result] = None) -> Tuple[int, int]:
+    """Latest mtime and total size of a text file and its sidecar, which change when either does."""
+    stat = stat or os.stat(file_path)
+    try:
+        sidecar = os.stat(sidecar_path(file_path))
+    except FileNotFoundError:
+        return stat.st_mtime_ns, stat.st_size
+    return max(stat.st_mtime_ns, sidecar.st_mtime_ns), stat.st_size + sidecar.st_size
+
+
+def read_sidecar(file_path: str) -> Tuple[dict, str]:
+    """Metadata of the sidecar of a text file and its raw text; empty without a sidecar or a JSON object."""
+    try:
+        with open(sidecar_path(file_path), "r") as file:
+            raw = file.read()
+    except FileNotFoundError:
+        return {}, ""
+    try:
+        metadata = json.loads(raw)
+    except ValueError as e:
+        logger.warning(f"Ignored the metadata of {file_path}, its sidecar isn't valid JSON: {e}")
+        return {}, raw
+    if not isinstance(metadata, dict):
+        logger.warning(f"Ignored the metadata of {file_path}, its sidecar isn't a JSON object.")
+        return {}, raw
+    return metadata, raw
+
+
+def document_fields(document: TextDocument) -> dict:
+    """Metadata fields indexed with every passage of a document, see `IndexProfile.mappings`."""
+    fields = {
+        "source_path": document.path,
+        "directory": os.path.dirname(document.name).replace(os.sep, "/"),
+        "file_size": document.size,
+        "modified_at": datetime.fromtimestamp(document.mtime_ns / 1e9, timezone.utc).isoformat(
+            timespec="seconds"
+        ),
+    }
+    if document.metadata:
+        fields["metadata"] = document.metadata
+    return fields
+
+
+def read_document(data_path: str, file_path: str, stat: os.stat_result = None) -> TextDocument:
+    """Read a text file of the corpus.
+
+    Args:
+        data_path (str): the root folder of the corpus.
+        file_path (str): path of the file to read.
+        stat (os.stat_result): stat of the file if it is already known.
+    """
+    stat = stat or os.stat(file_path)
+    relative_path = os.path.relpath(file_path, data_path)
+    with open(file_path, "r") as file:
+        content = file.read()
+    metadata, raw_metadata = read_sidecar(file_path)
+    return TextDocument(
+        doc_id=document_id(relative_path),
+        name=relative_path,
+        path=file_path,
+        content=content,
+        mtime_ns=stat.st_mtime_ns,
+        size=stat.st_size,
+        # A changed sidecar changes the indexed document too.
+        content_hash=content_hash(content + "\0" + raw_metadata if raw_metadata else content),
+        metadata=metadata,
+        signature=file_signature(file_path, stat),
+    )
+
+
+def read_text_files(
+    data_path: str, chunk_size: int = constants.READ_CHUNK_SIZE
+) -> Iterator[List[TextDocument]]:
+    """Read the text files of a folder tree in chunks.
+
+    Args:
+        data_path (str): the root folder of the corpus.
+        chunk_size (int): number of files read per chunk.
+
+    Yields:
+        lists of at most `chunk_size` documents.
+    """
+    for chunk in batched(scan_text_files(data_path), chunk_size):
+        yield [read_document(data_path, file_path) for file_path in chunk]
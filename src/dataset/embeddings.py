@@ -1,49 +1,307 @@
 import argparse
-import os
 import textwrap
+import time
 import traceback
+from collections import deque
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, Optional, Union
 
 import argcomplete
-from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
 
+from src.dataset.bucketing import LengthBucketedEncoder
+from src.dataset.cache import EmbeddingCache
+from src.dataset.chunking import STRATEGIES, Chunker
+from src.dataset.corpus import document_fields, passage_id, read_text_files
+from src.dataset.encoder_pool import EncoderPool
+from src.dataset.manifest import Manifest
+from src.dataset.pipeline import run_pipeline
+from src.dataset.profiles import IndexProfile, bulk_load, index_profile
+from src.dataset.projection import Projection, index_projection
+from src.dataset.vector_store import BACKENDS, VectorStore, as_vector_store, open_store
 from src.utils import constants
 from src.utils.logging import getLogger
+from src.utils.metrics import SnapshotWriter, metrics, timed_iter, timer
+from src.utils.registry import get_model
+from src.utils.utils import batched, l2_normalize
+
+if TYPE_CHECKING:
+    from elasticsearch import Elasticsearch
+    from sentence_transformers import SentenceTransformer
 
 # Instantiate the logger
 logger = getLogger(__name__)
+# Logs once per chunk or document, kept from flooding the handlers.
+document_logger = getLogger(__name__, rate_limit=constants.LOG_RATE_LIMIT)
 
 
 def local_text_embedding(
-    client: Elasticsearch,
+    client: Union["Elasticsearch", VectorStore],
     index_name: str,
     data_path: str,
-    model: SentenceTransformer = SentenceTransformer(constants.MAIN_EMBEDDING),
+    model: Optional["SentenceTransformer"] = None,
+    read_chunk_size: int = constants.READ_CHUNK_SIZE,
+    batch_size: int = constants.ENCODE_BATCH_SIZE,
+    max_tokens: Optional[int] = constants.ENCODE_MAX_TOKENS,
+    bulk_chunk_size: int = constants.BULK_CHUNK_SIZE,
+    bulk_max_bytes: int = constants.BULK_MAX_BYTES,
+    queue_size: int = constants.PIPELINE_QUEUE_SIZE,
+    cache: Optional[EmbeddingCache] = None,
+    manifest: Optional[Manifest] = None,
+    chunk_strategy: str = constants.CHUNK_STRATEGY,
+    chunk_size: Optional[int] = None,
+    chunk_overlap: Optional[int] = None,
+    bulk_inflight: int = constants.BULK_INFLIGHT,
+    profile: Optional[IndexProfile] = None,
+    projection: Optional[Projection] = None,
 ):
-    """Read text files and embed them in the ES.
+    """Read text files and embed them in the ES, or in another vector store.
+
+    The folder tree is walked lazily and ingestion runs as a pipeline of
+    three stages connected by bounded queues: a reader thread that reads
+    files in chunks, the encoder that encodes each chunk with a single
+    batched `model.encode` call, and a shipper thread that sends the
+    documents through the `_bulk` API.
+
+    Each document is split into passages that are embedded and indexed
+    separately, and carry the id and the file metadata of their parent
+    document, see `document_fields`.  Ids are derived
+    from the document path, so re-running the ingestion overwrites documents
+    instead of duplicating them.
 
     Args:
-        client (Elasticsearch): elasticsearch client
+        client (Elasticsearch): elasticsearch client, or the `VectorStore` to index into.
         index_name (str): index name defined in the elasticsearch
         data_path (str): the path for the folder containing the text file.
+        model (SentenceTransformer): the model, or an `EncoderPool`, encoding
+            the passages; the shared model by default.
+        read_chunk_size (int): number of files read and encoded together.
+        batch_size (int): batch size of the model forward pass, without `max_tokens`.
+        max_tokens (int): token budget of a forward pass, padding included;
+            passages are then batched by similar length instead of
+            `batch_size` at a time in reading order, see `LengthBucketedEncoder`.
+        bulk_chunk_size (int): maximum number of documents per bulk request.
+        bulk_max_bytes (int): maximum payload size in bytes per bulk request.
+        queue_size (int): maximum number of chunks waiting between two stages.
+        cache (EmbeddingCache): optional embedding cache, only the texts it
+            doesn't hold yet are encoded.
+        manifest (Manifest): optional manifest of a previous run; if given,
+            only new or changed files are embedded and the documents of
+            deleted files are removed from the index.
+        chunk_strategy (str): how documents are split into passages, see `Chunker`.
+        chunk_size (int): sentences or tokens per passage.
+        chunk_overlap (int): sentences or tokens shared by consecutive passages.
+        bulk_inflight (int): number of bulk requests sent concurrently.
+        profile (IndexProfile): profile of the index, vectors are normalized
+            to unit length if it compares them by dot product.
+        projection (Projection): projection of the vectors to the dimensions
+            of the index, applied to every encoded chunk at once.
+
+    Returns:
+        number of documents indexed.
     """
+    store = as_vector_store(client)
+    if model is None:
+        model = get_model()
     logger.info(f"Loaded sentence transformer {constants.MAIN_EMBEDDING} with default embedding")
     logger.info(f"Embedding dimensions : {model.get_sentence_embedding_dimension()}")
-    for i, filename in enumerate(os.listdir(data_path)):
-        # Check if the file is a text file
-        if filename.endswith(".txt"):
-            file_path = os.path.join(data_path, filename)
-            with open(file_path, "r") as file:
-                content = file.read()
-                # Parse the file content here
-                logger.debug(f"Embedding {filename}:")
-                doc = {
-                    "sentence_text": content,
-                    "document_name": f"Document {i}",
-                    "sentence_embedding": model.encode(content),
-                }
-
-                client.index(index=index_name, document=doc)
+    if projection is not None:
+        logger.info(f"Vectors are indexed through {projection}")
+    bucketed = None
+    if max_tokens:
+        bucketed = model = LengthBucketedEncoder(model, max_tokens=max_tokens)
+
+    if manifest is not None:
+        manifest.begin_sync()
+        source = batched(manifest.changed_files(data_path), read_chunk_size)
+    else:
+        source = read_text_files(data_path, chunk_size=read_chunk_size)
+
+    chunker = Chunker(chunk_strategy, tokenizer=model.tokenizer, chunk_size=chunk_size, overlap=chunk_overlap)
+    if chunk_strategy in ("tokens", "max_tokens") and chunker.chunk_size > model.max_seq_length - 2:
+        logger.warning(
+            f"Passages of {chunker.chunk_size} tokens will be truncated to the {model.max_seq_length} "
+            "tokens of the model."
+        )
+
+    def encode(chunk):
+        passages = []
+        with timer("chunk"):
+            for document in chunk:
+                document_passages = chunker.split(document.content)
+                document.chunks = len(document_passages)
+                passages.extend((document, i, passage) for i, passage in enumerate(document_passages))
+        texts = [passage for _, _, passage in passages]
+        document_logger.debug(f"Embedding {len(texts)} passages of {len(chunk)} documents.")
+        with timer("encode"):
+            if cache is not None:
+                embeddings = cache.encode(texts, lambda misses: model.encode(misses, batch_size=batch_size))
+            else:
+                embeddings = model.encode(texts, batch_size=batch_size)
+        if projection is not None:
+            with timer("project"):
+                embeddings = projection.apply(embeddings)
+        if profile is not None and profile.normalize:
+            embeddings = l2_normalize(embeddings)
+
+        actions = []
+        fields = {}
+        for (document, i, passage), embedding in zip(passages, embeddings):
+            if i == 0:
+                fields = document_fields(document)
+            action = {
+                "_index": index_name,
+                "_id": passage_id(document.doc_id, i),
+                "_source": {
+                    "sentence_text": passage,
+                    "document_name": document.name,
+                    "parent_id": document.doc_id,
+                    "chunk_index": i,
+                    "sentence_embedding": embedding,
+                    **fields,
+                },
+            }
+            actions.append((document, action))
+            if i == document.chunks - 1 and manifest is not None:
+                # Remove the extra passages of a longer previous version.
+                for stale in range(document.chunks, manifest.indexed_chunks(document)):
+                    stale_id = passage_id(document.doc_id, stale)
+                    actions.append((document, {"_op_type": "delete", "_index": index_name, "_id": stale_id}))
+        return actions
+
+    def ship(encoded_chunks):
+        indexed, failed = 0, 0
+        # The bulk helpers report the results in the order of the actions, and
+        # the actions of a document are contiguous.
+        in_flight, done = deque(), []
+        failed_ids = set()
+        # Time spent waiting for the encoder, taken out of the bulk timings.
+        waited_ns = [0]
+
+        def actions():
+            chunks = iter(encoded_chunks)
+            while True:
+                start_ns = time.perf_counter_ns()
+                chunk = next(chunks, None)
+                waited_ns[0] += time.perf_counter_ns() - start_ns
+                if chunk is None:
+                    return
+                for j, (document, action) in enumerate(chunk):
+                    is_last = j == len(chunk) - 1 or chunk[j + 1][0] is not document
+                    in_flight.append((document, is_last, j == len(chunk) - 1))
+                    yield action
+
+        mark_ns, waited_at_mark = time.perf_counter_ns(), 0
+        for ok, info in store.bulk(
+            actions(), chunk_size=bulk_chunk_size, max_chunk_bytes=bulk_max_bytes, inflight=bulk_inflight
+        ):
+            document, is_last, chunk_done = in_flight.popleft()
+            if chunk_done:
+                # Time to send a read chunk, as the results come back in order.
+                now_ns = time.perf_counter_ns()
+                metrics.observe("bulk", (now_ns - mark_ns - (waited_ns[0] - waited_at_mark)) / 1e9)
+                mark_ns, waited_at_mark = now_ns, waited_ns[0]
+            # A stale passage that is already gone is as good as deleted.
+            if not ok and info.get("delete", {}).get("status") != 404:
+                failed_ids.add(document.doc_id)
+                document_logger.error(f"Could not index document {document.name}: {info}")
+            if not is_last:
+                continue
+            if document.doc_id in failed_ids:
+                failed_ids.discard(document.doc_id)
+                failed += 1
+            else:
+                indexed += 1
+                done.append(document)
+            if manifest is not None and len(done) >= bulk_chunk_size:
+                manifest.record(done)
+                done = []
+        if manifest is not None:
+            manifest.record(done)
+        return indexed, failed
+
+    start = time.perf_counter()
+    indexed, failed = run_pipeline(
+        timed_iter(source, "read"), encode=encode, ship=ship, queue_size=queue_size
+    )
+    deleted = 0
+    if manifest is not None:
+        deleted = delete_removed_documents(
+            store, index_name, manifest, bulk_chunk_size=bulk_chunk_size, bulk_inflight=bulk_inflight
+        )
+    # The index must be persisted before the manifest records what it holds.
+    store.flush()
+    if manifest is not None:
+        manifest.commit()
+        logger.info(
+            f"Sync found {manifest.changed} new or changed and {manifest.unchanged} unchanged files, "
+            f"deleted {deleted} documents."
+        )
+    if indexed or failed or deleted:
+        # Drops the search results cached before this ingestion.
+        try:
+            store.bump_generation(index_name)
+        except Exception as e:
+            logger.warning(
+                f"Could not record the ingestion into {index_name}, cached results may be stale: {e}"
+            )
+    elapsed = time.perf_counter() - start
+
+    if cache is not None:
+        cache.flush()
+        logger.info(f"Embedding cache stats: {cache.stats()}")
+    if bucketed is not None:
+        logger.info(f"Encode batching stats: {bucketed.stats()}")
+    if metrics.enabled:
+        logger.info(f"Stage timings: {metrics.summary()}")
+    logger.info(
+        f"Indexed {indexed} documents ({failed} failed) in {elapsed:.2f}s "
+        f"({indexed / elapsed if elapsed > 0 else 0.0:.1f} docs/sec)."
+    )
+    return indexed
+
+
+def delete_removed_documents(
+    client: Union["Elasticsearch", VectorStore],
+    index_name: str,
+    manifest: Manifest,
+    bulk_chunk_size: int = constants.BULK_CHUNK_SIZE,
+    bulk_inflight: int = constants.BULK_INFLIGHT,
+) -> int:
+    """Delete the documents of the files that disappeared since the last sync.
+
+    Args:
+        client (Elasticsearch): elasticsearch client, or the `VectorStore` of the index.
+        index_name (str): index name defined in the elasticsearch
+        manifest (Manifest): manifest of the current sync.
+        bulk_chunk_size (int): maximum number of documents per bulk request.
+        bulk_inflight (int): number of bulk requests sent concurrently.
+
+    Returns:
+        number of documents deleted.
+    """
+    deleted_files = manifest.deleted_files()
+    removed, failed_paths = [], set()
+    # (path, is_last) of the delete actions, in the order of the results.
+    in_flight = deque()
+
+    def actions():
+        for path, doc_id, chunks in deleted_files:
+            for i in range(chunks):
+                in_flight.append((path, i == chunks - 1))
+                yield {"_op_type": "delete", "_index": index_name, "_id": passage_id(doc_id, i)}
+
+    for ok, info in as_vector_store(client).bulk(
+        actions(), chunk_size=bulk_chunk_size, inflight=bulk_inflight
+    ):
+        path, is_last = in_flight.popleft()
+        # A document that is already gone is as good as deleted.
+        if not ok and info.get("delete", {}).get("status") != 404:
+            failed_paths.add(path)
+            document_logger.error(f"Could not delete document {path}: {info}")
+        if is_last and path not in failed_paths:
+            removed.append(path)
+    manifest.remove(removed)
+    return len(removed)
 
 
 if __name__ == "__main__":
@@ -58,34 +316,220 @@ if __name__ == "__main__":
 
         --data_path="/data/sample_data"
         --index_name="es0"
+        --read_chunk_size=256
+        --batch_size=32
+        --max_tokens=8192
+        --bulk_chunk_size=500
+        --bulk_max_bytes=104857600
+        --queue_size=4
+        --bulk_inflight=1
+        --cache_dir=".cache/embeddings"
+        --cache_max_entries=10000000
+        --cache_dtype="float32"
+        --sync
+        --manifest_path=".cache/manifests/es0.sqlite"
+        --chunk_strategy="max_tokens"
+        --chunk_size=256
+        --chunk_overlap=32
+        --workers=0
+        --threads_per_worker=1
+        --backend="elasticsearch"
+        --faiss_dir=".cache/faiss"
+        --metrics_path=".cache/metrics/embeddings.jsonl"
+        --metrics_interval=10
 
         Example Usage
         -------------
         python %(prog)s
         python %(prog)s --data_path=/data/sample_data --index_name=es0
+        python %(prog)s --data_path=/data/sample_data --index_name=es0 --batch_size 64 --bulk_chunk_size 1000
+        python %(prog)s --data_path=/data/sample_data --index_name=es0 --bulk_inflight 4
+        python %(prog)s --data_path=/data/sample_data --index_name=es0 --max_tokens 0 --batch_size 64
+        python %(prog)s --data_path=/data/sample_data --index_name=es0 --workers 8 --threads_per_worker 4
+        python %(prog)s --data_path=/data/sample_data --index_name=es0 --backend faiss
+        python %(prog)s --data_path=/data/sample_data --index_name=es0 --metrics_path .cache/metrics.jsonl
 
         '''
         ),
     )
     parser.add_argument('--data_path', help='data path that contains documents.', type=str)
     parser.add_argument('--index_name', help='elasticsearch defined index.', type=str)
+    parser.add_argument(
+        '--read_chunk_size',
+        help='number of files read and encoded together.',
+        type=int,
+        default=constants.READ_CHUNK_SIZE,
+    )
+    parser.add_argument(
+        '--batch_size',
+        help='batch size of the model encoding.',
+        type=int,
+        default=constants.ENCODE_BATCH_SIZE,
+    )
+    parser.add_argument(
+        '--max_tokens',
+        help='token budget of an encode batch, padding included; 0 encodes --batch_size passages at a time.',
+        type=int,
+        default=constants.ENCODE_MAX_TOKENS,
+    )
+    parser.add_argument(
+        '--bulk_chunk_size',
+        help='maximum number of documents per bulk request.',
+        type=int,
+        default=constants.BULK_CHUNK_SIZE,
+    )
+    parser.add_argument(
+        '--bulk_max_bytes',
+        help='maximum bulk request payload size in bytes.',
+        type=int,
+        default=constants.BULK_MAX_BYTES,
+    )
+    parser.add_argument(
+        '--queue_size',
+        help='maximum number of chunks waiting between two pipeline stages.',
+        type=int,
+        default=constants.PIPELINE_QUEUE_SIZE,
+    )
+    parser.add_argument(
+        '--bulk_inflight',
+        help='number of bulk requests sent concurrently.',
+        type=int,
+        default=constants.BULK_INFLIGHT,
+    )
+    parser.add_argument('--cache_dir', help='embedding cache folder, no cache if not given.', type=str)
+    parser.add_argument(
+        '--cache_max_entries',
+        help='maximum number of vectors kept in the embedding cache.',
+        type=int,
+        default=constants.EMBEDDING_CACHE_MAX_ENTRIES,
+    )
+    parser.add_argument(
+        '--cache_dtype',
+        help='storage type of the cached vectors.',
+        choices=['float32', 'float16'],
+        default=constants.EMBEDDING_CACHE_DTYPE,
+    )
+    parser.add_argument(
+        '--sync',
+        help='only embed new or changed files and delete the removed ones.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--manifest_path',
+        help='manifest of the indexed files used by --sync, defaults to one per index.',
+        type=str,
+    )
+    parser.add_argument(
+        '--chunk_strategy',
+        help='how documents are split into passages; change it only on a fresh index.',
+        choices=STRATEGIES,
+        default=constants.CHUNK_STRATEGY,
+    )
+    parser.add_argument('--chunk_size', help='sentences or tokens per passage.', type=int)
+    parser.add_argument(
+        '--chunk_overlap', help='sentences or tokens shared by consecutive passages.', type=int
+    )
+    parser.add_argument(
+        '--workers',
+        help='number of encoder worker processes, 0 encodes in the main process.',
+        type=int,
+        default=constants.ENCODER_WORKERS,
+    )
+    parser.add_argument(
+        '--threads_per_worker',
+        help='torch threads of every encoder worker.',
+        type=int,
+        default=constants.THREADS_PER_WORKER,
+    )
+    parser.add_argument(
+        '--backend',
+        help='where the passages are indexed.',
+        choices=BACKENDS,
+        default=constants.VECTOR_BACKEND,
+    )
+    parser.add_argument('--faiss_dir', help='folder of the faiss indices.', type=str)
+    parser.add_argument(
+        '--metrics_path', help='JSON lines file the stage timings are appended to periodically.', type=str
+    )
+    parser.add_argument(
+        '--metrics_interval',
+        help='seconds between two stage timing snapshots.',
+        type=float,
+        default=constants.METRICS_INTERVAL,
+    )
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
 
-    logger.info('Started invoking elasticsearch client.')
-    # Create the client instance
-    client = Elasticsearch(
-        hosts=constants.ES_URL,
-        ca_certs=constants.ES_CA_CERTS,
-        basic_auth=(constants.ES_USER, constants.ES_PASSWORD),
-    )
+    logger.info(f'Opening the {args.backend} vector store.')
+    store = open_store(args.backend, faiss_dir=args.faiss_dir)
     # Get cluster information
-    logger.info(client.info())
+    logger.info(store.info())
+    profile = None
+    if args.backend == "elasticsearch":
+        profile = index_profile(store.client, args.index_name)
+        logger.info(f"Index {args.index_name} profile: {profile}")
+    projection = index_projection(store, args.index_name, profile)
+
+    cache = None
+    if args.cache_dir:
+        cache = EmbeddingCache(
+            args.cache_dir,
+            constants.MAIN_EMBEDDING,
+            max_entries=args.cache_max_entries,
+            dtype=args.cache_dtype,
+        )
+
+    manifest = None
+    if args.sync:
+        manifest = Manifest(args.manifest_path or constants.MANIFEST_DIR / f"{args.index_name}.sqlite")
+
+    pool = None
+    if args.workers > 0:
+        pool = EncoderPool(
+            constants.MAIN_EMBEDDING, workers=args.workers, threads_per_worker=args.threads_per_worker
+        )
+    # Without a pool, local_text_embedding uses its in-process model.
+    encoder = {"model": pool} if pool is not None else {}
+
+    snapshots = SnapshotWriter(args.metrics_path, args.metrics_interval) if args.metrics_path else None
 
     # Run embedding
     try:
         logger.info("Running embeddings.")
-        local_text_embedding(client=client, index_name=args.index_name, data_path=args.data_path)
+        loading = bulk_load(store.client, args.index_name, profile) if profile is not None else nullcontext()
+        with loading:
+            local_text_embedding(
+                client=store,
+                index_name=args.index_name,
+                data_path=args.data_path,
+                read_chunk_size=args.read_chunk_size,
+                batch_size=args.batch_size,
+                max_tokens=args.max_tokens,
+                bulk_chunk_size=args.bulk_chunk_size,
+                bulk_max_bytes=args.bulk_max_bytes,
+                queue_size=args.queue_size,
+                bulk_inflight=args.bulk_inflight,
+                cache=cache,
+                manifest=manifest,
+                chunk_strategy=args.chunk_strategy,
+                chunk_size=args.chunk_size,
+                chunk_overlap=args.chunk_overlap,
+                profile=profile,
+                projection=projection,
+                **encoder,
+            )
+        if pool is not None:
+            pool.log_stats()
     except Exception as e:
         logger.error(f"Could not perform the embedding due to error {e}")
         print(traceback.format_exc())
+    finally:
+        if cache is not None:
+            cache.close()
+        if manifest is not None:
+            manifest.close()
+        if pool is not None:
+            pool.close()
+        if snapshots is not None:
+            snapshots.close()
+        store.close()
@@ -0,0 +1,217 @@
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+import traceback
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from src.utils import constants
+from src.utils.logging import getLogger
+from src.utils.registry import load_tokenizer
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+
+def _pin_worker(worker_id: int, threads: int):
+    """Restrict a worker to its own cores and thread count so workers don't oversubscribe the CPU."""
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(threads)
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        first = (worker_id * threads) % len(cores)
+        os.sched_setaffinity(0, {cores[(first + i) % len(cores)] for i in range(threads)})
+
+
+def _encode_worker(
+    worker_id: int, model_name: str, backend: str, threads: int, tasks: mp.Queue, results: mp.Queue
+):
+    """Worker process: loads its own model and encodes the batches it pulls from `tasks`."""
+    # The thread settings must be in place before torch is imported.
+    _pin_worker(worker_id, threads)
+    import torch
+
+    from src.dataset.encoders import load_encoder
+
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    try:
+        model = load_encoder(backend, model_name, threads=threads, device="cpu")
+    except Exception:
+        results.put(("error", None, worker_id, traceback.format_exc()))
+        return
+    results.put(("ready", None, worker_id, (model.get_sentence_embedding_dimension(), model.max_seq_length)))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, texts, batch_size, kwargs = task
+        start = time.perf_counter()
+        try:
+            embeddings = model.encode(texts, batch_size=batch_size, **kwargs)
+            results.put(("done", task_id, worker_id, (embeddings, time.perf_counter() - start)))
+        except Exception:
+            results.put(("error", task_id, worker_id, traceback.format_exc()))
+
+
+class EncoderPool:
+    """Encode texts with a pool of CPU worker processes.
+
+    Each worker loads its own copy of the model, is pinned to its own cores
+    and limited to `threads_per_worker` torch threads.  `encode` shards the
+    texts into batches, workers pull them from a shared queue and the vectors
+    are gathered back in order.  The pool can be used in place of a
+    `SentenceTransformer` by `local_text_embedding`.
+
+    Example:
+        pool = EncoderPool(constants.MAIN_EMBEDDING, workers=8, threads_per_worker=4)
+        embeddings = pool.encode(texts, batch_size=32)
+        pool.log_stats()
+        pool.close()
+    """
+
+    def __init__(
+        self,
+        model_name: str = constants.MAIN_EMBEDDING,
+        workers: Optional[int] = None,
+        threads_per_worker: int = constants.THREADS_PER_WORKER,
+        backend: str = constants.ENCODER_BACKEND,
+    ):
+        """Start the workers and wait until their models are loaded.
+
+        Args:
+            model_name (str): the sentence transformer to load in every worker.
+            workers (int): number of worker processes, defaults to one per
+                `threads_per_worker` cores.
+            threads_per_worker (int): torch threads of every worker.
+            backend (str): encoder backend of the workers, see `load_encoder`.
+        """
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        self.workers = workers or max(1, cores // threads_per_worker)
+        self.threads_per_worker = threads_per_worker
+        self.model_name = model_name
+        self.tokenizer = load_tokenizer(model_name)
+        self._lock = threading.Lock()
+        self._next_task = 0
+        self._stats: Dict[int, List[float]] = {worker_id: [0, 0.0] for worker_id in range(self.workers)}
+
+        if backend in ("onnx", "onnx_int8"):
+            # Exported once here rather than by every worker.
+            from src.dataset.encoders import export_onnx
+
+            export_onnx(model_name, quantize=backend == "onnx_int8")
+
+        context = mp.get_context("spawn")
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._processes = [
+            context.Process(
+                target=_encode_worker,
+                args=(worker_id, model_name, backend, threads_per_worker, self._tasks, self._results),
+                name=f"encoder-{worker_id}",
+                daemon=True,
+            )
+            for worker_id in range(self.workers)
+        ]
+        for process in self._processes:
+            process.start()
+
+        for _ in range(self.workers):
+            status, _, worker_id, payload = self._get_result()
+            if status == "error":
+                self.close()
+                raise RuntimeError(f"Encoder worker {worker_id} could not load {model_name}:\n{payload}")
+            self._dims, self.max_seq_length = payload
+        logger.info(
+            f"Started {self.workers} encoder workers with {threads_per_worker} threads each for {model_name}."
+        )
+
+    def _get_result(self):
+        """Wait for the next result, failing if a worker died."""
+        while True:
+            try:
+                return self._results.get(timeout=1)
+            except queue.Empty:
+                dead = [process.name for process in self._processes if not process.is_alive()]
+                if dead:
+                    raise RuntimeError(f"Encoder workers {dead} exited unexpectedly")
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dims
+
+    def _run(self, batches: List[List[str]], kwargs: dict) -> List[np.ndarray]:
+        """Encode every batch as one worker task and gather the vectors of each batch."""
+        with self._lock:
+            task_ids = []
+            for batch in batches:
+                task_ids.append(self._next_task)
+                self._tasks.put((self._next_task, batch, len(batch), kwargs))
+                self._next_task += 1
+
+            embeddings = {}
+            pending = set(task_ids)
+            while pending:
+                status, task_id, worker_id, payload = self._get_result()
+                if task_id not in pending:
+                    # Left over from a call that failed.
+                    continue
+                pending.discard(task_id)
+                if status == "error":
+                    raise RuntimeError(f"Encoder worker {worker_id} failed:\n{payload}")
+                embeddings[task_id], elapsed = payload
+                self._stats[worker_id][0] += len(embeddings[task_id])
+                self._stats[worker_id][1] += elapsed
+        return [embeddings[task_id] for task_id in task_ids]
+
+    def encode(self, texts, batch_size: int = constants.ENCODE_BATCH_SIZE, **kwargs) -> np.ndarray:
+        """Encode texts across the workers; same interface as `SentenceTransformer.encode`.
+
+        Args:
+            texts: a text or a list of texts.
+            batch_size (int): texts per worker task and per forward pass.
+        """
+        if isinstance(texts, str):
+            return self.encode([texts], batch_size=batch_size, **kwargs)[0]
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self._dims), dtype=np.float32)
+        batches = [texts[start : start + batch_size] for start in range(0, len(texts), batch_size)]
+        return np.concatenate(self._run(batches, kwargs))
+
+    def encode_batches(self, batches: List[List[str]], **kwargs) -> List[np.ndarray]:
+        """Encode batches already formed by the caller, each in a single forward pass.
+
+        Used by `LengthBucketedEncoder`, the batches are spread over the workers.
+        """
+        return self._run([list(batch) for batch in batches], kwargs)
+
+    def stats(self) -> Dict[int, Dict[str, float]]:
+        """Texts encoded, busy seconds and throughput of every worker."""
+        return {
+            worker_id: {
+                "texts": texts,
+                "seconds": seconds,
+                "texts_per_sec": texts / seconds if seconds > 0 else 0.0,
+            }
+            for worker_id, (texts, seconds) in self._stats.items()
+        }
+
+    def log_stats(self):
+        for worker_id, stats in self.stats().items():
+            logger.info(
+                f"Encoder worker {worker_id}: {stats['texts']} texts in {stats['seconds']:.2f}s "
+                f"({stats['texts_per_sec']:.1f} texts/sec)."
+            )
+
+    def close(self):
+        """Stop the workers."""
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,348 @@
+import argparse
+import json
+import textwrap
+import time
+from itertools import islice
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import argcomplete
+import numpy as np
+
+from src.utils import constants
+from src.utils.logging import getLogger
+from src.utils.registry import load_model
+from src.utils.utils import l2_normalize
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+# "torch" is the sentence-transformers model, "int8" the same model with its
+# linear layers dynamically quantized to int8, "onnx" an exported graph run by
+# ONNX Runtime and "onnx_int8" that graph with int8 weights.
+ENCODER_BACKENDS = ("torch", "int8", "onnx", "onnx_int8")
+POOLING_MODES = ("cls", "mean", "max")
+
+
+def onnx_dir(model_name: str = constants.MAIN_EMBEDDING) -> Path:
+    """Folder of the exported graph of a model."""
+    return Path(constants.ONNX_DIR) / model_name.replace("/", "__")
+
+
+def export_onnx(
+    model_name: str = constants.MAIN_EMBEDDING, output_dir: Optional[str] = None, quantize: bool = False
+):
+    """Export the transformer of a sentence-transformers model to ONNX.
+
+    The graph outputs the token embeddings; pooling and normalization are
+    read from the model and saved in `encoder.json` next to it, with the
+    tokenizer, so `OnnxEncoder` doesn't need torch.  Existing files are kept.
+
+    Args:
+        model_name (str): the sentence transformer to export.
+        output_dir (str): where the graph is written, see `onnx_dir`.
+        quantize (bool): also write a copy of the graph with its weights
+            dynamically quantized to int8.
+
+    Returns:
+        the output folder.
+    """
+    output_dir = Path(output_dir) if output_dir else onnx_dir(model_name)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if not (output_dir / "model.onnx").exists():
+        import torch
+        from sentence_transformers import models
+
+        model = load_model(model_name, device="cpu")
+        transformer, pooling = model[0], model[1]
+        if not isinstance(transformer, models.Transformer) or not isinstance(pooling, models.Pooling):
+            raise ValueError(f"{model_name} doesn't start with a transformer and a pooling layer")
+        extra = [module for module in list(model)[2:] if not isinstance(module, models.Normalize)]
+        if extra:
+            raise ValueError(
+                f"Can't export the {[type(module).__name__ for module in extra]} layers of {model_name}"
+            )
+        pooling_mode = pooling.get_pooling_mode_str()
+        if pooling_mode not in POOLING_MODES:
+            raise ValueError(f"Unsupported pooling {pooling_mode}, expected one of {POOLING_MODES}")
+
+        auto_model = transformer.auto_model.eval()
+        sample = transformer.tokenizer(["an example sentence"], return_tensors="pt")
+        input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+
+        class TokenEmbeddings(torch.nn.Module):
+            def forward(self, *inputs):
+                return auto_model(**dict(zip(input_names, inputs)))[0]
+
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in [*input_names, "token_embeddings"]}
+        with torch.no_grad():
+            torch.onnx.export(
+                TokenEmbeddings(),
+                tuple(sample[name] for name in input_names),
+                str(output_dir / "model.onnx"),
+                input_names=input_names,
+                output_names=["token_embeddings"],
+                dynamic_axes=dynamic_axes,
+                opset_version=constants.ONNX_OPSET,
+            )
+        transformer.tokenizer.save_pretrained(str(output_dir))
+        config = {
+            "model_name": model_name,
+            "input_names": input_names,
+            "pooling": pooling_mode,
+            "normalize": len(model) > 2,
+            "max_seq_length": model.max_seq_length,
+            "dims": model.get_sentence_embedding_dimension(),
+        }
+        (output_dir / "encoder.json").write_text(json.dumps(config, indent=2))
+        logger.info(f"Exported {model_name} to {output_dir / 'model.onnx'}.")
+
+    if quantize and not (output_dir / "model_int8.onnx").exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(
+            str(output_dir / "model.onnx"), str(output_dir / "model_int8.onnx"), weight_type=QuantType.QInt8
+        )
+        logger.info(f"Quantized {output_dir / 'model.onnx'} to int8.")
+    return output_dir
+
+
+class OnnxEncoder:
+    """Encode texts with a graph exported by `export_onnx`, on ONNX Runtime.
+
+    It exposes `encode`, `tokenizer`, `max_seq_length` and
+    `get_sentence_embedding_dimension` like `SentenceTransformer`, so it can
+    be used wherever the model is.
+
+    Example:
+        encoder = OnnxEncoder(export_onnx(constants.MAIN_EMBEDDING, quantize=True), quantized=True)
+        embeddings = encoder.encode(texts, batch_size=32)
+    """
+
+    def __init__(self, model_dir: str, quantized: bool = False, threads: Optional[int] = None):
+        """
+        Args:
+            model_dir (str): folder written by `export_onnx`.
+            quantized (bool): run the int8 graph instead of the float32 one.
+            threads (int): ONNX Runtime intra-op threads, all cores if not given.
+        """
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_dir = Path(model_dir)
+        config = json.loads((model_dir / "encoder.json").read_text())
+        self.model_name = config["model_name"]
+        self.input_names = config["input_names"]
+        self.pooling = config["pooling"]
+        self.normalize = config["normalize"]
+        self.max_seq_length = config["max_seq_length"]
+        self._dims = config["dims"]
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        graph = model_dir / ("model_int8.onnx" if quantized else "model.onnx")
+        self.session = ort.InferenceSession(str(graph), options, providers=["CPUExecutionProvider"])
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dims
+
+    def _pool(self, tokens: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        if self.pooling == "cls":
+            return tokens[:, 0]
+        mask = attention_mask[..., None].astype(np.float32)
+        if self.pooling == "max":
+            return np.where(mask > 0, tokens, -1e9).max(axis=1)
+        return (tokens * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+    def encode(
+        self,
+        texts,
+        batch_size: int = constants.ENCODE_BATCH_SIZE,
+        normalize_embeddings: bool = False,
+        **kwargs,
+    ) -> np.ndarray:
+        """Encode a text or a list of texts; other `SentenceTransformer.encode` arguments are ignored."""
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(
+                texts[start : start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np",
+            )
+            feeds = {name: inputs[name].astype(np.int64) for name in self.input_names}
+            tokens = self.session.run(None, feeds)[0]
+            batches.append(self._pool(tokens, inputs["attention_mask"]))
+        if not batches:
+            return np.zeros((0, self._dims), dtype=np.float32)
+        embeddings = np.concatenate(batches).astype(np.float32)
+        if self.normalize or normalize_embeddings:
+            embeddings = l2_normalize(embeddings)
+        return embeddings[0] if single else embeddings
+
+
+def load_encoder(
+    backend: str = constants.ENCODER_BACKEND,
+    model_name: str = constants.MAIN_EMBEDDING,
+    threads: Optional[int] = None,
+    device: Optional[str] = None,
+):
+    """Load the model on one of the `ENCODER_BACKENDS`, exporting its ONNX graph on first use.
+
+    Args:
+        backend (str): one of `ENCODER_BACKENDS`.
+        model_name (str): the sentence transformer.
+        threads (int): ONNX Runtime intra-op threads; torch threads are set by the caller.
+        device (str): torch device of the "torch" backend, the others run on CPU.
+    """
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend {backend}, expected one of {ENCODER_BACKENDS}")
+    if backend == "torch":
+        return load_model(model_name, device=device)
+    if backend == "int8":
+        import torch
+
+        model = torch.quantization.quantize_dynamic(
+            load_model(model_name, device="cpu"), {torch.nn.Linear}, dtype=torch.qint8
+        )
+        logger.info(f"Quantized the linear layers of {model_name} to int8.")
+        return model
+    quantized = backend == "onnx_int8"
+    return OnnxEncoder(export_onnx(model_name, quantize=quantized), quantized=quantized, threads=threads)
+
+
+def check_agreement(
+    texts: Sequence[str],
+    backends: Sequence[str] = ENCODER_BACKENDS,
+    model_name: str = constants.MAIN_EMBEDDING,
+    batch_size: int = constants.ENCODE_BATCH_SIZE,
+    neighbours: int = 10,
+) -> Dict[str, Dict[str, float]]:
+    """Compare the vectors and speed of encoder backends to the torch baseline.
+
+    Args:
+        texts (Sequence[str]): sample of the texts to embed.
+        backends (Sequence[str]): backends to compare, torch is always run.
+        model_name (str): the sentence transformer.
+        batch_size (int): batch size of the forward passes.
+        neighbours (int): number of nearest neighbours compared.
+
+    Returns:
+        per backend: its throughput and speedup over torch, the mean and
+        minimum cosine similarity of its vectors to the torch ones, and the
+        share of the torch nearest neighbours of every text it finds among
+        the sample.
+    """
+    texts = list(texts)
+    neighbours = min(neighbours, len(texts) - 1)
+
+    def nearest(vectors):
+        similarities = vectors @ vectors.T
+        np.fill_diagonal(similarities, -np.inf)
+        return np.argsort(-similarities, axis=1)[:, :neighbours]
+
+    report, baseline, baseline_seconds, baseline_nearest = {}, None, None, None
+    for backend in ["torch", *[backend for backend in backends if backend != "torch"]]:
+        encoder = load_encoder(backend, model_name)
+        # Warm up, the first batches pay for allocations.
+        encoder.encode(texts[:batch_size], batch_size=batch_size)
+        start = time.perf_counter()
+        vectors = l2_normalize(encoder.encode(texts, batch_size=batch_size))
+        seconds = time.perf_counter() - start
+        del encoder
+        if baseline is None:
+            baseline, baseline_seconds = vectors, seconds
+            baseline_nearest = nearest(vectors) if neighbours > 0 else None
+        cosines = (vectors * baseline).sum(axis=1)
+        report[backend] = {
+            "texts_per_sec": len(texts) / seconds,
+            "speedup": baseline_seconds / seconds,
+            "cosine_mean": float(cosines.mean()),
+            "cosine_min": float(cosines.min()),
+        }
+        if baseline_nearest is not None:
+            found = nearest(vectors)
+            report[backend][f"neighbour_recall@{neighbours}"] = float(
+                np.mean([len(set(a) & set(b)) / neighbours for a, b in zip(found, baseline_nearest)])
+            )
+    return report
+
+
+def sample_texts(data_path: str, limit: int) -> List[str]:
+    """Up to `limit` paragraphs of the text files of a folder."""
+    from src.dataset.corpus import read_text_files
+
+    def paragraphs():
+        for chunk in read_text_files(data_path):
+            for document in chunk:
+                yield from (
+                    paragraph.strip() for paragraph in document.content.split("\n\n") if paragraph.strip()
+                )
+
+    return list(islice(paragraphs(), limit))
+
+
+if __name__ == "__main__":
+
+    # Get the parser arguments
+    parser = argparse.ArgumentParser(
+        description="script to compare the encoder backends.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=textwrap.dedent(
+            ''''
+        Current arguments are:
+
+        --data_path="/data/sample_data"
+        --backends torch int8 onnx onnx_int8
+        --limit=512
+        --batch_size=32
+        --min_cosine=0.99
+
+        Example Usage
+        -------------
+        python %(prog)s --data_path data/sample_data
+        python %(prog)s --data_path data/sample_data --backends onnx_int8 --limit 2000
+
+        '''
+        ),
+    )
+    parser.add_argument('--data_path', help='folder of the sample texts.', type=str, required=True)
+    parser.add_argument(
+        '--backends',
+        help='backends compared to torch.',
+        nargs='+',
+        choices=ENCODER_BACKENDS,
+        default=list(ENCODER_BACKENDS),
+    )
+    parser.add_argument('--limit', help='number of sample texts.', type=int, default=512)
+    parser.add_argument(
+        '--batch_size',
+        help='batch size of the forward passes.',
+        type=int,
+        default=constants.ENCODE_BATCH_SIZE,
+    )
+    parser.add_argument(
+        '--min_cosine',
+        help='minimum cosine similarity to the torch vectors of a usable backend.',
+        type=float,
+        default=constants.ENCODER_MIN_COSINE,
+    )
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+
+    texts = sample_texts(args.data_path, args.limit)
+    logger.info(f"Comparing {args.backends} on {len(texts)} texts of {args.data_path}.")
+    report = check_agreement(texts, backends=args.backends, batch_size=args.batch_size)
+    for backend, stats in report.items():
+        logger.info(f"{backend}: " + ", ".join(f"{name}={value:.4f}" for name, value in stats.items()))
+        if stats["cosine_min"] < args.min_cosine:
+            logger.warning(
+                f"{backend} vectors drift from torch: "
+                f"minimum cosine {stats['cosine_min']:.4f} < {args.min_cosine}"
+            )
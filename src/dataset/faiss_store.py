@@ -0,0 +1,465 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from src.dataset.local_search import knn_search_response
+from src.dataset.vector_store import FAISS_INDEX_TYPES, IndexNotFoundError, VectorStore
+from src.utils import constants
+from src.utils.logging import getLogger
+from src.utils.utils import batched, l2_normalize
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+# Number of ids looked up per sqlite query.
+_LOOKUP_BATCH = 500
+
+
+class _LocalIndex:
+    """A FAISS index of passage vectors and an sqlite table of their `_source`.
+
+    Every indexed passage gets a new integer id.  Passages that are replaced
+    or deleted are dropped from the table, and from the FAISS index when it
+    supports removals; HNSW graphs don't, so their stale vectors stay in the
+    graph and are skipped at search time.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        index_type: str = constants.FAISS_INDEX_TYPE,
+        m: int = constants.FAISS_HNSW_M,
+        ef_construction: int = constants.FAISS_HNSW_EF_CONSTRUCTION,
+        nlist: int = constants.FAISS_NLIST,
+        pq_m: int = constants.FAISS_PQ_M,
+        nprobe: int = constants.FAISS_NPROBE,
+        mmap: bool = False,
+        projection: Optional[str] = None,
+    ):
+        path.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.nprobe = nprobe
+        self.read_only = mmap
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(str(path / "docs.sqlite"), check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, doc_id TEXT UNIQUE, source TEXT)"
+        )
+        stored = {name: json.loads(value) for name, value in self._db.execute("SELECT name, value FROM meta")}
+        # The settings of an existing index win over the given ones.
+        self.params = {
+            "index_type": index_type,
+            "m": m,
+            "ef_construction": ef_construction,
+            "nlist": nlist,
+            "pq_m": pq_m,
+            **stored.get("params", {}),
+        }
+        if self.params["index_type"] not in FAISS_INDEX_TYPES:
+            raise ValueError(
+                f"Unknown faiss index type {self.params['index_type']}, expected one of {FAISS_INDEX_TYPES}"
+            )
+        self._next_id = stored.get("next_id", 0)
+        # Projection file the vectors go through, recorded when the index is created.
+        self.projection = stored.get("projection", projection)
+
+        self.index = None
+        if (path / "index.faiss").exists():
+            flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+            self.index = faiss.read_index(str(path / "index.faiss"), flags)
+        # Vectors of an IVF-PQ index waiting for enough data to train it.
+        self._pending_ids = np.zeros(0, dtype=np.int64)
+        self._pending = None
+        if (path / "pending.npz").exists():
+            pending = np.load(path / "pending.npz")
+            self._pending_ids, self._pending = pending["ids"], pending["vectors"]
+        # Generation of the files loaded above, they are stale once it changes.
+        self.loaded_generation = self.generation
+        self._checked_at = time.monotonic()
+
+    @property
+    def removable(self) -> bool:
+        return self.params["index_type"] != "hnsw"
+
+    def _create(self, dims: int):
+        params = self.params
+        if params["index_type"] == "flat":
+            index = faiss.IndexFlatIP(dims)
+        elif params["index_type"] == "hnsw":
+            index = faiss.IndexHNSWFlat(dims, params["m"], faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = params["ef_construction"]
+        else:
+            quantizer = faiss.IndexFlatIP(dims)
+            index = faiss.IndexIVFPQ(
+                quantizer, dims, params["nlist"], params["pq_m"], 8, faiss.METRIC_INNER_PRODUCT
+            )
+        self.index = faiss.IndexIDMap2(index)
+        logger.info(f"Created a {params['index_type']} faiss index of {dims} dims at {self.path}.")
+
+    @property
+    def _train_size(self) -> int:
+        # k-means wants about 39 points per centroid, PQ codebooks have 256 centroids.
+        return max(self.params["nlist"] * 39, 256)
+
+    def _add(self, ids: np.ndarray, vectors: np.ndarray):
+        if self.index is None:
+            self._create(vectors.shape[1])
+        if self.index.is_trained:
+            self.index.add_with_ids(vectors, ids)
+            return
+        self._pending_ids = np.concatenate([self._pending_ids, ids])
+        self._pending = vectors if self._pending is None else np.concatenate([self._pending, vectors])
+        if len(self._pending_ids) >= self._train_size:
+            self._train()
+
+    def _train(self):
+        logger.info(f"Training the IVF-PQ index at {self.path} on {len(self._pending_ids)} vectors.")
+        self.index.train(self._pending)
+        self.index.add_with_ids(self._pending, self._pending_ids)
+        self._pending_ids, self._pending = np.zeros(0, dtype=np.int64), None
+
+    def _remove(self, ids: List[int]):
+        if not ids:
+            return
+        ids = np.array(ids, dtype=np.int64)
+        if self._pending is not None:
+            keep = ~np.isin(self._pending_ids, ids)
+            self._pending_ids, self._pending = self._pending_ids[keep], self._pending[keep]
+        if self.index is not None and self.index.is_trained and self.removable:
+            self.index.remove_ids(faiss.IDSelectorBatch(ids))
+
+    def current_ids(self, doc_ids: Iterable[str]) -> Dict[str, int]:
+        found = {}
+        for batch in batched(doc_ids, _LOOKUP_BATCH):
+            marks = ",".join("?" * len(batch))
+            found.update(self._db.execute(f"SELECT doc_id, id FROM docs WHERE doc_id IN ({marks})", batch))
+        return found
+
+    def write(self, actions: List[dict]) -> List[Tuple[bool, dict]]:
+        """Apply index and delete actions in order."""
+        if self.read_only:
+            raise RuntimeError(f"The faiss index at {self.path} is memory-mapped read-only")
+        with self._lock:
+            current = self.current_ids(action["_id"] for action in actions if action.get("_id"))
+            results, removed, rows, vectors = [], [], {}, {}
+            for action in actions:
+                op_type = action.get("_op_type", "index")
+                doc_id = action.get("_id") or uuid.uuid4().hex
+                old = current.get(doc_id)
+                if op_type == "delete":
+                    if old is None:
+                        results.append((False, {"delete": {"_id": doc_id, "status": 404}}))
+                        continue
+                    removed.append(old)
+                    current[doc_id] = None
+                    results.append((True, {"delete": {"_id": doc_id, "status": 200}}))
+                    continue
+                source = dict(action["_source"])
+                vector = source.pop("sentence_embedding")
+                if old is not None:
+                    removed.append(old)
+                new = self._next_id
+                self._next_id += 1
+                current[doc_id] = new
+                rows[new] = (new, doc_id, json.dumps(source))
+                vectors[new] = vector
+                results.append((True, {op_type: {"_id": doc_id, "status": 200 if old is not None else 201}}))
+
+            # Passages replaced within the batch never reach the index.
+            stale = [old for old in removed if old not in rows]
+            for old in removed:
+                rows.pop(old, None)
+                vectors.pop(old, None)
+            self._db.executemany("DELETE FROM docs WHERE id = ?", [(old,) for old in stale])
+            self._db.executemany(
+                "INSERT OR REPLACE INTO docs (id, doc_id, source) VALUES (?, ?, ?)", rows.values()
+            )
+            self._remove(stale)
+            if vectors:
+                ids = np.fromiter(vectors, dtype=np.int64, count=len(vectors))
+                self._add(ids, l2_normalize(np.stack([np.asarray(vector) for vector in vectors.values()])))
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES ('next_id', ?)",
+                (json.dumps(self._next_id),),
+            )
+            return results
+
+    def _raw_search(self, vector: np.ndarray, fetch: int) -> List[Tuple[int, float]]:
+        """(id, inner product) of the `fetch` nearest vectors, stale ones included."""
+        candidates = []
+        if self.index is not None and self.index.is_trained and self.index.ntotal > 0:
+            inner = faiss.downcast_index(self.index.index)
+            if isinstance(inner, faiss.IndexHNSW):
+                inner.hnsw.efSearch = max(fetch, 16)
+            elif isinstance(inner, faiss.IndexIVF):
+                inner.nprobe = self.nprobe
+            scores, ids = self.index.search(vector[None, :], min(fetch, self.index.ntotal))
+            candidates.extend((int(i), float(s)) for i, s in zip(ids[0], scores[0]) if i >= 0)
+        if self._pending is not None and len(self._pending_ids):
+            # Not trained yet, search the waiting vectors exhaustively.
+            scores = self._pending @ vector
+            top = np.argsort(-scores)[:fetch]
+            candidates.extend((int(self._pending_ids[i]), float(scores[i])) for i in top)
+        return sorted(candidates, key=lambda candidate: -candidate[1])[:fetch]
+
+    @property
+    def size(self) -> int:
+        return (self.index.ntotal if self.index is not None else 0) + len(self._pending_ids)
+
+    def nearest(
+        self, vector: np.ndarray, k: int, num_candidates: int, accept: Callable[[dict], bool]
+    ) -> List[Tuple[str, float, dict]]:
+        """(doc_id, score, source) of the `k` nearest live passages accepted by the filter.
+
+        Scores are `(1 + inner product) / 2`, like ES scores of unit vectors.
+        """
+        with self._lock:
+            fetch = max(num_candidates, k)
+            while True:
+                candidates = self._raw_search(vector, fetch)
+                found = {}
+                for batch in batched([i for i, _ in candidates], _LOOKUP_BATCH):
+                    marks = ",".join("?" * len(batch))
+                    query = f"SELECT id, doc_id, source FROM docs WHERE id IN ({marks})"
+                    found.update(
+                        (i, (doc_id, source)) for i, doc_id, source in self._db.execute(query, batch)
+                    )
+                results = []
+                for i, score in candidates:
+                    if i not in found:
+                        continue
+                    doc_id, source = found[i][0], json.loads(found[i][1])
+                    if accept(source):
+                        results.append((doc_id, (1 + score) / 2, source))
+                # Stale or filtered out candidates may leave less than k results, look further.
+                if len(results) >= k or fetch >= self.size:
+                    return results[:k]
+                fetch *= 2
+
+    def save(self):
+        if self.read_only:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES ('params', ?)", (json.dumps(self.params),)
+            )
+            if self.projection is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO meta (name, value) VALUES ('projection', ?)",
+                    (json.dumps(self.projection),),
+                )
+            self._db.commit()
+            if self.index is not None:
+                tmp_path = self.path / "index.faiss.tmp"
+                faiss.write_index(self.index, str(tmp_path))
+                os.replace(tmp_path, self.path / "index.faiss")
+            if self._pending is not None and len(self._pending_ids):
+                np.savez(self.path / "pending.npz", ids=self._pending_ids, vectors=self._pending)
+            elif (self.path / "pending.npz").exists():
+                (self.path / "pending.npz").unlink()
+
+    @property
+    def generation(self) -> Optional[str]:
+        # Read from the table every time, ingestion may run in another process.
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def changed_on_disk(self) -> bool:
+        """Whether another process ingested into the index since it was loaded.
+
+        The generation is read at most every `FAISS_RELOAD_CHECK_INTERVAL`
+        seconds, so searches don't all query the table.
+        """
+        now = time.monotonic()
+        if now - self._checked_at < constants.FAISS_RELOAD_CHECK_INTERVAL:
+            return False
+        self._checked_at = now
+        return self.generation != self.loaded_generation
+
+    def bump_generation(self):
+        with self._lock:
+            generation = uuid.uuid4().hex
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES ('generation', ?)",
+                (json.dumps(generation),),
+            )
+            self._db.commit()
+            # This index made the change, it already holds it.
+            self.loaded_generation = generation
+
+    def stats(self) -> dict:
+        live = self._db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+        return {**self.params, "passages": live, "vectors": self.size, "stale": self.size - live}
+
+    def close(self):
+        self.save()
+        self._db.close()
+
+
+class FaissStore(VectorStore):
+    """Passages indexed in local FAISS indices, one folder per index name.
+
+    Vectors are normalized and compared by inner product, and scores are
+    scaled like ES cosine scores, so results can be mixed with or compared
+    to those of ES.  Only kNN searches are supported; their filters can use
+    term, terms, range, exists and bool queries on the `_source` fields.
+    Indices are saved on `flush` and `close`, and can be memory-mapped
+    read-only for serving.
+
+    Example:
+        store = FaissStore(".cache/faiss", index_type="hnsw")
+        local_text_embedding(store, "es0", data_path)
+        store.close()
+        store = FaissStore(".cache/faiss", mmap=True)
+        results = perform_search("semantic search", store, "es0", model)
+    """
+
+    def __init__(self, root: str = constants.FAISS_DIR, mmap: bool = False, **index_options):
+        """
+        Args:
+            root (str): folder holding the indices.
+            mmap (bool): memory-map existing indices read-only instead of loading them.
+            index_options: settings of new indices, see `create_index`.
+        """
+        self.root = Path(root)
+        self.mmap = mmap
+        self.index_options = index_options
+        self._indices: Dict[str, _LocalIndex] = {}
+        self._lock = threading.Lock()
+
+    def create_index(
+        self,
+        index_name: str,
+        index_type: str = constants.FAISS_INDEX_TYPE,
+        m: int = constants.FAISS_HNSW_M,
+        ef_construction: int = constants.FAISS_HNSW_EF_CONSTRUCTION,
+        nlist: int = constants.FAISS_NLIST,
+        pq_m: int = constants.FAISS_PQ_M,
+        nprobe: int = constants.FAISS_NPROBE,
+        projection: Optional[str] = None,
+    ):
+        """Create an index; the vector dimension is taken from the first indexed passages.
+
+        Args:
+            index_name (str): name of the index.
+            index_type (str): "flat" for exact search, "hnsw" for a graph
+                index, or "ivfpq" for an inverted file of product-quantized
+                vectors, trained once enough vectors are indexed.
+            m (int): HNSW neighbours per node.
+            ef_construction (int): HNSW candidates explored while indexing.
+            nlist (int): IVF clusters.
+            pq_m (int): PQ sub-quantizers, must divide the vector dimension.
+            nprobe (int): IVF clusters visited per search.
+            projection (str): projection file the vectors go through,
+                recorded in the index, see `index_projection`.
+        """
+        if (self.root / index_name / "docs.sqlite").exists():
+            raise ValueError(f"Index {index_name} already exists at {self.root / index_name}")
+        with self._lock:
+            self._indices[index_name] = _LocalIndex(
+                self.root / index_name,
+                index_type=index_type,
+                m=m,
+                ef_construction=ef_construction,
+                nlist=nlist,
+                pq_m=pq_m,
+                nprobe=nprobe,
+                projection=projection,
+            )
+            self._indices[index_name].save()
+
+    def _index(self, index_name: str, create: bool = False) -> _LocalIndex:
+        """The loaded index of a name, reloaded if it changed on disk.
+
+        Args:
+            index_name (str): name of the index.
+            create (bool): create the index with the store settings if it
+                doesn't exist, instead of raising an `IndexNotFoundError`.
+        """
+        # Checked outside the store lock, searches on other indices don't wait for it.
+        index = self._indices.get(index_name)
+        if index is not None and not index.changed_on_disk():
+            return index
+        with self._lock:
+            current = self._indices.get(index_name)
+            if current is not index:
+                # Loaded by another thread meanwhile.
+                return current
+            path = self.root / index_name
+            if not create and not (path / "docs.sqlite").exists():
+                raise IndexNotFoundError(f"No faiss index {index_name} in {self.root}")
+            # Reload an index another process ingested into since it was loaded.
+            # The stale one isn't closed, searches may still be running on it.
+            if index is not None:
+                logger.info(f"Reloading the faiss index {index_name}, it changed on disk.")
+            index = _LocalIndex(path, mmap=self.mmap, **self.index_options)
+            self._indices[index_name] = index
+            return index
+
+    def bulk(
+        self,
+        actions: Iterable[dict],
+        chunk_size: int = constants.BULK_CHUNK_SIZE,
+        max_chunk_bytes: int = constants.BULK_MAX_BYTES,
+        inflight: int = constants.BULK_INFLIGHT,
+    ) -> Iterator[Tuple[bool, dict]]:
+        """Apply actions in chunks of `chunk_size`; `max_chunk_bytes` and `inflight` don't apply locally.
+
+        Indices that don't exist yet are created with the store settings.
+        """
+        for chunk in batched(actions, chunk_size):
+            # Consecutive actions on the same index are written together.
+            start = 0
+            while start < len(chunk):
+                index_name = chunk[start]["_index"]
+                end = start
+                while end < len(chunk) and chunk[end]["_index"] == index_name:
+                    end += 1
+                yield from self._index(index_name, create=True).write(chunk[start:end])
+                start = end
+
+    def search(self, index_name: str, body: dict) -> dict:
+        """Run a kNN search request, see `knn_search_body`; unknown indices raise `IndexNotFoundError`."""
+        return knn_search_response(index_name, body, self._index(index_name).nearest)
+
+    def search_many(self, searches: List[Tuple[str, dict]]) -> List[dict]:
+        return [self.search(index_name, body) for index_name, body in searches]
+
+    def info(self) -> dict:
+        return {
+            "backend": "faiss",
+            "root": str(self.root),
+            "indices": {name: index.stats() for name, index in self._indices.items()},
+        }
+
+    def generation(self, index_name: str) -> Optional[str]:
+        return self._index(index_name).generation
+
+    def bump_generation(self, index_name: str):
+        self._index(index_name).bump_generation()
+
+    def projection_file(self, index_name: str) -> Optional[str]:
+        try:
+            return self._index(index_name).projection
+        except IndexNotFoundError:
+            # Ingestion creates it, without projection.
+            return None
+
+    def flush(self):
+        for index in list(self._indices.values()):
+            index.save()
+
+    def close(self):
+        for index in list(self._indices.values()):
+            index.close()
+        self._indices.clear()
@@ -0,0 +1,109 @@
+from typing import Callable, Dict, Hashable, List, Optional
+
+from src.utils import constants
+
+FUSION_METHODS = ("rrf", "weighted")
+
+
+def hit_key(hit: dict) -> Hashable:
+    """Identify a hit by its index and its parent document, or its own id for passages."""
+    # Collapsed hits carry the parent id in `fields` even if `_source` doesn't.
+    parent_id = hit.get("_source", {}).get("parent_id") or hit.get("fields", {}).get("parent_id", [None])[0]
+    return hit.get("_index"), parent_id or hit["_id"]
+
+
+def passage_key(hit: dict) -> Hashable:
+    """Identify a hit by its index and its own id."""
+    return hit.get("_index"), hit["_id"]
+
+
+def normalize_scores(hits: List[dict]) -> List[float]:
+    """Min-max normalize the scores of a ranking to [0, 1]."""
+    scores = [hit["_score"] for hit in hits]
+    if not scores:
+        return []
+    low, high = min(scores), max(scores)
+    if high == low:
+        return [1.0] * len(scores)
+    return [(score - low) / (high - low) for score in scores]
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[dict]],
+    size: int,
+    weights: Optional[List[float]] = None,
+    rank_constant: int = constants.RRF_RANK_CONSTANT,
+    key: Callable[[dict], Hashable] = hit_key,
+) -> List[dict]:
+    """Fuse rankings by summing `weight / (rank_constant + rank)` over the rankings of every hit.
+
+    Only ranks are used, so rankings with incomparable scores (BM25 and
+    cosine similarity) can be fused without normalization.
+
+    Args:
+        rankings (List[List[dict]]): hits of every retriever, best first.
+        size (int): number of hits to return.
+        weights (List[float]): weight of every ranking, 1 by default.
+        rank_constant (int): damps the advantage of the top ranks.
+        key: identifies the same hit across rankings.
+
+    Returns:
+        the fused hits, best first, with the fused score as `_score`.
+    """
+    weights = weights or [1.0] * len(rankings)
+    scores: Dict[Hashable, float] = {}
+    best: Dict[Hashable, dict] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, hit in enumerate(ranking, start=1):
+            hit_id = key(hit)
+            scores[hit_id] = scores.get(hit_id, 0.0) + weight / (rank_constant + rank)
+            best.setdefault(hit_id, hit)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:size]
+    return [dict(best[hit_id], _score=scores[hit_id]) for hit_id in ranked]
+
+
+def weighted_score_fusion(
+    rankings: List[List[dict]],
+    size: int,
+    weights: Optional[List[float]] = None,
+    key: Callable[[dict], Hashable] = hit_key,
+) -> List[dict]:
+    """Fuse rankings by the weighted sum of their min-max normalized scores.
+
+    A hit missing from a ranking scores 0 in it.
+
+    Args:
+        rankings (List[List[dict]]): hits of every retriever, best first.
+        size (int): number of hits to return.
+        weights (List[float]): weight of every ranking, 1 by default.
+        key: identifies the same hit across rankings.
+
+    Returns:
+        the fused hits, best first, with the fused score as `_score`.
+    """
+    weights = weights or [1.0] * len(rankings)
+    scores: Dict[Hashable, float] = {}
+    best: Dict[Hashable, dict] = {}
+    for ranking, weight in zip(rankings, weights):
+        for hit, score in zip(ranking, normalize_scores(ranking)):
+            hit_id = key(hit)
+            scores[hit_id] = scores.get(hit_id, 0.0) + weight * score
+            best.setdefault(hit_id, hit)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:size]
+    return [dict(best[hit_id], _score=scores[hit_id]) for hit_id in ranked]
+
+
+def fuse(
+    rankings: List[List[dict]],
+    size: int,
+    method: str = constants.FUSION_METHOD,
+    weights: Optional[List[float]] = None,
+    rank_constant: int = constants.RRF_RANK_CONSTANT,
+    key: Callable[[dict], Hashable] = hit_key,
+) -> List[dict]:
+    """Fuse rankings with one of `FUSION_METHODS`."""
+    if method == "rrf":
+        return reciprocal_rank_fusion(rankings, size, weights=weights, rank_constant=rank_constant, key=key)
+    if method == "weighted":
+        return weighted_score_fusion(rankings, size, weights=weights, key=key)
+    raise ValueError(f"Unknown fusion method {method}, expected one of {FUSION_METHODS}")
@@ -1,11 +1,16 @@
 import argparse
+import sys
 import textwrap
+from pathlib import Path
 
 import argcomplete
-from elasticsearch import Elasticsearch
 
+from src.dataset.profiles import PROFILES, get_profile
+from src.dataset.projection import load_projection, projection_path
+from src.dataset.vector_store import BACKENDS, FAISS_INDEX_TYPES, open_store
 from src.utils import constants
 from src.utils.logging import getLogger
+from src.utils.registry import get_es_client
 
 # instantiate the logger
 logger = getLogger(__name__)
@@ -22,52 +27,129 @@ if __name__ == "__main__":
 
         --index_name="index0"
         --embedding_dims="512"
+        --profile="default"
+        --m=16
+        --ef_construction=100
+        --shards=2
+        --replicas=1
+        --backend="elasticsearch"
+        --faiss_dir=".cache/faiss"
+        --faiss_index_type="hnsw"
+        --nlist=1024
+        --pq_m=16
+        --projection=".cache/projections/es0.npz"
 
         Example Usage
         -------------
         python %(prog)s
         python %(prog)s --index_name=es0 --embedding_dims 512
+        python %(prog)s --index_name=es0 --embedding_dims 768 --profile compact --replicas 0
+        python %(prog)s --index_name=es0 --backend faiss --faiss_index_type ivfpq --nlist 256 --pq_m 48
 
         '''
         ),
     )
     parser.add_argument('--index_name', help='elasticsearch index name', type=str)
     parser.add_argument('--embedding_dims', help='text embedding vector dimension.', type=int)
+    parser.add_argument(
+        '--profile',
+        help='vector storage and index settings profile.',
+        choices=list(PROFILES),
+        default="default",
+    )
+    parser.add_argument('--m', help='HNSW neighbours per node, overrides the profile.', type=int)
+    parser.add_argument(
+        '--ef_construction', help='HNSW candidates explored while indexing, overrides the profile.', type=int
+    )
+    parser.add_argument('--shards', help='number of primary shards, overrides the profile.', type=int)
+    parser.add_argument('--replicas', help='number of replicas, overrides the profile.', type=int)
+    parser.add_argument(
+        '--backend',
+        help='where the passages are indexed.',
+        choices=BACKENDS,
+        default=constants.VECTOR_BACKEND,
+    )
+    parser.add_argument('--faiss_dir', help='folder of the faiss indices.', type=str)
+    parser.add_argument(
+        '--faiss_index_type',
+        help='faiss index type.',
+        choices=FAISS_INDEX_TYPES,
+        default=constants.FAISS_INDEX_TYPE,
+    )
+    parser.add_argument('--nlist', help='IVF clusters of an ivfpq faiss index.', type=int)
+    parser.add_argument('--pq_m', help='PQ sub-quantizers of an ivfpq faiss index.', type=int)
+    parser.add_argument(
+        '--projection',
+        help='projection of the vectors, the one fitted for the index name if any by default.',
+        type=str,
+    )
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
 
+    # The index records the projection its vectors go through, ingestion and search read it there.
+    projection_file = args.projection or projection_path(args.index_name)
+    projection = load_projection(projection_file)
+    if args.projection and projection is None:
+        raise FileNotFoundError(f"No projection at {args.projection}")
+    recorded_projection = str(Path(projection_file).resolve()) if projection is not None else None
+
+    if args.backend == "faiss":
+        # Local indices take the vector dimension from the first passages.
+        store = open_store("faiss", faiss_dir=args.faiss_dir)
+        options = dict(
+            index_type=args.faiss_index_type,
+            m=args.m,
+            ef_construction=args.ef_construction,
+            nlist=args.nlist,
+            pq_m=args.pq_m,
+            projection=recorded_projection,
+        )
+        try:
+            store.create_index(args.index_name, **{key: value for key, value in options.items() if value})
+            logger.info(f"Built {args.index_name} faiss index in {store.root}.")
+        except ValueError as e:
+            logger.debug(e)
+        finally:
+            store.close()
+        sys.exit(0)
+
     logger.info('Started invoking elasticsearch client.')
     # Create the client instance
-    client = Elasticsearch(
-        hosts=constants.ES_URL,
-        ca_certs=constants.ES_CA_CERTS,
-        basic_auth=(constants.ES_USER, constants.ES_PASSWORD),
-    )
+    client = get_es_client()
     # get cluster information
     logger.info(client.info())
 
+    # Vectors projected to fewer dimensions are indexed with the dims of the projection.
+    embedding_dims = args.embedding_dims
+    if projection is not None:
+        if embedding_dims and embedding_dims != projection.dims:
+            logger.info(f"Indexing {projection.dims} dimensions instead of {embedding_dims}: {projection}")
+        embedding_dims = projection.dims
+
     # define index config
-    settings = {"number_of_shards": 2, "number_of_replicas": 1}
-    mappings = {
-        "properties": {
-            "sentence_embedding": {
-                "type": "dense_vector",
-                "dims": args.embedding_dims,
-                "index": True,
-                "similarity": "cosine",
-            },
-            "sentence_text": {"type": "text", "fields": {"keyword": {"type": "text"}}},
-            "document_name": {"type": "text", "fields": {"keyword": {"type": "text"}}},
-        }
-    }
+    profile = get_profile(
+        args.profile,
+        m=args.m,
+        ef_construction=args.ef_construction,
+        shards=args.shards,
+        replicas=args.replicas,
+        projection=recorded_projection,
+    )
+    settings = profile.settings()
+    mappings = profile.mappings(embedding_dims)
 
     # create an index in elasticsearch
+    from elasticsearch import BadRequestError
+
     try:
         client.indices.create(
             index=args.index_name,
             settings=settings,
             mappings=mappings,
         )
-        logger.info(f"Built {args.index_name} index.")
+        logger.info(f"Built {args.index_name} index with the {profile.name} profile: {profile}")
     except Exception as e:
+        if not (isinstance(e, BadRequestError) and e.error == "resource_already_exists_exception"):
+            logger.error(f'Could not create the index "{args.index_name}": {e}')
+            raise
         logger.debug(f'Index "{args.index_name}" already exists')
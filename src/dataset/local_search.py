@@ -0,0 +1,222 @@
+"""Search requests of the ES query DSL answered by local vector stores.
+
+The local stores only keep passage vectors and their `_source`; this module
+turns a kNN search request into calls to their nearest neighbour search, or
+scores the passages of a BM25 search request, and builds an ES shaped
+response, so `search_hits` runs against them unchanged.
+"""
+
+import math
+import operator
+import re
+import time
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from src.utils.utils import l2_normalize
+
+# (vector, k, num_candidates, accept) -> (doc_id, score, source) of the k nearest accepted passages
+NearestSearch = Callable[[np.ndarray, int, int, Callable[[dict], bool]], List[Tuple[str, float, dict]]]
+
+# Term frequency saturation and length normalization of BM25, the ES defaults.
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+
+
+def _field_values(source: dict, field: str) -> list:
+    """Values of a field of a `_source`.
+
+    Dotted names reach into objects and `.keyword` sub-fields read the field itself.
+    """
+    if field.endswith(".keyword"):
+        field = field[: -len(".keyword")]
+    value = source
+    for name in field.split("."):
+        value = value.get(name) if isinstance(value, dict) else None
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def matches(source: dict, query: dict) -> bool:
+    """Whether a `_source` matches a query of the subset of the ES query DSL used as filters.
+
+    Supported: term, terms, range, exists, match (any of the query terms),
+    match_all and bool with filter, must, must_not and should clauses.
+    """
+    (kind, spec), *_ = query.items()
+    if kind == "match_all":
+        return True
+    if kind == "bool":
+        required = _as_list(spec.get("filter")) + _as_list(spec.get("must"))
+        should = _as_list(spec.get("should"))
+        return (
+            all(matches(source, clause) for clause in required)
+            and not any(matches(source, clause) for clause in _as_list(spec.get("must_not")))
+            and (not should or any(matches(source, clause) for clause in should))
+        )
+    if kind == "exists":
+        return bool(_field_values(source, spec["field"]))
+    (field, value), *_ = spec.items()
+    values = _field_values(source, field)
+    if kind == "match":
+        terms = set(_match_terms(value))
+        return any(terms.intersection(tokenize(str(item))) for item in values)
+    if kind == "term":
+        return (value["value"] if isinstance(value, dict) else value) in values
+    if kind == "terms":
+        return any(item in values for item in value)
+    if kind == "range":
+        bounds = {"gt": operator.gt, "gte": operator.ge, "lt": operator.lt, "lte": operator.le}
+        return any(
+            all(bounds[op](item, bound) for op, bound in value.items() if op in bounds) for item in values
+        )
+    raise ValueError(f"The faiss backend doesn't support {kind} queries")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased words of a text, close to the ES standard analyzer."""
+    return re.findall(r"\w+", text.lower())
+
+
+def _match_terms(spec) -> List[str]:
+    return tokenize(spec["query"] if isinstance(spec, dict) else spec)
+
+
+def _as_list(clauses) -> list:
+    if clauses is None:
+        return []
+    return clauses if isinstance(clauses, list) else [clauses]
+
+
+def _filter_source(source: dict, spec) -> Optional[dict]:
+    """Apply the `_source` option of a search request to a `_source`."""
+    if spec is None or spec is True:
+        return source
+    if spec is False:
+        return None
+    if isinstance(spec, (list, str)):
+        spec = {"includes": _as_list(spec)}
+    includes, excludes = _as_list(spec.get("includes")), _as_list(spec.get("excludes"))
+    return {
+        name: value
+        for name, value in source.items()
+        if (not includes or name in includes) and name not in excludes
+    }
+
+
+def knn_search_response(index_name: str, body: dict, nearest: NearestSearch) -> dict:
+    """Run a kNN search request, see `knn_search_body`, with a local nearest neighbour search.
+
+    Supports the kNN filters accepted by `matches`, `min_score`, `collapse`
+    with inner hits, `size` and `_source` filtering.
+
+    Args:
+        index_name (str): name of the searched index, set on the hits.
+        body (dict): the search request.
+        nearest (NearestSearch): nearest neighbour search of the index;
+            scores are expected on the scale of ES cosine scores.
+    """
+    start = time.perf_counter()
+    if "knn" not in body or "query" in body:
+        raise ValueError("Local vector stores only run kNN searches")
+    knn = body["knn"]
+    filters = _as_list(knn.get("filter"))
+    passages = nearest(
+        l2_normalize(knn["query_vector"]),
+        k=knn["k"],
+        num_candidates=knn.get("num_candidates", knn["k"]),
+        accept=lambda source: all(matches(source, query) for query in filters),
+    )
+    return _response(index_name, body, passages, start)
+
+
+def lexical_search_response(index_name: str, body: dict, passages: Iterable[Tuple[str, dict]]) -> dict:
+    """Run a BM25 search request, see `lexical_search_body`, by scoring every passage.
+
+    The request is a `match` query, or a bool query whose `must` clauses
+    hold the `match` queries scored and whose other clauses filter the
+    passages, see `matches`.  Scores are BM25 scores computed over all the
+    given passages, with the ES default parameters; the other options are
+    those of `knn_search_response`.
+
+    Args:
+        index_name (str): name of the searched index, set on the hits.
+        body (dict): the search request.
+        passages (Iterable): (doc_id, source) of all the passages of the index.
+    """
+    start = time.perf_counter()
+    if "query" not in body or "knn" in body:
+        raise ValueError("Expected a lexical search request")
+    query = body["query"]
+    scored, rest = ([query], {}) if "match" in query else ([], dict(query["bool"]))
+    if rest:
+        must = _as_list(rest.get("must"))
+        scored = [clause for clause in must if "match" in clause]
+        rest["must"] = [clause for clause in must if "match" not in clause]
+    if not scored:
+        raise ValueError("Local vector stores only score match queries")
+
+    passages = list(passages)
+    # BM25 weight of every (field, query term), with the term counts of the passages.
+    weights = []
+    for clause in scored:
+        (field, spec), *_ = clause["match"].items()
+        counts = [
+            Counter(tokenize(" ".join(map(str, _field_values(source, field))))) for _, source in passages
+        ]
+        lengths = [sum(count.values()) for count in counts]
+        average_length = sum(lengths) / len(lengths) if lengths else 0.0
+        for term in _match_terms(spec):
+            containing = sum(1 for count in counts if term in count)
+            idf = math.log(1 + (len(passages) - containing + 0.5) / (containing + 0.5))
+            weights.append((term, idf, counts, lengths, average_length))
+
+    results = []
+    for row, (doc_id, source) in enumerate(passages):
+        score, matched = 0.0, False
+        for term, idf, counts, lengths, average_length in weights:
+            frequency = counts[row][term]
+            if frequency:
+                matched = True
+                norm = _BM25_K1 * (1 - _BM25_B + _BM25_B * lengths[row] / (average_length or 1))
+                score += idf * frequency * (_BM25_K1 + 1) / (frequency + norm)
+        if matched and (not rest or matches(source, {"bool": rest})):
+            results.append((doc_id, score, source))
+    results.sort(key=lambda result: -result[1])
+    return _response(index_name, body, results, start)
+
+
+def _response(index_name: str, body: dict, passages: List[Tuple[str, float, dict]], start: float) -> dict:
+    """ES shaped response of scored passages, in decreasing score order, with the options of the request."""
+    min_score = body.get("min_score")
+    hits = [
+        {"_index": index_name, "_id": doc_id, "_score": score, "_source": source}
+        for doc_id, score, source in passages
+        if min_score is None or score >= min_score
+    ]
+
+    collapse = body.get("collapse")
+    if collapse is not None:
+        field, inner = collapse["field"], collapse.get("inner_hits")
+        groups: Dict[str, List[dict]] = {}
+        for hit in hits:
+            groups.setdefault((_field_values(hit["_source"], field) or [None])[0], []).append(hit)
+        hits = []
+        for value, group in groups.items():
+            hit = dict(group[0], fields={field: [value]})
+            if inner is not None:
+                inner_hits = [
+                    dict(passage, _source=_filter_source(passage["_source"], inner.get("_source")))
+                    for passage in group[: inner.get("size", 3)]
+                ]
+                hit["inner_hits"] = {inner["name"]: {"hits": {"hits": inner_hits}}}
+            hits.append(hit)
+
+    hits = [
+        dict(hit, _source=_filter_source(hit["_source"], body.get("_source")))
+        for hit in hits[: body.get("size", 10)]
+    ]
+    return {"took": int((time.perf_counter() - start) * 1000), "hits": {"hits": hits}}
@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterable, Iterator, List, Tuple
+
+from src.dataset.corpus import (
+    TextDocument,
+    file_signature,
+    read_document,
+    scan_text_files,
+)
+from src.utils.logging import getLogger
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+# Number of manifest updates buffered before they are written.
+_WRITE_BATCH = 10_000
+
+
+class Manifest:
+    """Record of the files indexed from a corpus, used for incremental syncs.
+
+    For every indexed file the manifest keeps its path relative to the corpus
+    root, mtime, size, content hash, document id and number of passages.  A
+    sync walks the corpus and only reads files whose mtime or size changed,
+    only re-embeds files whose content hash changed, and reports the files
+    that disappeared.
+
+    Example:
+        manifest = Manifest(".cache/manifests/es0.sqlite")
+        manifest.begin_sync()
+        for document in manifest.changed_files(data_path):
+            ...  # index the document, then
+            manifest.record([document])
+        deleted = manifest.deleted_files()
+        ...  # delete them from the index, then
+        manifest.remove(path for path, _, _ in deleted)
+        manifest.commit()
+    """
+
+    def __init__(self, path: str):
+        """Open the manifest, creating it if needed.
+
+        Args:
+            path (str): path of the manifest sqlite file.
+        """
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, doc_id TEXT, mtime_ns INTEGER, size INTEGER, content_hash TEXT, "
+            "chunks INTEGER, sync_run INTEGER)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS files_sync_run ON files (sync_run)")
+        self._run = self._db.execute("SELECT COALESCE(MAX(sync_run), 0) FROM files").fetchone()[0]
+        self.unchanged = 0
+        self.changed = 0
+
+    def begin_sync(self) -> int:
+        """Start a new sync run; files not seen during the run are reported as deleted."""
+        self._run += 1
+        self.unchanged = 0
+        self.changed = 0
+        return self._run
+
+    def _mark_seen(self, paths: List[str]):
+        with self._lock:
+            self._db.executemany(
+                "UPDATE files SET sync_run = ? WHERE path = ?", [(self._run, p) for p in paths]
+            )
+
+    def _mark_touched(self, documents: List[TextDocument]):
+        """Store the new mtime and size of files whose content did not change."""
+        with self._lock:
+            self._db.executemany(
+                "UPDATE files SET mtime_ns = ?, size = ?, sync_run = ? WHERE path = ?",
+                [(*d.signature, self._run, d.name) for d in documents],
+            )
+
+    def changed_files(self, data_path: str) -> Iterator[TextDocument]:
+        """Walk the corpus and yield the new or modified files.
+
+        Unchanged files are only stat-ed, with their sidecar, files whose mtime
+        or size changed are read and hashed, and only those whose content or
+        metadata changed are yielded.
+
+        Args:
+            data_path (str): the root folder of the corpus.
+        """
+        seen, touched = [], []
+        for file_path in scan_text_files(data_path):
+            relative_path = os.path.relpath(file_path, data_path)
+            stat = os.stat(file_path)
+            signature = file_signature(file_path, stat)
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT mtime_ns, size, content_hash FROM files WHERE path = ?", (relative_path,)
+                ).fetchone()
+            if row is not None:
+                seen.append(relative_path)
+                if (row[0], row[1]) == signature:
+                    self.unchanged += 1
+                    continue
+
+            document = read_document(data_path, file_path, stat)
+            if row is not None and row[2] == document.content_hash:
+                self.unchanged += 1
+                touched.append(document)
+            else:
+                self.changed += 1
+                yield document
+
+            if len(seen) >= _WRITE_BATCH:
+                self._mark_seen(seen)
+                seen = []
+            if len(touched) >= _WRITE_BATCH:
+                self._mark_touched(touched)
+                touched = []
+        self._mark_seen(seen)
+        self._mark_touched(touched)
+
+    def record(self, documents: Iterable[TextDocument]):
+        """Record documents that have been indexed."""
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO files (path, doc_id, mtime_ns, size, content_hash, chunks, sync_run) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(d.name, d.doc_id, *d.signature, d.content_hash, d.chunks, self._run) for d in documents],
+            )
+
+    def indexed_chunks(self, document: TextDocument) -> int:
+        """Number of passages the previous version of a document was indexed with."""
+        with self._lock:
+            row = self._db.execute("SELECT chunks FROM files WHERE path = ?", (document.name,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def deleted_files(self) -> List[Tuple[str, str, int]]:
+        """(path, doc_id, chunks) of the recorded files not seen during the current sync."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT path, doc_id, chunks FROM files WHERE sync_run < ?", (self._run,)
+            ).fetchall()
+
+    def remove(self, paths: Iterable[str]):
+        """Forget files that have been deleted from the index."""
+        with self._lock:
+            self._db.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in paths])
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        self.commit()
+        self._db.close()
@@ -0,0 +1,154 @@
+import threading
+import uuid
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from src.dataset.local_search import knn_search_response, lexical_search_response
+from src.dataset.vector_store import VectorStore
+from src.utils import constants
+from src.utils.utils import l2_normalize
+
+
+class _MemoryIndex:
+    """Passage vectors and `_source` of an index, kept in memory and searched exhaustively.
+
+    Replaced and deleted passages leave an empty row behind, skipped at search time.
+    """
+
+    def __init__(self, projection: Optional[str] = None):
+        self._lock = threading.RLock()
+        self._rows: Dict[str, int] = {}
+        self._doc_ids: List[Optional[str]] = []
+        self._sources: List[Optional[dict]] = []
+        self._vectors: List[Optional[np.ndarray]] = []
+        # Stacked unit vectors of the rows, rebuilt on the first search after a write.
+        self._matrix: Optional[np.ndarray] = None
+        self.generation: Optional[str] = None
+        self.projection = projection
+
+    def write(self, actions: List[dict]) -> List[Tuple[bool, dict]]:
+        results = []
+        with self._lock:
+            for action in actions:
+                op_type = action.get("_op_type", "index")
+                doc_id = action.get("_id") or uuid.uuid4().hex
+                row = self._rows.pop(doc_id, None)
+                if row is not None:
+                    self._doc_ids[row] = self._sources[row] = self._vectors[row] = None
+                if op_type == "delete":
+                    status = 200 if row is not None else 404
+                    results.append((row is not None, {"delete": {"_id": doc_id, "status": status}}))
+                    continue
+                # Like the faiss store, vectors aren't returned in `_source`.
+                source = dict(action["_source"])
+                vector = source.pop("sentence_embedding")
+                self._rows[doc_id] = len(self._doc_ids)
+                self._doc_ids.append(doc_id)
+                self._sources.append(source)
+                self._vectors.append(np.asarray(vector, dtype=np.float32))
+                results.append((True, {op_type: {"_id": doc_id, "status": 200 if row is not None else 201}}))
+            self._matrix = None
+        return results
+
+    def nearest(
+        self, vector: np.ndarray, k: int, num_candidates: int, accept: Callable[[dict], bool]
+    ) -> List[Tuple[str, float, dict]]:
+        """(doc_id, score, source) of the exact `k` nearest passages accepted by the filter."""
+        with self._lock:
+            if self._matrix is None:
+                dims = len(vector)
+                self._matrix = l2_normalize(
+                    np.stack([v if v is not None else np.zeros(dims, np.float32) for v in self._vectors])
+                    if self._vectors
+                    else np.zeros((0, dims), np.float32)
+                )
+            matrix, doc_ids, sources = self._matrix, list(self._doc_ids), list(self._sources)
+        scores = (1 + matrix @ vector) / 2
+        results = []
+        for row in np.argsort(-scores, kind="stable"):
+            if doc_ids[row] is None or not accept(sources[row]):
+                continue
+            results.append((doc_ids[row], float(scores[row]), sources[row]))
+            if len(results) == k:
+                break
+        return results
+
+    def passages(self) -> List[Tuple[str, dict]]:
+        """(doc_id, source) of the live passages."""
+        with self._lock:
+            return [
+                (doc_id, source) for doc_id, source in zip(self._doc_ids, self._sources) if doc_id is not None
+            ]
+
+    @property
+    def size(self) -> int:
+        return len(self._rows)
+
+
+class MemoryStore(VectorStore):
+    """Passages kept in memory and searched by brute force, for benchmarks and tests.
+
+    It accepts the same bulk actions and kNN search requests as `FaissStore`,
+    and BM25 search requests as well, so every search mode runs against it.
+    It needs no service nor optional dependency, and its results are exact.
+    Nothing is persisted.
+
+    Example:
+        store = MemoryStore()
+        local_text_embedding(store, "es0", data_path, model=model)
+        results = perform_search("semantic search", store, "es0", model)
+    """
+
+    def __init__(self):
+        self._indices: Dict[str, _MemoryIndex] = {}
+        self._lock = threading.Lock()
+
+    def create_index(self, index_name: str, projection: Optional[str] = None):
+        """Create an empty index, whose vectors go through the `projection` file if given."""
+        with self._lock:
+            if index_name in self._indices:
+                raise ValueError(f"Index {index_name} already exists")
+            self._indices[index_name] = _MemoryIndex(projection)
+
+    def _index(self, index_name: str) -> _MemoryIndex:
+        with self._lock:
+            return self._indices.setdefault(index_name, _MemoryIndex())
+
+    def bulk(
+        self,
+        actions: Iterable[dict],
+        chunk_size: int = constants.BULK_CHUNK_SIZE,
+        max_chunk_bytes: int = constants.BULK_MAX_BYTES,
+        inflight: int = constants.BULK_INFLIGHT,
+    ) -> Iterator[Tuple[bool, dict]]:
+        """Apply actions one at a time; the chunking options don't apply in memory."""
+        for action in actions:
+            yield from self._index(action["_index"]).write([action])
+
+    def search(self, index_name: str, body: dict) -> dict:
+        """Run a kNN or a BM25 search request, see `knn_search_body` and `lexical_search_body`."""
+        index = self._index(index_name)
+        if "query" in body:
+            return lexical_search_response(index_name, body, index.passages())
+        return knn_search_response(index_name, body, index.nearest)
+
+    def search_many(self, searches: List[Tuple[str, dict]]) -> List[dict]:
+        return [self.search(index_name, body) for index_name, body in searches]
+
+    def info(self) -> dict:
+        return {"backend": "memory", "indices": {name: index.size for name, index in self._indices.items()}}
+
+    def generation(self, index_name: str) -> Optional[str]:
+        return self._index(index_name).generation
+
+    def bump_generation(self, index_name: str):
+        self._index(index_name).generation = uuid.uuid4().hex
+
+    def projection_file(self, index_name: str) -> Optional[str]:
+        index = self._indices.get(index_name)
+        return index.projection if index is not None else None
+
+    def delete_index(self, index_name: str):
+        with self._lock:
+            self._indices.pop(index_name, None)
@@ -0,0 +1,119 @@
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator
+
+from src.utils import constants
+from src.utils.logging import getLogger
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+# Marks the end of the stream between two stages.
+_END = object()
+
+# How often (in seconds) a blocked stage re-checks whether the pipeline stopped.
+_POLL_INTERVAL = 0.1
+
+
+class PipelineStopped(Exception):
+    """Raised inside a stage when another stage of the pipeline failed."""
+
+
+def _put(q: queue.Queue, item: Any, stop: threading.Event):
+    """Put an item on a bounded queue without blocking forever."""
+    while True:
+        if stop.is_set():
+            raise PipelineStopped()
+        try:
+            q.put(item, timeout=_POLL_INTERVAL)
+            return
+        except queue.Full:
+            continue
+
+
+def _drain(q: queue.Queue, stop: threading.Event) -> Iterator[Any]:
+    """Yield the items of a queue until the end marker."""
+    while True:
+        if stop.is_set():
+            raise PipelineStopped()
+        try:
+            item = q.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            continue
+        if item is _END:
+            return
+        yield item
+
+
+def run_pipeline(
+    source: Iterable[Any],
+    encode: Callable[[Any], Any],
+    ship: Callable[[Iterator[Any]], Any],
+    queue_size: int = constants.PIPELINE_QUEUE_SIZE,
+) -> Any:
+    """Run a read -> encode -> ship pipeline with bounded queues between the stages.
+
+    The source is consumed by a reader thread and the shipper runs in its own
+    thread, so reading the next batch and shipping the previous one overlap
+    with encoding the current one, which runs in the calling thread.  At most
+    `queue_size` batches wait between two stages, which caps the memory used
+    regardless of the corpus size.
+
+    Args:
+        source (Iterable): batches to encode, e.g. chunks of documents.
+        encode (Callable): turns a batch into an encoded batch.
+        ship (Callable): consumes the iterator of encoded batches.
+        queue_size (int): maximum number of batches waiting between two stages.
+
+    Returns:
+        the value returned by `ship`.
+    """
+    read_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    ship_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+    shipped = {}
+
+    def reader():
+        try:
+            for batch in source:
+                _put(read_queue, batch, stop)
+            _put(read_queue, _END, stop)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def shipper():
+        try:
+            shipped["result"] = ship(_drain(ship_queue, stop))
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [
+        threading.Thread(target=reader, name="pipeline-reader", daemon=True),
+        threading.Thread(target=shipper, name="pipeline-shipper", daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        for batch in _drain(read_queue, stop):
+            _put(ship_queue, encode(batch), stop)
+        _put(ship_queue, _END, stop)
+    except PipelineStopped:
+        pass
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return shipped.get("result")
@@ -0,0 +1,168 @@
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, replace
+from typing import TYPE_CHECKING, Dict, Iterator, Optional
+
+from src.utils.logging import getLogger
+
+if TYPE_CHECKING:
+    from elasticsearch import Elasticsearch
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+SIMILARITIES = ("cosine", "dot_product")
+VECTOR_INDEX_TYPES = ("hnsw", "int8_hnsw")
+
+
+@dataclass(frozen=True)
+class IndexProfile:
+    """How the passages index stores and searches its vectors.
+
+    The profile is saved in the `_meta` of the index mapping, so ingestion
+    can read it back and prepare the vectors accordingly.
+    """
+
+    name: str
+    # "dot_product" needs unit vectors and is cheaper than "cosine", which
+    # normalizes on every comparison.
+    similarity: str = "cosine"
+    # "int8_hnsw" keeps the HNSW graph on int8 quantized vectors, about 4x
+    # smaller than float32.
+    index_type: str = "hnsw"
+    # HNSW neighbours per node and candidates explored while building the graph.
+    m: int = 16
+    ef_construction: int = 100
+    # Keep the vectors out of `_source`; they are still indexed and searchable,
+    # but can't be read back or reindexed from ES.
+    exclude_vector_source: bool = False
+    shards: int = 2
+    replicas: int = 1
+    refresh_interval: str = "1s"
+    # Refreshes are disabled while bulk loading when set.
+    bulk_refresh_disabled: bool = False
+    # File of the projection the vectors go through before being indexed or
+    # searched, see `Projection`; the index dims are then those of the projection.
+    projection: Optional[str] = None
+
+    def __post_init__(self):
+        if self.similarity not in SIMILARITIES:
+            raise ValueError(f"Unknown similarity {self.similarity}, expected one of {SIMILARITIES}")
+        if self.index_type not in VECTOR_INDEX_TYPES:
+            raise ValueError(
+                f"Unknown vector index type {self.index_type}, expected one of {VECTOR_INDEX_TYPES}"
+            )
+
+    @property
+    def normalize(self) -> bool:
+        """Whether vectors must be normalized to unit length before indexing."""
+        return self.similarity == "dot_product"
+
+    def settings(self) -> dict:
+        return {
+            "number_of_shards": self.shards,
+            "number_of_replicas": self.replicas,
+            "refresh_interval": self.refresh_interval,
+        }
+
+    def mappings(self, dims: int) -> dict:
+        mappings = {
+            "_meta": {"profile": asdict(self)},
+            "properties": {
+                "sentence_embedding": {
+                    "type": "dense_vector",
+                    "dims": dims,
+                    "index": True,
+                    "similarity": self.similarity,
+                    "index_options": {
+                        "type": self.index_type,
+                        "m": self.m,
+                        "ef_construction": self.ef_construction,
+                    },
+                },
+                "sentence_text": {
+                    "type": "text",
+                    "fields": {"keyword": {"type": "keyword", "ignore_above": 256}},
+                },
+                "document_name": {
+                    "type": "text",
+                    "fields": {"keyword": {"type": "keyword", "ignore_above": 1024}},
+                },
+                "parent_id": {"type": "keyword"},
+                "chunk_index": {"type": "integer"},
+                # File metadata, see `document_fields`, to filter and aggregate on.
+                "source_path": {"type": "keyword"},
+                "directory": {"type": "keyword"},
+                "file_size": {"type": "long"},
+                "modified_at": {"type": "date"},
+                "metadata": {"type": "object"},
+            },
+            # Strings of the sidecar metadata are exact values, not full text;
+            # dates and numbers keep their dynamic date and numeric types.
+            "dynamic_templates": [
+                {
+                    "metadata_strings": {
+                        "path_match": "metadata.*",
+                        "match_mapping_type": "string",
+                        "mapping": {"type": "keyword", "ignore_above": 1024},
+                    }
+                }
+            ],
+        }
+        if self.exclude_vector_source:
+            mappings["_source"] = {"excludes": ["sentence_embedding"]}
+        return mappings
+
+
+PROFILES: Dict[str, IndexProfile] = {
+    # The original float32 cosine index.
+    "default": IndexProfile("default"),
+    # int8 quantized unit vectors compared by dot product, without the vectors in `_source`.
+    "compact": IndexProfile(
+        "compact",
+        similarity="dot_product",
+        index_type="int8_hnsw",
+        exclude_vector_source=True,
+        bulk_refresh_disabled=True,
+    ),
+    # A denser graph for better recall, at the cost of memory and build time.
+    "recall": IndexProfile(
+        "recall",
+        similarity="dot_product",
+        m=32,
+        ef_construction=200,
+        bulk_refresh_disabled=True,
+    ),
+}
+
+
+def get_profile(name: str, **overrides) -> IndexProfile:
+    """A named profile, with some of its settings overridden."""
+    if name not in PROFILES:
+        raise ValueError(f"Unknown index profile {name}, expected one of {list(PROFILES)}")
+    return replace(PROFILES[name], **{key: value for key, value in overrides.items() if value is not None})
+
+
+def index_profile(client: "Elasticsearch", index_name: str) -> Optional[IndexProfile]:
+    """The profile an index was created with, None for indices created without one."""
+    mappings = client.indices.get_mapping(index=index_name)
+    for mapping in mappings.values():
+        profile = mapping["mappings"].get("_meta", {}).get("profile")
+        if profile is not None:
+            return IndexProfile(**profile)
+    return None
+
+
+@contextmanager
+def bulk_load(client: "Elasticsearch", index_name: str, profile: Optional[IndexProfile]) -> Iterator[None]:
+    """Disable refreshes while bulk loading if the profile asks for it, then refresh once."""
+    if profile is None or not profile.bulk_refresh_disabled:
+        yield
+        return
+    client.indices.put_settings(index=index_name, settings={"refresh_interval": "-1"})
+    logger.info(f"Disabled refreshes of {index_name} during the bulk load.")
+    try:
+        yield
+    finally:
+        client.indices.put_settings(index=index_name, settings={"refresh_interval": profile.refresh_interval})
+        client.indices.refresh(index=index_name)
+        logger.info(f"Restored the refresh interval of {index_name} to {profile.refresh_interval}.")
@@ -0,0 +1,405 @@
+import argparse
+import json
+import random
+import textwrap
+import traceback
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Union
+
+import argcomplete
+import numpy as np
+
+from src.dataset.cache import EmbeddingCache
+from src.dataset.chunking import STRATEGIES, Chunker
+from src.dataset.corpus import read_text_files
+from src.dataset.profiles import IndexProfile, index_profile
+from src.dataset.vector_store import ElasticsearchStore, VectorStore
+from src.utils import constants
+from src.utils.logging import getLogger
+from src.utils.registry import get_model
+from src.utils.utils import l2_normalize
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+
+class Projection:
+    """Linear projection of the model vectors to fewer dimensions, fitted on the corpus.
+
+    Vectors are projected on the principal components of the corpus vectors,
+    the directions holding most of their energy.  The components are those
+    of the uncentred vectors, as a truncated SVD: centring them would change
+    the angles between vectors, and so the cosine neighbours of a query.
+    Passage and query vectors must both be projected.
+
+    Example:
+        projection = fit_projection(sample_vectors, dims=256)
+        projection.save(projection_path("es0"))
+        vectors = projection.apply(model.encode(texts))
+    """
+
+    def __init__(
+        self,
+        components: np.ndarray,
+        energy: np.ndarray,
+        model_name: str = constants.MAIN_EMBEDDING,
+    ):
+        """
+        Args:
+            components (np.ndarray): principal components as columns, (source_dims, dims).
+            energy (np.ndarray): share of the energy of the corpus vectors along each component.
+            model_name (str): id of the model whose vectors are projected.
+        """
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        self.energy = np.asarray(energy, dtype=np.float32)
+        self.model_name = model_name
+
+    @property
+    def source_dims(self) -> int:
+        return self.components.shape[0]
+
+    @property
+    def dims(self) -> int:
+        return self.components.shape[1]
+
+    def apply(self, vectors: np.ndarray) -> np.ndarray:
+        """Project a vector, or a batch of vectors, in a single matrix product."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.shape[-1] != self.source_dims:
+            raise ValueError(f"Expected vectors of {self.source_dims} dimensions, got {vectors.shape[-1]}")
+        return vectors @ self.components
+
+    def truncate(self, dims: int) -> "Projection":
+        """The projection on the first `dims` components only; PCA projections are nested."""
+        if not 0 < dims <= self.dims:
+            raise ValueError(f"Can't truncate a projection to {self.dims} dimensions to {dims}")
+        return Projection(self.components[:, :dims], self.energy[:dims], self.model_name)
+
+    def save(self, path: Union[str, Path]):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # np.savez appends .npz to names without it.
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                components=self.components,
+                energy=self.energy,
+                model_name=np.array(self.model_name),
+            )
+        logger.info(f"Saved the {self.source_dims} to {self.dims} dimensions projection to {path}.")
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "Projection":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["components"], data["energy"], str(data["model_name"]))
+
+    def __repr__(self) -> str:
+        return (
+            f"Projection({self.model_name}, {self.source_dims} -> {self.dims} dimensions, "
+            f"{self.energy.sum():.1%} of the energy)"
+        )
+
+
+def fit_projection(vectors: np.ndarray, dims: int, model_name: str = constants.MAIN_EMBEDDING) -> Projection:
+    """Fit a projection to `dims` dimensions on a sample of passage vectors.
+
+    The components are the eigenvectors of the second moment matrix of the
+    sample, which only takes a source dims square matrix to compute.
+
+    Args:
+        vectors (np.ndarray): sample of passage vectors, one per row.
+        dims (int): dimensions of the projected vectors.
+        model_name (str): id of the model that encoded them.
+    """
+    vectors = np.asarray(vectors, dtype=np.float64)
+    if not 0 < dims <= vectors.shape[1]:
+        raise ValueError(f"Can't project vectors of {vectors.shape[1]} dimensions to {dims}")
+    if len(vectors) < dims:
+        logger.warning(f"Fitting {dims} components on only {len(vectors)} vectors, the last ones are noise.")
+    eigenvalues, eigenvectors = np.linalg.eigh(vectors.T @ vectors / max(len(vectors), 1))
+    # eigh sorts them by increasing eigenvalue.
+    order = np.argsort(eigenvalues)[::-1][:dims]
+    explained = np.clip(eigenvalues[order], 0, None) / max(eigenvalues.clip(0).sum(), 1e-12)
+    return Projection(eigenvectors[:, order], explained, model_name)
+
+
+def projection_path(index_name: str) -> Path:
+    """Where the projection of an index is saved by default."""
+    return constants.PROJECTION_DIR / f"{index_name}.npz"
+
+
+def load_projection(path: Union[str, Path]) -> Optional[Projection]:
+    """The projection saved at `path`, None if there is none."""
+    if not Path(path).exists():
+        return None
+    projection = Projection.load(path)
+    if projection.model_name != constants.MAIN_EMBEDDING:
+        logger.warning(
+            f"The projection {path} was fitted on {projection.model_name} vectors, "
+            f"not on those of {constants.MAIN_EMBEDDING}."
+        )
+    return projection
+
+
+def index_projection(
+    store: VectorStore, index_name: str, profile: Optional[IndexProfile] = None
+) -> Optional[Projection]:
+    """The projection the vectors of an index must go through, None if they are stored as encoded.
+
+    Indices record the projection they were created for: an ES index in its
+    profile, so an alias finds the one of the index behind it, and local
+    indices in their own metadata, see `VectorStore.projection_file`.  It is
+    never guessed from the projection files saved for an index name.
+
+    Args:
+        store (VectorStore): the store holding the index.
+        index_name (str): index or alias name.
+        profile (IndexProfile): profile of the index when it is already known.
+    """
+    if profile is None and isinstance(store, ElasticsearchStore):
+        profile = index_profile(store.client, index_name)
+    path = profile.projection if profile is not None else store.projection_file(index_name)
+    if not path:
+        return None
+    if not Path(path).exists():
+        raise FileNotFoundError(f"{index_name} stores vectors projected by {path}, not found")
+    return load_projection(path)
+
+
+def indices_projection(store: VectorStore, index_names: List[str]) -> Optional[Projection]:
+    """The projection shared by the vectors of several indices searched together, see `index_projection`.
+
+    A query vector is projected once for all the indices, so they must store
+    vectors of the same projection, or all store them as encoded.
+
+    Args:
+        store (VectorStore): the store holding the indices.
+        index_names (List[str]): index or alias names.
+    """
+    projection = index_projection(store, index_names[0])
+    for index_name in index_names[1:]:
+        other = index_projection(store, index_name)
+        same = (projection is None and other is None) or (
+            projection is not None
+            and other is not None
+            and projection.model_name == other.model_name
+            and np.array_equal(projection.components, other.components)
+        )
+        if not same:
+            raise ValueError(
+                f"{index_names[0]} and {index_name} store vectors of different projections, "
+                "search them separately"
+            )
+    return projection
+
+
+def sample_passages(
+    data_path: str,
+    sample_size: int = constants.PROJECTION_SAMPLE_SIZE,
+    chunker: Optional[Chunker] = None,
+    seed: int = constants.BENCHMARK_SEED,
+) -> List[str]:
+    """A uniform random sample of the passages of the corpus, by reservoir sampling in a single pass."""
+    chunker = chunker or Chunker()
+    rng = random.Random(seed)
+    sample, seen = [], 0
+    for chunk in read_text_files(data_path):
+        for document in chunk:
+            for passage in chunker.split(document.content):
+                seen += 1
+                if len(sample) < sample_size:
+                    sample.append(passage)
+                else:
+                    position = rng.randrange(seen)
+                    if position < sample_size:
+                        sample[position] = passage
+    logger.info(f"Sampled {len(sample)} of the {seen} passages of {data_path}.")
+    return sample
+
+
+def _neighbours(queries: np.ndarray, corpus: np.ndarray, k: int) -> np.ndarray:
+    """Rows of the `k` corpus vectors most cosine similar to each query."""
+    scores = l2_normalize(queries) @ l2_normalize(corpus).T
+    top = np.argpartition(-scores, min(k, scores.shape[1] - 1), axis=1)[:, :k]
+    rows = np.arange(len(queries))[:, None]
+    return np.take_along_axis(top, np.argsort(-scores[rows, top], axis=1, kind="stable"), axis=1)
+
+
+def evaluate_projection(
+    vectors: np.ndarray,
+    dims: Sequence[int],
+    queries: int = constants.PROJECTION_EVAL_QUERIES,
+    k: int = constants.BENCHMARK_K,
+    seed: int = constants.BENCHMARK_SEED,
+    model_name: str = constants.MAIN_EMBEDDING,
+) -> List[Dict[str, float]]:
+    """Recall@k of exact searches in the projected space against the full one, at each target dimension.
+
+    Some sampled passages are held out as queries; the projection is fitted
+    on the others, which are then searched exhaustively for the `k` nearest
+    passages of every query with and without projection.
+
+    Args:
+        vectors (np.ndarray): sample of passage vectors, one per row.
+        dims (Sequence[int]): target dimensions to evaluate.
+        queries (int): passages held out as queries.
+        k (int): neighbours compared.
+        seed (int): seed of the held out queries.
+        model_name (str): id of the model that encoded the passages.
+
+    Returns:
+        per dimension, the recall@k, the share of the energy kept and the
+        float32 bytes per vector.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    order = np.random.default_rng(seed).permutation(len(vectors))
+    queries = min(queries, len(vectors) // 2)
+    query_vectors, corpus = vectors[order[:queries]], vectors[order[queries:]]
+    k = min(k, len(corpus))
+    exact = _neighbours(query_vectors, corpus, k)
+    # The smaller projections are truncations of the largest one.
+    full = fit_projection(corpus, max(dims), model_name)
+
+    report = [{"dims": vectors.shape[1], "recall": 1.0, "energy": 1.0, "bytes": vectors.shape[1] * 4}]
+    for target in sorted(dims, reverse=True):
+        projection = full.truncate(target)
+        found = _neighbours(projection.apply(query_vectors), projection.apply(corpus), k)
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(exact, found)])
+        report.append(
+            {
+                "dims": target,
+                "recall": round(float(recall), 4),
+                "energy": round(float(projection.energy.sum()), 4),
+                "bytes": target * 4,
+            }
+        )
+        logger.info(
+            f"{target} dimensions: recall@{k} {recall:.3f}, " f"{projection.energy.sum():.1%} of the energy."
+        )
+    return report
+
+
+def encode_sample(
+    texts: List[str],
+    model: "SentenceTransformer",
+    cache: Optional[EmbeddingCache] = None,
+    batch_size: int = constants.ENCODE_BATCH_SIZE,
+) -> np.ndarray:
+    """Encode sampled passages as ingestion does, through the embedding cache if given."""
+    if cache is not None:
+        return cache.encode(texts, lambda misses: model.encode(misses, batch_size=batch_size))
+    return model.encode(texts, batch_size=batch_size)
+
+
+if __name__ == "__main__":
+
+    # Get the parser arguments
+    parser = argparse.ArgumentParser(
+        description="script to fit and evaluate a projection of the stored vectors to fewer dimensions.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=textwrap.dedent(
+            ''''
+        Current arguments are:
+
+        --index_name="es0"
+        --data_path="/data/sample_data"
+        --dims=256
+        --eval_dims="64,128,256,384"
+        --output=".cache/projections/es0.npz"
+        --sample_size=20000
+        --queries=500
+        --k=10
+        --seed=0
+        --batch_size=32
+        --cache_dir=".cache/embeddings"
+        --chunk_strategy="none"
+
+        Example Usage
+        -------------
+        python %(prog)s --index_name es0 --data_path /data/sample_data --eval_dims 64,128,256,384
+        python %(prog)s --index_name es0 --data_path /data/sample_data --dims 256
+        python %(prog)s --index_name es0 --data_path /data/sample_data --dims 256 --chunk_strategy max_tokens
+
+        '''
+        ),
+    )
+    parser.add_argument('--index_name', help='index the projection is fitted for.', type=str, required=True)
+    parser.add_argument('--data_path', help='data path that contains documents.', type=str, required=True)
+    parser.add_argument('--dims', help='fit and save a projection to this many dimensions.', type=int)
+    parser.add_argument(
+        '--eval_dims',
+        help='comma separated dimensions at which to report the recall lost.',
+        type=lambda value: [int(dims) for dims in value.split(",")],
+    )
+    parser.add_argument(
+        '--output', help='projection file, the default one of the index if not given.', type=str
+    )
+    parser.add_argument(
+        '--sample_size',
+        help='passages the projection is fitted on.',
+        type=int,
+        default=constants.PROJECTION_SAMPLE_SIZE,
+    )
+    parser.add_argument(
+        '--queries',
+        help='sampled passages held out as queries by the evaluation.',
+        type=int,
+        default=constants.PROJECTION_EVAL_QUERIES,
+    )
+    parser.add_argument(
+        '--k', help='neighbours compared by the evaluation.', type=int, default=constants.BENCHMARK_K
+    )
+    parser.add_argument('--seed', help='seed of the sampling.', type=int, default=constants.BENCHMARK_SEED)
+    parser.add_argument(
+        '--batch_size',
+        help='batch size of the model encoding.',
+        type=int,
+        default=constants.ENCODE_BATCH_SIZE,
+    )
+    parser.add_argument('--cache_dir', help='embedding cache folder, no cache if not given.', type=str)
+    parser.add_argument(
+        '--chunk_strategy',
+        help='how documents are split into passages, as at ingestion.',
+        choices=STRATEGIES,
+        default=constants.CHUNK_STRATEGY,
+    )
+    parser.add_argument('--chunk_size', help='sentences or tokens per passage.', type=int)
+    parser.add_argument(
+        '--chunk_overlap', help='sentences or tokens shared by consecutive passages.', type=int
+    )
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+    if not args.dims and not args.eval_dims:
+        parser.error("nothing to do, give --dims, --eval_dims or both")
+
+    model = get_model()
+    cache = EmbeddingCache(args.cache_dir, constants.MAIN_EMBEDDING) if args.cache_dir else None
+    try:
+        chunker = Chunker(
+            args.chunk_strategy,
+            tokenizer=model.tokenizer,
+            chunk_size=args.chunk_size,
+            overlap=args.chunk_overlap,
+        )
+        texts = sample_passages(args.data_path, args.sample_size, chunker, seed=args.seed)
+        vectors = encode_sample(texts, model, cache, batch_size=args.batch_size)
+        if args.eval_dims:
+            report = evaluate_projection(
+                vectors, args.eval_dims, queries=args.queries, k=args.k, seed=args.seed
+            )
+            print(json.dumps(report, indent=2))
+        if args.dims:
+            projection = fit_projection(vectors, args.dims)
+            projection.save(args.output or projection_path(args.index_name))
+            logger.info(
+                f"Fitted {projection}; create the index again to store vectors of {args.dims} dimensions."
+            )
+    except Exception as e:
+        logger.error(f"Could not fit the projection due to error {e}")
+        print(traceback.format_exc())
+    finally:
+        if cache is not None:
+            cache.close()
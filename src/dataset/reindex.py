@@ -0,0 +1,420 @@
+import argparse
+import os
+import re
+import textwrap
+import time
+import traceback
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional
+
+import argcomplete
+
+from src.dataset.cache import EmbeddingCache
+from src.dataset.chunking import STRATEGIES
+from src.dataset.embeddings import local_text_embedding
+from src.dataset.manifest import Manifest
+from src.dataset.profiles import PROFILES, IndexProfile, get_profile
+from src.dataset.projection import load_projection, projection_path
+from src.dataset.vector_store import ElasticsearchStore
+from src.utils import constants
+from src.utils.logging import getLogger
+from src.utils.registry import get_es_client, get_model
+
+if TYPE_CHECKING:
+    from elasticsearch import Elasticsearch
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+
+def versioned_name(alias: str) -> str:
+    """Name of a new version of the index behind an alias, e.g. es0-20240131120000."""
+    return f"{alias}-{time.strftime('%Y%m%d%H%M%S', time.gmtime())}"
+
+
+def index_versions(client: "Elasticsearch", alias: str) -> List[str]:
+    """Versioned indices of an alias, oldest first."""
+    pattern = re.compile(rf"^{re.escape(alias)}-\d{{14}}$")
+    return sorted(name for name in client.indices.get(index=f"{alias}-*") if pattern.match(name))
+
+
+def alias_indices(client: "Elasticsearch", alias: str) -> List[str]:
+    """Indices the alias currently points to."""
+    if not client.indices.exists_alias(name=alias):
+        return []
+    return sorted(client.indices.get_alias(name=alias))
+
+
+def create_versioned_index(
+    client: "Elasticsearch", alias: str, profile: IndexProfile, dims: int, index_name: Optional[str] = None
+) -> str:
+    """Create a new version of the index behind an alias, set up for bulk loading.
+
+    It has no replicas and no refreshes until `finalize_index`, so the load
+    writes every document once and builds segments without refresh churn.
+
+    Returns:
+        the name of the new index.
+    """
+    index_name = index_name or versioned_name(alias)
+    settings = dict(profile.settings(), number_of_replicas=0, refresh_interval="-1")
+    client.indices.create(index=index_name, settings=settings, mappings=profile.mappings(dims))
+    logger.info(f"Created {index_name} for {alias} with the {profile.name} profile, set up for bulk loading.")
+    return index_name
+
+
+def finalize_index(
+    client: "Elasticsearch",
+    index_name: str,
+    profile: IndexProfile,
+    max_num_segments: int = constants.REINDEX_MAX_SEGMENTS,
+    health_timeout: str = constants.REINDEX_HEALTH_TIMEOUT,
+):
+    """Make a bulk loaded index ready to serve.
+
+    Its segments are force-merged, which leaves fewer and larger HNSW
+    graphs to search, then the replicas and refresh interval of the profile
+    are restored and the replicas given time to recover.
+
+    Args:
+        client (Elasticsearch): elasticsearch client.
+        index_name (str): the bulk loaded index.
+        profile (IndexProfile): profile the index was created with.
+        max_num_segments (int): segments per shard after the merge.
+        health_timeout (str): how long to wait for the replicas to be allocated.
+    """
+    client.indices.refresh(index=index_name)
+    start = time.perf_counter()
+    # Merging a large index takes longer than the default request timeout.
+    client.options(request_timeout=constants.REINDEX_MERGE_TIMEOUT).indices.forcemerge(
+        index=index_name, max_num_segments=max_num_segments
+    )
+    logger.info(
+        f"Merged {index_name} into {max_num_segments} segment(s) per shard "
+        f"in {time.perf_counter() - start:.1f}s."
+    )
+    client.indices.put_settings(
+        index=index_name,
+        settings={"number_of_replicas": profile.replicas, "refresh_interval": profile.refresh_interval},
+    )
+    try:
+        health = client.cluster.health(index=index_name, wait_for_status="green", timeout=health_timeout)
+        timed_out = health.get("timed_out", False)
+    except Exception as e:
+        logger.debug(e)
+        timed_out = True
+    if timed_out:
+        logger.warning(
+            f"The replicas of {index_name} were not all allocated within {health_timeout}, "
+            "it will serve from its primaries until they are."
+        )
+
+
+def swap_alias(
+    client: "Elasticsearch", alias: str, index_name: str, replace_index: bool = False
+) -> List[str]:
+    """Point the alias to `index_name` only, in a single atomic update.
+
+    Searches through the alias move from the old indices to the new one
+    without ever seeing both or none.
+
+    Args:
+        client (Elasticsearch): elasticsearch client.
+        alias (str): the read alias searches target.
+        index_name (str): the index it should point to.
+        replace_index (bool): if a concrete index has the alias name, as
+            indices created before aliases were used do, delete it in the
+            same update; refused otherwise.
+
+    Returns:
+        the indices the alias pointed to before.
+    """
+    previous = alias_indices(client, alias)
+    actions = [{"remove": {"index": name, "alias": alias}} for name in previous if name != index_name]
+    if not previous and client.indices.exists(index=alias):
+        if not replace_index:
+            raise ValueError(
+                f"{alias} is an index, not an alias; "
+                f"pass replace_index to delete it in favour of {index_name}"
+            )
+        actions.append({"remove_index": {"index": alias}})
+    actions.append({"add": {"index": index_name, "alias": alias}})
+    client.indices.update_aliases(actions=actions)
+    logger.info(f"Alias {alias} now points to {index_name} instead of {previous or 'nothing'}.")
+    return previous
+
+
+def delete_old_versions(client: "Elasticsearch", alias: str, keep: int = constants.REINDEX_KEEP) -> List[str]:
+    """Delete the versions of an alias it doesn't point to.
+
+    The `keep` most recent of them are kept for rollback.
+    """
+    current = set(alias_indices(client, alias))
+    old = [name for name in index_versions(client, alias) if name not in current]
+    deleted = old[: max(len(old) - keep, 0)]
+    for name in deleted:
+        client.indices.delete(index=name)
+        logger.info(f"Deleted the old version {name} of {alias}.")
+    return deleted
+
+
+def rollback(client: "Elasticsearch", alias: str) -> str:
+    """Point the alias back to the version created before the current one."""
+    current = alias_indices(client, alias)
+    versions = index_versions(client, alias)
+    older = [name for name in versions if current and name < min(current)]
+    if not older:
+        raise ValueError(f"No version of {alias} older than {current} to roll back to")
+    swap_alias(client, alias, older[-1])
+    return older[-1]
+
+
+def reindex(
+    client: "Elasticsearch",
+    alias: str,
+    data_path: str,
+    profile: IndexProfile,
+    model=None,
+    replace_index: bool = False,
+    keep: int = constants.REINDEX_KEEP,
+    max_num_segments: int = constants.REINDEX_MAX_SEGMENTS,
+    health_timeout: str = constants.REINDEX_HEALTH_TIMEOUT,
+    **ingest_options,
+) -> str:
+    """Rebuild the index behind an alias without disturbing the searches it serves.
+
+    1. create a new version of the index with bulk-load settings,
+    2. ingest the corpus into it with `local_text_embedding`,
+    3. force-merge it and restore its replicas and refreshes,
+    4. swap the alias to it atomically, then delete the versions beyond `keep`.
+
+    The live index takes none of the load or merges, and searches through
+    the alias switch from the old version to the complete new one at once.
+    If a step fails, the new version is deleted and the alias left as is.
+    The manifest the new version was built with becomes the manifest of the
+    alias, so `embeddings.py --sync` on the alias carries on from it.
+
+    Args:
+        client (Elasticsearch): elasticsearch client.
+        alias (str): the read alias searches target.
+        data_path (str): folder of the corpus.
+        profile (IndexProfile): settings and mappings of the new version, and
+            the projection its vectors go through if any.
+        model (SentenceTransformer): the model encoding the passages; the shared model by default.
+        replace_index (bool): replace a concrete index named like the alias, see `swap_alias`.
+        keep (int): previous versions kept for rollback.
+        max_num_segments (int): segments per shard after the merge.
+        health_timeout (str): how long to wait for the replicas of the new version.
+        ingest_options: other arguments of `local_text_embedding`.
+
+    Returns:
+        the name of the new version.
+    """
+    # Refused by `swap_alias`, checked before paying for the ingestion.
+    if (
+        not replace_index
+        and client.indices.exists(index=alias)
+        and not client.indices.exists_alias(name=alias)
+    ):
+        raise ValueError(f"{alias} is an index, not an alias; pass replace_index to replace it")
+    model = model if model is not None else get_model()
+    projection = load_projection(profile.projection) if profile.projection else None
+    dims = projection.dims if projection is not None else model.get_sentence_embedding_dimension()
+    index_name = create_versioned_index(client, alias, profile, dims)
+    manifest_path = constants.MANIFEST_DIR / f"{index_name}.sqlite"
+    manifest = Manifest(manifest_path)
+    manifest_open = True
+    try:
+        indexed = local_text_embedding(
+            ElasticsearchStore(client, close_client=False),
+            index_name,
+            data_path,
+            model=model,
+            manifest=manifest,
+            profile=profile,
+            projection=projection,
+            **ingest_options,
+        )
+        manifest.close()
+        manifest_open = False
+        logger.info(f"Ingested {indexed} documents into {index_name}.")
+        finalize_index(client, index_name, profile, max_num_segments, health_timeout)
+        swap_alias(client, alias, index_name, replace_index=replace_index)
+    except BaseException:
+        if manifest_open:
+            manifest.close()
+        Path(manifest_path).unlink(missing_ok=True)
+        client.indices.delete(index=index_name, ignore_unavailable=True)
+        logger.error(f"Reindexing {alias} failed, deleted {index_name} and kept the alias as it was.")
+        raise
+    os.replace(manifest_path, constants.MANIFEST_DIR / f"{alias}.sqlite")
+    delete_old_versions(client, alias, keep)
+    return index_name
+
+
+if __name__ == "__main__":
+
+    # Get the parser arguments
+    parser = argparse.ArgumentParser(
+        description="script to rebuild the index behind a search alias without downtime.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=textwrap.dedent(
+            ''''
+        Current arguments are:
+
+        --alias="es0"
+        --data_path="/data/sample_data"
+        --profile="default"
+        --shards=2
+        --replicas=1
+        --m=16
+        --ef_construction=100
+        --batch_size=32
+        --bulk_chunk_size=500
+        --bulk_inflight=1
+        --cache_dir=".cache/embeddings"
+        --chunk_strategy="none"
+        --max_num_segments=1
+        --keep=1
+        --health_timeout="10m"
+        --projection=".cache/projections/es0.npz"
+        --replace_index
+        --rollback
+        --cleanup
+
+        Example Usage
+        -------------
+        python %(prog)s --alias es0 --data_path /data/sample_data
+        python %(prog)s --alias es0 --data_path /data/sample_data --profile compact --bulk_inflight 4
+        python %(prog)s --alias es0 --data_path /data/sample_data --replace_index
+        python %(prog)s --alias es0 --rollback
+
+        '''
+        ),
+    )
+    parser.add_argument('--alias', help='read alias the searches target.', type=str, required=True)
+    parser.add_argument('--data_path', help='data path that contains documents.', type=str)
+    parser.add_argument(
+        '--profile',
+        help='vector storage and index settings profile of the new version.',
+        choices=list(PROFILES),
+        default="default",
+    )
+    parser.add_argument('--shards', help='number of primary shards, overrides the profile.', type=int)
+    parser.add_argument('--replicas', help='number of replicas, overrides the profile.', type=int)
+    parser.add_argument('--m', help='HNSW neighbours per node, overrides the profile.', type=int)
+    parser.add_argument(
+        '--ef_construction', help='HNSW candidates explored while indexing, overrides the profile.', type=int
+    )
+    parser.add_argument(
+        '--batch_size',
+        help='batch size of the model encoding.',
+        type=int,
+        default=constants.ENCODE_BATCH_SIZE,
+    )
+    parser.add_argument(
+        '--bulk_chunk_size',
+        help='maximum number of documents per bulk request.',
+        type=int,
+        default=constants.BULK_CHUNK_SIZE,
+    )
+    parser.add_argument(
+        '--bulk_inflight',
+        help='number of bulk requests sent concurrently.',
+        type=int,
+        default=constants.BULK_INFLIGHT,
+    )
+    parser.add_argument('--cache_dir', help='embedding cache folder, no cache if not given.', type=str)
+    parser.add_argument(
+        '--chunk_strategy',
+        help='how documents are split into passages.',
+        choices=STRATEGIES,
+        default=constants.CHUNK_STRATEGY,
+    )
+    parser.add_argument('--chunk_size', help='sentences or tokens per passage.', type=int)
+    parser.add_argument(
+        '--chunk_overlap', help='sentences or tokens shared by consecutive passages.', type=int
+    )
+    parser.add_argument(
+        '--max_num_segments',
+        help='segments per shard after the force merge.',
+        type=int,
+        default=constants.REINDEX_MAX_SEGMENTS,
+    )
+    parser.add_argument(
+        '--keep',
+        help='previous versions kept for rollback.',
+        type=int,
+        default=constants.REINDEX_KEEP,
+    )
+    parser.add_argument(
+        '--health_timeout',
+        help='how long to wait for the replicas of the new version.',
+        type=str,
+        default=constants.REINDEX_HEALTH_TIMEOUT,
+    )
+    parser.add_argument(
+        '--projection',
+        help='projection of the vectors, the one fitted for the alias if any by default.',
+        type=str,
+    )
+    parser.add_argument(
+        '--replace_index',
+        help='delete a concrete index named like the alias when swapping.',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--rollback', help='point the alias back to the previous version and exit.', action='store_true'
+    )
+    parser.add_argument(
+        '--cleanup', help='only delete the versions beyond --keep and exit.', action='store_true'
+    )
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+
+    client = get_es_client()
+    if args.rollback:
+        logger.info(f"Rolled {args.alias} back to {rollback(client, args.alias)}.")
+    elif args.cleanup:
+        delete_old_versions(client, args.alias, args.keep)
+    else:
+        if not args.data_path:
+            parser.error("--data_path is required to reindex")
+        projection_file = Path(args.projection or projection_path(args.alias))
+        if args.projection and not projection_file.exists():
+            parser.error(f"no projection at {args.projection}")
+        profile = get_profile(
+            args.profile,
+            m=args.m,
+            ef_construction=args.ef_construction,
+            shards=args.shards,
+            replicas=args.replicas,
+            projection=str(projection_file.resolve()) if projection_file.exists() else None,
+        )
+        cache = None
+        if args.cache_dir:
+            cache = EmbeddingCache(args.cache_dir, constants.MAIN_EMBEDDING)
+        try:
+            reindex(
+                client,
+                args.alias,
+                args.data_path,
+                profile,
+                replace_index=args.replace_index,
+                keep=args.keep,
+                max_num_segments=args.max_num_segments,
+                health_timeout=args.health_timeout,
+                batch_size=args.batch_size,
+                bulk_chunk_size=args.bulk_chunk_size,
+                bulk_inflight=args.bulk_inflight,
+                cache=cache,
+                chunk_strategy=args.chunk_strategy,
+                chunk_size=args.chunk_size,
+                chunk_overlap=args.chunk_overlap,
+            )
+        except Exception as e:
+            logger.error(f"Could not reindex {args.alias} due to error {e}")
+            print(traceback.format_exc())
+        finally:
+            if cache is not None:
+                cache.close()
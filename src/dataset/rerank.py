@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+
+from src.utils import constants
+from src.utils.logging import getLogger
+from src.utils.utils import l2_normalize
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+RERANK_METHODS = ("exact", "cross_encoder")
+
+# Number of recent queries the reranking statistics are computed over.
+_STATS_WINDOW = 10_000
+
+
+class Reranker:
+    """Re-score the candidates of an approximate kNN search.
+
+    The kNN search fetches `depth` candidate passages from the ANN index,
+    which can then be cheap (a quantized index, a low `num_candidates`), and
+    the candidates are ranked again by:
+
+    - "exact": the cosine similarity of the query and the float32 passage
+      vectors, as a single matrix-vector product over all the candidates.
+      Vectors are read from `_source`; passages stored without them are
+      re-encoded, through the embedding cache when there is one.
+    - "cross_encoder": a cross-encoder scoring every (query, passage text) pair.
+
+    Every call also records what reranking bought: the share of the reranked
+    top k the ANN ranking had missed, and the time it added.
+
+    Example:
+        reranker = Reranker("exact", depth=100)
+        results = perform_search(query, client, "es0", model, reranker=reranker)
+        logger.info(reranker.stats())
+    """
+
+    def __init__(
+        self,
+        method: str = constants.RERANK_METHOD,
+        depth: int = constants.RERANK_DEPTH,
+        cross_encoder: str = constants.CROSS_ENCODER,
+    ):
+        """
+        Args:
+            method (str): one of `RERANK_METHODS`.
+            depth (int): number of candidate passages fetched and re-scored.
+            cross_encoder (str): name or path of the cross-encoder model.
+        """
+        if method not in RERANK_METHODS:
+            raise ValueError(f"Unknown rerank method {method}, expected one of {RERANK_METHODS}")
+        self.method = method
+        self.depth = depth
+        self.model = None
+        if method == "cross_encoder":
+            # Only loaded when used, it is a second transformer in memory.
+            from sentence_transformers import CrossEncoder
+
+            self.model = CrossEncoder(cross_encoder)
+        self._lock = threading.Lock()
+        self._queries = 0
+        self._latencies_ms = deque(maxlen=_STATS_WINDOW)
+        self._recalls = deque(maxlen=_STATS_WINDOW)
+
+    @property
+    def needs_vectors(self) -> bool:
+        """Whether the candidates must be fetched with their vectors."""
+        return self.method == "exact"
+
+    def _scores(
+        self, query: str, query_emb, hits: List[dict], encode: Callable[[List[str]], np.ndarray]
+    ) -> np.ndarray:
+        texts = [hit["_source"].get("sentence_text") or "" for hit in hits]
+        if self.method == "cross_encoder":
+            return np.asarray(self.model.predict([(query, text) for text in texts]), dtype=np.float32)
+        vectors = [hit["_source"].get("sentence_embedding") for hit in hits]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            for i, vector in zip(missing, encode([texts[i] for i in missing])):
+                vectors[i] = vector
+        # Same scale as the ES scores of cosine and dot_product indices.
+        return (1 + l2_normalize(np.asarray(vectors, dtype=np.float32)) @ l2_normalize(query_emb)) / 2
+
+    def rescore(
+        self,
+        query: str,
+        query_emb,
+        hits: Sequence[dict],
+        k: int,
+        encode: Callable[[List[str]], np.ndarray],
+    ) -> List[dict]:
+        """Rank candidate passages by their new scores.
+
+        Args:
+            query (str): the search query.
+            query_emb: the query vector.
+            hits (Sequence[dict]): passage hits of the kNN search, in ANN order.
+            k (int): number of passages the caller keeps, the ANN and the
+                reranked top k are compared on it.
+            encode (Callable): encodes passage texts whose vectors aren't in `_source`.
+
+        Returns:
+            copies of the hits with their new `_score`, by decreasing score.
+        """
+        if not hits:
+            return []
+        start = time.perf_counter()
+        scores = self._scores(query, query_emb, hits, encode)
+        # Ties keep the ANN order.
+        order = np.argsort(-scores, kind="stable")
+        reranked = [dict(hits[i], _score=float(scores[i])) for i in order]
+        latency_ms = (time.perf_counter() - start) * 1000
+
+        top = min(k, len(hits))
+        recall = len(set(order[:top]) & set(range(top))) / top
+        with self._lock:
+            self._queries += 1
+            self._latencies_ms.append(latency_ms)
+            self._recalls.append(recall)
+        return reranked
+
+    def stats(self) -> Dict[str, float]:
+        """Recall of the ANN top k against the reranked one, and reranking latency, over the recent queries.
+
+        `recall_gain_mean` is the share of the reranked top k that the ANN
+        ranking alone would have missed.
+        """
+        with self._lock:
+            latencies = np.array(self._latencies_ms, dtype=np.float64)
+            recalls = np.array(self._recalls, dtype=np.float64)
+            queries = self._queries
+        if not len(latencies):
+            return {"method": self.method, "depth": self.depth, "queries": 0}
+        return {
+            "method": self.method,
+            "depth": self.depth,
+            "queries": queries,
+            "ann_recall_mean": float(recalls.mean()),
+            "recall_gain_mean": float(1 - recalls.mean()),
+            "latency_ms_mean": float(latencies.mean()),
+            "latency_ms_p50": float(np.percentile(latencies, 50)),
+            "latency_ms_p99": float(np.percentile(latencies, 99)),
+        }
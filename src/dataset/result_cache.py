@@ -0,0 +1,266 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.dataset.cache import normalize_text
+from src.dataset.search import SearchResult
+from src.utils import constants
+from src.utils.logging import getLogger
+from src.utils.utils import l2_normalize
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+# Number of query vectors the semantic tier starts with; it doubles when full.
+_INITIAL_ROWS = 1024
+
+
+def _digest(value) -> str:
+    return hashlib.blake2b(
+        json.dumps(value, sort_keys=True, default=str).encode("utf-8"), digest_size=20
+    ).hexdigest()
+
+
+@dataclass
+class _Entry:
+    results: List[SearchResult]
+    scope: str
+    # ingestion generations of the searched indices when the search started
+    generations: tuple
+    expires: float
+    nbytes: int
+    # row of the query vector in the semantic tier
+    row: Optional[int] = None
+
+
+class ResultCache:
+    """In-memory cache of search results, in front of `search_hits`.
+
+    Results are cached under the normalized query text and everything else
+    that shapes them: indices, k, aggregation and search options.  Entries
+    are evicted least recently used first once `max_entries` or `max_bytes`
+    is reached, expire after `ttl` seconds, and are dropped when one of their
+    indices is ingested into again, which the stores record as a new
+    ingestion generation.
+
+    With a `semantic_threshold`, a query missing the exact tier is encoded
+    and served the results of a cached query of the same scope whose vector
+    is at least that cosine similar.  First pages only: a page cursor
+    belongs to the ranking of its own query.
+
+    Example:
+        result_cache = ResultCache(generation=store.generation, semantic_threshold=0.97)
+        search = lambda query_emb: search_hits(query, store, ["es0"], model, query_emb=query_emb)
+        results = result_cache.search(query, ["es0"], 5, "max", {}, search, encode)
+        logger.info(result_cache.stats())
+    """
+
+    def __init__(
+        self,
+        max_entries: int = constants.RESULT_CACHE_MAX_ENTRIES,
+        ttl: float = constants.RESULT_CACHE_TTL,
+        max_bytes: int = constants.RESULT_CACHE_MAX_BYTES,
+        semantic_threshold: Optional[float] = None,
+        generation: Optional[Callable[[str], Optional[str]]] = None,
+        check_interval: float = constants.RESULT_CACHE_CHECK_INTERVAL,
+    ):
+        """
+        Args:
+            max_entries (int): maximum number of cached searches.
+            ttl (float): seconds a search stays cached.
+            max_bytes (int): maximum estimated size of the cached results.
+            semantic_threshold (float): cosine similarity above which a
+                cached query answers a new one; no semantic tier if not given.
+            generation (Callable): ingestion generation of an index, usually
+                `VectorStore.generation`; entries are never invalidated without it.
+            check_interval (float): seconds the generation of an index is
+                trusted before it is read again.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.semantic_threshold = semantic_threshold
+        self._generation = generation
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._nbytes = 0
+        # index name -> (generation, time it was read)
+        self._generations: Dict[str, Tuple[Optional[str], float]] = {}
+        # Query vectors of the semantic tier, with the scope and key of each row.
+        self._vectors: Optional[np.ndarray] = None
+        self._row_scopes = np.zeros(0, dtype=np.int64)
+        self._row_keys: List[Optional[str]] = []
+        self._free_rows: List[int] = []
+        self._scope_ids: Dict[str, int] = {}
+        self._counters = dict.fromkeys(
+            ["lookups", "hits", "semantic_hits", "misses", "evictions", "expirations", "invalidations"], 0
+        )
+
+    @staticmethod
+    def keys(
+        query: str, index_names: Sequence[str], k: int, aggregation: str, options: dict
+    ) -> Tuple[str, str]:
+        """(key, scope) of a search: the scope covers everything but the query text."""
+        scope = _digest({"index": list(index_names), "k": k, "aggregation": aggregation, "options": options})
+        return _digest([scope, normalize_text(query).casefold()]), scope
+
+    def _generations_of(self, index_names: Sequence[str]) -> tuple:
+        if self._generation is None:
+            return ()
+        now = time.monotonic()
+        generations = []
+        for index_name in index_names:
+            generation, checked = self._generations.get(index_name, (None, float("-inf")))
+            if now - checked >= self.check_interval:
+                generation = self._generation(index_name)
+                self._generations[index_name] = (generation, now)
+            generations.append(generation)
+        return tuple(generations)
+
+    def _drop(self, key: str, counter: Optional[str] = None):
+        entry = self._entries.pop(key)
+        self._nbytes -= entry.nbytes
+        if entry.row is not None:
+            self._row_scopes[entry.row] = -1
+            self._row_keys[entry.row] = None
+            self._free_rows.append(entry.row)
+        if counter is not None:
+            self._counters[counter] += 1
+
+    def _live(self, key: str, generations: tuple) -> Optional[_Entry]:
+        """The entry of a key if it is still valid, dropping it otherwise."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires < time.monotonic():
+            self._drop(key, "expirations")
+            return None
+        if entry.generations != generations:
+            self._drop(key, "invalidations")
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _nearest(self, scope: str, query_emb: np.ndarray, generations: tuple) -> Optional[_Entry]:
+        """The entry of the most similar cached query of the scope, if similar enough."""
+        scope_id = self._scope_ids.get(scope)
+        if scope_id is None or self._vectors is None:
+            return None
+        rows = np.flatnonzero(self._row_scopes == scope_id)
+        if not len(rows):
+            return None
+        similarities = self._vectors[rows] @ query_emb
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.semantic_threshold:
+            return None
+        return self._live(self._row_keys[rows[best]], generations)
+
+    def _add_vector(self, key: str, scope: str, query_emb: np.ndarray) -> int:
+        if self._vectors is None:
+            self._vectors = np.zeros((_INITIAL_ROWS, len(query_emb)), dtype=np.float32)
+            self._row_scopes = np.full(_INITIAL_ROWS, -1, dtype=np.int64)
+            self._row_keys = [None] * _INITIAL_ROWS
+            self._free_rows = list(range(_INITIAL_ROWS - 1, -1, -1))
+        if not self._free_rows:
+            rows = len(self._row_keys)
+            self._vectors = np.concatenate([self._vectors, np.zeros_like(self._vectors)])
+            self._row_scopes = np.concatenate([self._row_scopes, np.full(rows, -1, dtype=np.int64)])
+            self._row_keys.extend([None] * rows)
+            self._free_rows = list(range(2 * rows - 1, rows - 1, -1))
+        row = self._free_rows.pop()
+        self._vectors[row] = query_emb
+        self._row_scopes[row] = self._scope_ids.setdefault(scope, len(self._scope_ids))
+        self._row_keys[row] = key
+        return row
+
+    def _put(self, key: str, scope: str, results: List[SearchResult], generations: tuple, query_emb):
+        if key in self._entries:
+            self._drop(key)
+        nbytes = len(json.dumps([asdict(result) for result in results], default=str))
+        entry = _Entry(results, scope, generations, time.monotonic() + self.ttl, nbytes)
+        if query_emb is not None:
+            entry.row = self._add_vector(key, scope, query_emb)
+            entry.nbytes += query_emb.nbytes
+        self._entries[key] = entry
+        self._nbytes += entry.nbytes
+        while self._entries and (len(self._entries) > self.max_entries or self._nbytes > self.max_bytes):
+            self._drop(next(iter(self._entries)), "evictions")
+
+    def search(
+        self,
+        query: str,
+        index_names: Sequence[str],
+        k: int,
+        aggregation: str,
+        options: dict,
+        search: Callable[[Optional[np.ndarray]], List[SearchResult]],
+        encode: Optional[Callable[[str], np.ndarray]] = None,
+    ) -> List[SearchResult]:
+        """Cached results of a search, running it on a miss.
+
+        Args:
+            query (str): the search query.
+            index_names (Sequence[str]): indices searched.
+            k (int): number of results.
+            aggregation (str): how passages are aggregated.
+            options (dict): the other search options.
+            search (Callable): runs the search, given the query vector when
+                the semantic tier already encoded it.
+            encode (Callable): encodes the query for the semantic tier.
+        """
+        key, scope = self.keys(query, index_names, k, aggregation, options)
+        try:
+            generations = self._generations_of(index_names)
+        except Exception as e:
+            logger.warning(f"Could not read the ingestion generation of {index_names}, not caching: {e}")
+            return search(None)
+
+        with self._lock:
+            self._counters["lookups"] += 1
+            entry = self._live(key, generations)
+            if entry is not None:
+                self._counters["hits"] += 1
+                return list(entry.results)
+
+        query_emb = None
+        if self.semantic_threshold is not None and encode is not None and not options.get("search_after"):
+            query_emb = l2_normalize(encode(query))
+            with self._lock:
+                entry = self._nearest(scope, query_emb, generations)
+                if entry is not None:
+                    self._counters["semantic_hits"] += 1
+                    return list(entry.results)
+
+        with self._lock:
+            self._counters["misses"] += 1
+        results = search(query_emb)
+        with self._lock:
+            self._put(key, scope, results, generations, query_emb)
+        return results
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            for key in list(self._entries):
+                self._drop(key)
+
+    def stats(self) -> Dict[str, float]:
+        """Hit rates and size of the cache."""
+        with self._lock:
+            counters = dict(self._counters)
+            entries, nbytes = len(self._entries), self._nbytes
+        lookups = counters["lookups"] or 1
+        return {
+            "entries": entries,
+            "bytes": nbytes,
+            **counters,
+            "hit_rate": (counters["hits"] + counters["semantic_hits"]) / lookups,
+            "semantic_hit_rate": counters["semantic_hits"] / lookups,
+        }
@@ -1,56 +1,664 @@
 import argparse
 import os
-import readline
+import re
 import textwrap
 import traceback
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Union
 
 import argcomplete
-from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
 
+from src.dataset.cache import EmbeddingCache
+from src.dataset.fusion import FUSION_METHODS, fuse, hit_key, passage_key
+from src.dataset.projection import Projection, index_projection
+from src.dataset.rerank import RERANK_METHODS, Reranker
+from src.dataset.vector_store import BACKENDS, VectorStore, as_vector_store, open_store
 from src.utils import constants
 from src.utils.logging import getLogger
+from src.utils.metrics import timed, timer
+from src.utils.registry import get_model, start_log_watcher
+from src.utils.utils import l2_normalize
 
-# Enable command history
-readline.parse_and_bind("tab: complete")
+if TYPE_CHECKING:
+    from elasticsearch import Elasticsearch
+    from sentence_transformers import SentenceTransformer
 
 # Instantiate the logger
 logger = getLogger(__name__)
 
+AGGREGATIONS = ("max", "sum", "none")
+SEARCH_MODES = ("knn", "lexical", "hybrid")
+_RANGE_OPERATORS = {">=": "gte", "<=": "lte", ">": "gt", "<": "lt"}
 
-def perform_search(
-    query: str, client: Elasticsearch, index_name: str, model=SentenceTransformer(constants.MAIN_EMBEDDING)
-):
-    # Perform transformations on the input query
-    # Example transformation: Convert query to uppercase
-    query_emb = model.encode(query)
-
-    # results = query
-    res = client.search(
-        knn={"field": "sentence_embedding", "query_vector": query_emb, "k": 5, "num_candidates": 5},
-        index=index_name,
-    )
 
-    # Generate results based on the search query
-    results = [
-        f'Result 1: {res["hits"]["hits"][0]["_source"]["sentence_text"]}',
-        f'score: {res["hits"]["hits"][0]["_score"]}',
-        f'Result 2: {res["hits"]["hits"][1]["_source"]["sentence_text"]}',
-        f'score: {res["hits"]["hits"][1]["_score"]}',
-        f'Result 3: {res["hits"]["hits"][2]["_source"]["sentence_text"]}',
-        f'score: {res["hits"]["hits"][2]["_score"]}',
+def aggregate_passages(hits: List[dict], size: int, how: str = "max", inner_hits: int = 3) -> List[dict]:
+    """Collapse passage hits into document hits.
+
+    Args:
+        hits (List[dict]): passage hits sorted by decreasing score.
+        size (int): number of documents to return.
+        how (str): "max" scores a document by its best passage, "sum" by the
+            sum of the scores of its passages.
+        inner_hits (int): number of best passages kept under each document.
+
+    Returns:
+        document hits shaped like collapsed ES hits, with their passages
+        under `inner_hits.passages`.
+    """
+    documents = {}
+    for hit in hits:
+        parent_id = hit["_source"].get("parent_id", hit["_id"])
+        documents.setdefault(parent_id, []).append(hit)
+
+    def score(passages):
+        scores = [passage["_score"] for passage in passages]
+        return sum(scores) if how == "sum" else max(scores)
+
+    ranked = sorted(documents.items(), key=lambda item: score(item[1]), reverse=True)[:size]
+    return [
+        {
+            "_id": parent_id,
+            "_score": score(passages),
+            "_source": passages[0]["_source"],
+            "inner_hits": {"passages": {"hits": {"hits": passages[:inner_hits]}}},
+        }
+        for parent_id, passages in ranked
     ]
 
-    # Return the results
+
+def metadata_filters(filters: Union[Dict[str, object], List[dict], None]) -> List[dict]:
+    """ES filter queries of field conditions; a list is taken as ES queries already.
+
+    A value gives a `term` query, a list of values a `terms` query and a dict
+    of bounds a `range` query, e.g. {"directory": "reports", "metadata.tenant":
+    ["acme", "globex"], "modified_at": {"gte": "2024-01-01"}}.
+    """
+    if filters is None:
+        return []
+    if isinstance(filters, list):
+        return filters
+    queries = []
+    for name, value in filters.items():
+        if isinstance(value, dict):
+            queries.append({"range": {name: value}})
+        elif isinstance(value, (list, tuple)):
+            queries.append({"terms": {name: list(value)}})
+        else:
+            queries.append({"term": {name: value}})
+    return queries
+
+
+def _bound(value: str):
+    """A range bound of a command line filter, a number if it reads as one."""
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_filters(expressions: Sequence[str]) -> Dict[str, object]:
+    """Field conditions of command line filters, see `metadata_filters`.
+
+    `field=value`, `field=value1,value2` and `field>=bound` (or `>`, `<`,
+    `<=`); the bounds of a field are combined into a single range.
+    """
+    filters: Dict[str, object] = {}
+    for expression in expressions:
+        match = re.match(r"^([\w.]+)\s*(>=|<=|>|<|=)\s*(.+)$", expression)
+        if match is None:
+            raise ValueError(f"Invalid filter {expression!r}, expected field=value or field>=value")
+        name, operator, value = match.groups()
+        if operator == "=":
+            values = value.split(",")
+            filters[name] = values if len(values) > 1 else value
+        elif isinstance(filters.get(name), dict):
+            filters[name][_RANGE_OPERATORS[operator]] = _bound(value)
+        else:
+            filters[name] = {_RANGE_OPERATORS[operator]: _bound(value)}
+    return filters
+
+
+@timed("query_encode")
+def encode_query(
+    query: str,
+    model: "SentenceTransformer",
+    cache: Optional[EmbeddingCache] = None,
+    projection: Optional[Projection] = None,
+):
+    """Encode the query, reusing the cached vector of repeated queries.
+
+    The vector goes through the projection of the index if any, and is
+    normalized to unit length, as `dot_product` indices require; cosine
+    similarity is not affected.
+    """
+    query_emb = cache.encode([query], model.encode)[0] if cache is not None else model.encode(query)
+    if projection is not None:
+        query_emb = projection.apply(query_emb)
+    return l2_normalize(query_emb)
+
+
+@dataclass
+class SearchResult:
+    """A document found by a search, or a passage when passages aren't aggregated."""
+
+    id: str
+    score: float
+    index: Optional[str] = None
+    text: Optional[str] = None
+    document_name: Optional[str] = None
+    parent_id: Optional[str] = None
+    # best passages of the document, as {"id", "score", "text", "chunk_index"}
+    passages: List[dict] = field(default_factory=list)
+    # the `_source` fields returned by the search
+    source: dict = field(default_factory=dict)
+    # pass the `sort` of the last result as `search_after` to get the next page
+    sort: list = field(default_factory=list)
+
+    @classmethod
+    def from_hit(cls, hit: dict, aggregation: str = constants.CHUNK_AGGREGATION) -> "SearchResult":
+        source = hit.get("_source", {})
+        passages = hit.get("inner_hits", {}).get("passages", {}).get("hits", {}).get("hits", [])
+        return cls(
+            id=hit["_id"],
+            score=hit["_score"],
+            index=hit.get("_index"),
+            text=source.get("sentence_text"),
+            document_name=source.get("document_name"),
+            parent_id=source.get("parent_id"),
+            passages=[
+                {
+                    "id": passage["_id"],
+                    "score": passage["_score"],
+                    "text": passage.get("_source", {}).get("sentence_text"),
+                    "chunk_index": passage.get("_source", {}).get("chunk_index"),
+                }
+                for passage in passages
+            ],
+            source=source,
+            sort=[hit["_score"], *_hit_id(hit, aggregation)],
+        )
+
+
+def _hit_id(hit: dict, aggregation: str) -> tuple:
+    """(index, id) identifying a hit: its parent document, or itself when passages aren't aggregated."""
+    index, hit_id = passage_key(hit) if aggregation == "none" else hit_key(hit)
+    return index or "", hit_id
+
+
+def _rank(hits: List[dict], aggregation: str) -> List[dict]:
+    """Sort hits by decreasing score, ties broken by id so pages are stable."""
+    return sorted(hits, key=lambda hit: (-hit["_score"], *_hit_id(hit, aggregation)))
+
+
+def _after(hit: dict, aggregation: str, search_after: list) -> bool:
+    """Whether a hit comes after the `sort` value of a previous result."""
+    score, index, hit_id = search_after
+    return (-hit["_score"], *_hit_id(hit, aggregation)) > (-score, index, hit_id)
+
+
+def _search_options(
+    body: dict,
+    aggregation: str,
+    min_score: Optional[float],
+    source_includes: Optional[List[str]],
+    source_excludes: Optional[List[str]],
+) -> dict:
+    """Set the `_source` filtering and the minimum score of a request."""
+    source = {"excludes": list(constants.SOURCE_EXCLUDES if source_excludes is None else source_excludes)}
+    if source_includes:
+        # Passages are aggregated by their parent id.
+        extra = ["parent_id"] if aggregation == "sum" and "parent_id" not in source_includes else []
+        source["includes"] = list(source_includes) + extra
+    body["_source"] = source
+    if min_score is not None:
+        body["min_score"] = min_score
+    return body
+
+
+def _collapse_passages(body: dict, k: int, aggregation: str, inner_hits: int) -> dict:
+    """Size the request and collapse passages into documents for the given aggregation."""
+    if aggregation not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation {aggregation}, expected one of {AGGREGATIONS}")
+    # Fetch more passages than documents so that k documents survive the collapse.
+    body["size"] = k if aggregation == "none" else k * constants.CHUNK_OVERSAMPLE
+    if aggregation == "max":
+        body["collapse"] = {
+            "field": "parent_id",
+            "inner_hits": {
+                "name": "passages",
+                "size": inner_hits,
+                "_source": ["sentence_text", "chunk_index"],
+            },
+        }
+        body["size"] = k
+    return body
+
+
+def knn_search_body(
+    query_emb,
+    k: int = 5,
+    aggregation: str = constants.CHUNK_AGGREGATION,
+    inner_hits: int = constants.INNER_HITS_SIZE,
+    num_candidates: int = constants.NUM_CANDIDATES,
+    prefilter: Optional[str] = None,
+    filters: Optional[List[dict]] = None,
+    min_score: Optional[float] = None,
+    source_includes: Optional[List[str]] = None,
+    source_excludes: Optional[List[str]] = None,
+) -> dict:
+    """Arguments of the kNN `search` request for an encoded query.
+
+    Args:
+        query_emb: the query vector.
+        k (int): number of results.
+        aggregation (str): "max", "sum" or "none", see `perform_search`.
+        inner_hits (int): number of best passages returned with each document.
+        num_candidates (int): candidates explored per shard, raised to the
+            number of passages fetched if lower.
+        prefilter (str): if given, only passages matching this text are
+            candidates, which lets a smaller `num_candidates` reach the same recall.
+        filters (List[dict]): ES queries the candidates must match.
+        min_score (float): minimum similarity of the returned passages.
+        source_includes (List[str]): `_source` fields returned, all by default.
+        source_excludes (List[str]): `_source` fields not returned, the
+            embedding by default.
+    """
+    num_passages = k if aggregation == "none" else k * constants.CHUNK_OVERSAMPLE
+    knn = {
+        "field": "sentence_embedding",
+        "query_vector": query_emb,
+        "k": num_passages,
+        "num_candidates": min(
+            max(num_candidates or num_passages, num_passages), constants.MAX_NUM_CANDIDATES
+        ),
+    }
+    knn_filters = list(filters or [])
+    if prefilter:
+        knn_filters.append({"match": {"sentence_text": prefilter}})
+    if knn_filters:
+        knn["filter"] = knn_filters
+    body = _collapse_passages({"knn": knn}, k, aggregation, inner_hits)
+    return _search_options(body, aggregation, min_score, source_includes, source_excludes)
+
+
+def lexical_search_body(
+    query: str,
+    k: int = 5,
+    aggregation: str = constants.CHUNK_AGGREGATION,
+    inner_hits: int = constants.INNER_HITS_SIZE,
+    filters: Optional[List[dict]] = None,
+    min_score: Optional[float] = None,
+    source_includes: Optional[List[str]] = None,
+    source_excludes: Optional[List[str]] = None,
+) -> dict:
+    """Arguments of the BM25 `search` request on the passage text.
+
+    Args:
+        query (str): the search query.
+        k (int): number of results.
+        aggregation (str): "max", "sum" or "none", see `perform_search`.
+        inner_hits (int): number of best passages returned with each document.
+        filters (List[dict]): ES queries the passages must match.
+        min_score (float): minimum BM25 score of the returned passages.
+        source_includes (List[str]): `_source` fields returned, all by default.
+        source_excludes (List[str]): `_source` fields not returned, the
+            embedding by default.
+    """
+    query_clause = {"match": {"sentence_text": query}}
+    if filters:
+        query_clause = {"bool": {"must": [query_clause], "filter": list(filters)}}
+    body = _collapse_passages({"query": query_clause}, k, aggregation, inner_hits)
+    return _search_options(body, aggregation, min_score, source_includes, source_excludes)
+
+
+def _requested_source(source: dict, includes: Optional[List[str]], excludes: List[str]) -> dict:
+    """The `_source` fields a request asked for, among the ones fetched for reranking."""
+    return {
+        name: value
+        for name, value in source.items()
+        if (not includes or name in includes) and name not in excludes
+    }
+
+
+@timed("rerank")
+def rerank_hits(
+    query: str,
+    query_emb,
+    res: dict,
+    reranker: Reranker,
+    encode,
+    k: int = 5,
+    aggregation: str = constants.CHUNK_AGGREGATION,
+    inner_hits: int = constants.INNER_HITS_SIZE,
+    min_score: Optional[float] = None,
+    source_includes: Optional[List[str]] = None,
+    source_excludes: Optional[List[str]] = None,
+) -> List[dict]:
+    """Hits of a response to the kNN candidates request of a reranker, re-scored and then aggregated.
+
+    Args:
+        query (str): the search query.
+        query_emb: the query vector.
+        res (dict): response of the candidates request, passages in ANN order.
+        reranker (Reranker): re-scores the candidates.
+        encode (Callable): encodes passage texts stored without their vectors.
+        k (int): number of results.
+        aggregation (str): "max", "sum" or "none", see `perform_search`.
+        inner_hits (int): number of best passages kept under each document.
+        min_score (float): minimum re-scored score of the passages.
+        source_includes (List[str]): `_source` fields returned, all by default.
+        source_excludes (List[str]): `_source` fields not returned, the
+            embedding by default.
+    """
+    num_passages = k if aggregation == "none" else k * constants.CHUNK_OVERSAMPLE
+    hits = reranker.rescore(query, query_emb, res["hits"]["hits"], k=num_passages, encode=encode)
+    if min_score is not None:
+        hits = [hit for hit in hits if hit["_score"] >= min_score]
+    if aggregation != "none":
+        hits = aggregate_passages(hits, size=k, how=aggregation, inner_hits=inner_hits)
+
+    includes = list(source_includes or [])
+    if includes and aggregation == "sum" and "parent_id" not in includes:
+        includes.append("parent_id")
+    excludes = list(constants.SOURCE_EXCLUDES if source_excludes is None else source_excludes)
+    results = []
+    for hit in hits[:k]:
+        hit = dict(hit, _source=_requested_source(hit["_source"], includes, excludes))
+        if "inner_hits" in hit:
+            # Like the inner hits of a collapsed ES search.
+            passages = [
+                dict(
+                    passage,
+                    _source=_requested_source(passage["_source"], ["sentence_text", "chunk_index"], []),
+                )
+                for passage in hit["inner_hits"]["passages"]["hits"]["hits"]
+            ]
+            hit["inner_hits"] = {"passages": {"hits": {"hits": passages}}}
+        results.append(hit)
     return results
 
 
+def collect_hits(
+    res: dict,
+    k: int = 5,
+    aggregation: str = constants.CHUNK_AGGREGATION,
+    inner_hits: int = constants.INNER_HITS_SIZE,
+) -> List[dict]:
+    """Hits of a response to a `knn_search_body` or `lexical_search_body` request."""
+    hits = res["hits"]["hits"]
+    if aggregation == "sum":
+        return aggregate_passages(hits, size=k, how="sum", inner_hits=inner_hits)
+    return hits[:k]
+
+
+def render_results(results: List[SearchResult]) -> List[str]:
+    """Format search results for display."""
+    lines = []
+    for i, result in enumerate(results, start=1):
+        lines.append(f'Result {i}: {result.text}')
+        lines.append(f'score: {result.score}')
+    return lines
+
+
+@timed("search")
+def search_hits(
+    query: str,
+    client: Union["Elasticsearch", VectorStore],
+    index_names: List[str],
+    model: Optional["SentenceTransformer"] = None,
+    k: int = 5,
+    cache: Optional[EmbeddingCache] = None,
+    aggregation: str = constants.CHUNK_AGGREGATION,
+    inner_hits: int = constants.INNER_HITS_SIZE,
+    mode: str = constants.SEARCH_MODE,
+    fusion: str = constants.FUSION_METHOD,
+    lexical_weight: float = constants.LEXICAL_WEIGHT,
+    vector_weight: float = constants.VECTOR_WEIGHT,
+    depth: int = constants.HYBRID_DEPTH,
+    num_candidates: int = constants.NUM_CANDIDATES,
+    rank_constant: int = constants.RRF_RANK_CONSTANT,
+    prefilter: bool = False,
+    filters: Union[Dict[str, object], List[dict], None] = None,
+    min_score: Optional[float] = None,
+    source_includes: Optional[List[str]] = None,
+    source_excludes: Optional[List[str]] = None,
+    search_after: Optional[list] = None,
+    runner=None,
+    reranker: Optional[Reranker] = None,
+    rerank_depth: Optional[int] = None,
+    query_emb=None,
+    projection: Optional[Projection] = None,
+) -> List[SearchResult]:
+    """Search one or several indices with kNN, BM25 or both.
+
+    In hybrid mode the kNN and BM25 searches of every index are run
+    concurrently and their rankings are fused.  Several indices are searched
+    the same way and their hits merged by score.
+
+    Pages are walked with `search_after`: the next page starts after the
+    `sort` value of the last result of the previous one.  Approximate kNN
+    can't resume from a position, so every page searches deeper until it
+    holds `k` results past the cursor or the results run out.
+
+    With a reranker, the kNN search fetches `rerank_depth` candidate passages
+    which are re-scored before being collapsed into documents; in hybrid
+    mode the re-scored kNN ranking is then fused with the BM25 one.
+
+    Args:
+        query (str): the search query.
+        client (Elasticsearch): elasticsearch client, or the `VectorStore` to search.
+        index_names (List[str]): indices or aliases to search.
+        model (SentenceTransformer): the model encoding the query, the shared
+            one by default; not needed in lexical mode.
+        k (int): number of results.
+        cache (EmbeddingCache): optional embedding cache for repeated queries.
+        aggregation (str): "max", "sum" or "none", see `perform_search`.
+        inner_hits (int): number of best passages returned with each document.
+        mode (str): one of `SEARCH_MODES`.
+        fusion (str): "rrf" or "weighted", how hybrid rankings are fused.
+        lexical_weight (float): weight of the BM25 ranking in hybrid mode.
+        vector_weight (float): weight of the kNN ranking in hybrid mode.
+        depth (int): hits fetched from each ranking before fusion in hybrid mode.
+        num_candidates (int): kNN candidates explored per shard.
+        rank_constant (int): rank constant of reciprocal rank fusion.
+        prefilter (bool): only consider kNN candidates matching the query terms.
+        filters (List[dict]): ES queries the passages must match, or field
+            conditions, see `metadata_filters`.  They are the kNN `filter`, so
+            the ANN search only walks the passages matching them.
+        min_score (float): minimum score of the passages, applied by ES to
+            each ranking before fusion.
+        source_includes (List[str]): `_source` fields returned, all by default.
+        source_excludes (List[str]): `_source` fields not returned, the
+            embedding by default.
+        search_after (list): `sort` of the last result of the previous page.
+        runner (AsyncSearchRunner): runs several ES searches concurrently
+            instead of in a single `_msearch` request.
+        reranker (Reranker): re-scores the kNN candidates, see `Reranker`.
+        rerank_depth (int): candidate passages re-scored, the depth of the
+            reranker by default.
+        query_emb: the query vector when it is already encoded, and projected.
+        projection (Projection): projection of the vectors of the indices,
+            which must all store vectors of the same projection.
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode {mode}, expected one of {SEARCH_MODES}")
+    if reranker is not None and mode == "lexical":
+        raise ValueError("Reranking re-scores kNN candidates, use the knn or hybrid mode")
+    if search_after is not None and len(search_after) != 3:
+        raise ValueError("search_after must be the sort value of a previous result")
+    if mode != "lexical" and model is None:
+        model = get_model()
+    store = as_vector_store(client, runner=runner)
+    filters = metadata_filters(filters)
+    if mode not in ("knn", "hybrid"):
+        query_emb = None
+    elif query_emb is None:
+        query_emb = encode_query(query, model, cache, projection)
+    options = dict(
+        aggregation=aggregation,
+        inner_hits=inner_hits,
+        filters=filters,
+        min_score=min_score,
+        source_includes=source_includes,
+        source_excludes=source_excludes,
+    )
+
+    def encode(texts: List[str]):
+        vectors = cache.encode(texts, model.encode) if cache is not None else model.encode(texts)
+        return projection.apply(vectors) if projection is not None else vectors
+
+    def candidates_body(ranking_size: int) -> dict:
+        """kNN request of the passages the reranker re-scores, with the fields it needs."""
+        num_passages = ranking_size if aggregation == "none" else ranking_size * constants.CHUNK_OVERSAMPLE
+        needed = ["sentence_text", "parent_id", "chunk_index"]
+        excludes = list(constants.SOURCE_EXCLUDES if source_excludes is None else source_excludes)
+        if reranker.needs_vectors:
+            needed.append("sentence_embedding")
+            excludes = [name for name in excludes if name != "sentence_embedding"]
+        return knn_search_body(
+            query_emb,
+            k=max(rerank_depth or reranker.depth, num_passages),
+            aggregation="none",
+            num_candidates=num_candidates,
+            prefilter=query if prefilter else None,
+            filters=filters,
+            # Applied to the re-scored passages.
+            min_score=None,
+            source_includes=list(source_includes) + needed if source_includes else None,
+            source_excludes=excludes,
+        )
+
+    def ranked_hits(size: int) -> List[dict]:
+        ranking_size = max(depth, size) if mode == "hybrid" else size
+        bodies = []
+        if query_emb is not None and reranker is not None:
+            bodies.append(candidates_body(ranking_size))
+        elif query_emb is not None:
+            bodies.append(
+                knn_search_body(
+                    query_emb,
+                    k=ranking_size,
+                    num_candidates=num_candidates,
+                    prefilter=query if prefilter else None,
+                    **options,
+                )
+            )
+        if mode in ("lexical", "hybrid"):
+            bodies.append(lexical_search_body(query, k=ranking_size, **options))
+
+        searches = [(index_name, body) for index_name in index_names for body in bodies]
+        with timer("store_search"):
+            responses = store.search_many(searches)
+
+        # One ranking per body, merged across the indices.
+        rankings = []
+        for i in range(len(bodies)):
+            hits = []
+            for index_name, res in zip(index_names, responses[i :: len(bodies)]):
+                if i == 0 and query_emb is not None and reranker is not None:
+                    index_hits = rerank_hits(
+                        query,
+                        query_emb,
+                        res,
+                        reranker,
+                        encode,
+                        k=ranking_size,
+                        aggregation=aggregation,
+                        inner_hits=inner_hits,
+                        min_score=min_score,
+                        source_includes=source_includes,
+                        source_excludes=source_excludes,
+                    )
+                else:
+                    index_hits = collect_hits(
+                        res, k=ranking_size, aggregation=aggregation, inner_hits=inner_hits
+                    )
+                for hit in index_hits:
+                    hit.setdefault("_index", index_name)
+                    hits.append(hit)
+            rankings.append(_rank(hits, aggregation)[:ranking_size])
+        if mode != "hybrid":
+            return rankings[0]
+        fused = fuse(
+            rankings,
+            size=size,
+            method=fusion,
+            weights=[vector_weight, lexical_weight],
+            rank_constant=rank_constant,
+            key=passage_key if aggregation == "none" else hit_key,
+        )
+        return _rank(fused, aggregation)
+
+    size, fetched = k, -1
+    while True:
+        hits = ranked_hits(size)
+        page = (
+            hits if search_after is None else [hit for hit in hits if _after(hit, aggregation, search_after)]
+        )
+        exhausted = len(hits) <= fetched or size >= constants.MAX_SEARCH_DEPTH
+        # Hits cut off by the search size may tie with the last one of the page
+        # and come before it by id: search deeper until the cut is below its score.
+        tied = len(page) >= k and len(hits) >= size and hits[-1]["_score"] == page[k - 1]["_score"]
+        # Stop once the page is full, or searching deeper finds nothing new.
+        if (len(page) >= k and not tied) or exhausted:
+            return [SearchResult.from_hit(hit, aggregation) for hit in page[:k]]
+        size, fetched = min(size * 2, constants.MAX_SEARCH_DEPTH), len(hits)
+
+
+def perform_search(
+    query: str,
+    client: Union["Elasticsearch", VectorStore],
+    index_name: str,
+    model: "SentenceTransformer",
+    k: int = 5,
+    cache: Optional[EmbeddingCache] = None,
+    aggregation: str = constants.CHUNK_AGGREGATION,
+    inner_hits: int = constants.INNER_HITS_SIZE,
+    filters: Union[Dict[str, object], List[dict], None] = None,
+    **options,
+) -> List[SearchResult]:
+    """Search the passages closest to the query and collapse them into documents.
+
+    Args:
+        query (str): the search query.
+        client (Elasticsearch): elasticsearch client, or the `VectorStore` to search.
+        index_name (str): index name defined in the elasticsearch
+        model (SentenceTransformer): the model encoding the query.
+        k (int): number of results.
+        cache (EmbeddingCache): optional embedding cache for repeated queries.
+        aggregation (str): "max" scores a document by its best passage, "sum"
+            by the sum of its passage scores and "none" returns passages.
+        inner_hits (int): number of best passages returned with each document.
+        filters: field conditions on the passages and their document metadata,
+            e.g. {"metadata.tenant": "acme"}, or ES queries, see `metadata_filters`.
+        options: search mode, hybrid, filtering and paging options, see `search_hits`.
+    """
+    return search_hits(
+        query,
+        client=client,
+        index_names=[index_name],
+        model=model,
+        k=k,
+        cache=cache,
+        aggregation=aggregation,
+        inner_hits=inner_hits,
+        filters=filters,
+        **options,
+    )
+
+
 def clear_screen():
     # Clear the terminal screen
     os.system('cls' if os.name == 'nt' else 'clear')
 
 
 if __name__ == "__main__":
+    import readline
+
+    # Enable command history
+    readline.parse_and_bind("tab: complete")
 
     # Get the parser arguments
     parser = argparse.ArgumentParser(
@@ -61,29 +669,114 @@ if __name__ == "__main__":
         Current arguments are:
 
         --index_name="es0"
+        --cache_dir=".cache/embeddings"
+        --aggregation="max"
+        --mode="hybrid"
+        --fusion="rrf"
+        --lexical_weight=1.0
+        --vector_weight=1.0
+        --depth=50
+        --num_candidates=100
+        --prefilter
+        --k=5
+        --min_score=0.5
+        --filter="metadata.tenant=acme"
+        --rerank="exact"
+        --rerank_depth=100
+        --backend="elasticsearch"
+        --faiss_dir=".cache/faiss"
 
         Example Usage
         -------------
         python %(prog)s
         python %(prog)s  --index_name=es0
+        python %(prog)s  --index_name=es0 --mode hybrid --fusion weighted --lexical_weight 0.3
+        python %(prog)s  --index_name=es0 --num_candidates 20 --rerank exact --rerank_depth 100
+        python %(prog)s  --index_name=es0 --filter metadata.tenant=acme --filter "modified_at>=2024-01-01"
 
         '''
         ),
     )
     parser.add_argument('--index_name', help='elasticsearch defined index.', type=str)
+    parser.add_argument('--cache_dir', help='embedding cache folder, no cache if not given.', type=str)
+    parser.add_argument(
+        '--aggregation',
+        help='how passage scores are combined into document scores.',
+        choices=AGGREGATIONS,
+        default=constants.CHUNK_AGGREGATION,
+    )
+    parser.add_argument(
+        '--mode', help='kNN, BM25 or both fused.', choices=SEARCH_MODES, default=constants.SEARCH_MODE
+    )
+    parser.add_argument(
+        '--fusion',
+        help='how hybrid rankings are fused.',
+        choices=FUSION_METHODS,
+        default=constants.FUSION_METHOD,
+    )
+    parser.add_argument(
+        '--lexical_weight', help='weight of the BM25 ranking.', type=float, default=constants.LEXICAL_WEIGHT
+    )
+    parser.add_argument(
+        '--vector_weight', help='weight of the kNN ranking.', type=float, default=constants.VECTOR_WEIGHT
+    )
+    parser.add_argument(
+        '--depth',
+        help='hits fetched from each ranking before fusion.',
+        type=int,
+        default=constants.HYBRID_DEPTH,
+    )
+    parser.add_argument(
+        '--num_candidates',
+        help='kNN candidates explored per shard.',
+        type=int,
+        default=constants.NUM_CANDIDATES,
+    )
+    parser.add_argument(
+        '--prefilter', help='only consider kNN candidates matching the query terms.', action='store_true'
+    )
+    parser.add_argument('--k', help='number of results.', type=int, default=5)
+    parser.add_argument('--min_score', help='minimum score of the results.', type=float)
+    parser.add_argument(
+        '--filter',
+        help='condition on the passage metadata, field=value, field=a,b or field>=bound; repeatable.',
+        action='append',
+        default=[],
+    )
+    parser.add_argument(
+        '--rerank', help='re-score the kNN candidates, no reranking if not given.', choices=RERANK_METHODS
+    )
+    parser.add_argument(
+        '--rerank_depth', help='kNN candidates re-scored.', type=int, default=constants.RERANK_DEPTH
+    )
+    parser.add_argument(
+        '--backend',
+        help='where the passages are searched.',
+        choices=BACKENDS,
+        default=constants.VECTOR_BACKEND,
+    )
+    parser.add_argument('--faiss_dir', help='folder of the faiss indices.', type=str)
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
+    try:
+        filters = parse_filters(args.filter)
+    except ValueError as e:
+        parser.error(str(e))
+    # Pick up changes of the logging configuration while running.
+    start_log_watcher()
 
-    logger.info('Started invoking elasticsearch client.')
-    # Create the client instance
-    client = Elasticsearch(
-        hosts=constants.ES_URL,
-        ca_certs=constants.ES_CA_CERTS,
-        basic_auth=(constants.ES_USER, constants.ES_PASSWORD),
-    )
+    logger.info(f'Opening the {args.backend} vector store.')
+    client = open_store(args.backend, faiss_dir=args.faiss_dir, mmap=True)
     # Get cluster information
     logger.info(client.info())
 
+    model = get_model()
+    projection = index_projection(client, args.index_name)
+
+    cache = EmbeddingCache(args.cache_dir, constants.MAIN_EMBEDDING) if args.cache_dir else None
+
+    reranker = Reranker(args.rerank, depth=args.rerank_depth) if args.rerank else None
+
     # Run embedding
     try:
         logger.info("Running search.")
@@ -102,13 +795,34 @@ if __name__ == "__main__":
             clear_screen()
 
             # Perform the search and get the results
-            results = perform_search(query, client=client, index_name=args.index_name)
+            results = perform_search(
+                query,
+                client=client,
+                index_name=args.index_name,
+                model=model,
+                k=args.k,
+                cache=cache,
+                aggregation=args.aggregation,
+                mode=args.mode,
+                fusion=args.fusion,
+                lexical_weight=args.lexical_weight,
+                vector_weight=args.vector_weight,
+                depth=args.depth,
+                num_candidates=args.num_candidates,
+                prefilter=args.prefilter,
+                min_score=args.min_score,
+                filters=filters,
+                reranker=reranker,
+                projection=projection,
+            )
 
             # Print the results
             print("Results:")
-            for result in results:
-                print(result)
+            for line in render_results(results):
+                print(line)
             print()
+            if reranker is not None:
+                print(f"Reranking: {reranker.stats()}")
 
             # Prompt the user to press Enter to continue
             input("Press Enter to continue...")
@@ -116,3 +830,7 @@ if __name__ == "__main__":
     except Exception as e:
         logger.error(f"Could not perform the embedding due to error {e}")
         print(traceback.format_exc())
+    finally:
+        if cache is not None:
+            cache.close()
+        client.close()
@@ -0,0 +1,445 @@
+import argparse
+import json
+import textwrap
+import threading
+import time
+import traceback
+from dataclasses import asdict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+
+import argcomplete
+
+from src.dataset.async_search import AsyncSearchRunner
+from src.dataset.batcher import QueryBatcher
+from src.dataset.cache import EmbeddingCache
+from src.dataset.projection import Projection, indices_projection
+from src.dataset.rerank import RERANK_METHODS, Reranker
+from src.dataset.result_cache import ResultCache
+from src.dataset.search import encode_query, search_hits
+from src.dataset.vector_store import BACKENDS, VectorStore, as_vector_store, open_store
+from src.utils import constants
+from src.utils.logging import getLogger
+from src.utils.metrics import metrics, timed
+from src.utils.registry import get_model, start_log_watcher
+
+if TYPE_CHECKING:
+    from elasticsearch import Elasticsearch
+    from sentence_transformers import SentenceTransformer
+
+# Instantiate the logger
+logger = getLogger(__name__)
+# Logs once per request, kept from flooding the handlers under load.
+request_logger = getLogger(__name__, rate_limit=constants.LOG_RATE_LIMIT)
+
+# Search options a request may set, with their accepted types.
+_SEARCH_OPTIONS = {
+    "mode": (str,),
+    "fusion": (str,),
+    "lexical_weight": (int, float),
+    "vector_weight": (int, float),
+    "depth": (int,),
+    "num_candidates": (int,),
+    "rank_constant": (int,),
+    "prefilter": (bool,),
+    "filters": (list, dict),
+    "min_score": (int, float),
+    "source_includes": (list,),
+    "source_excludes": (list,),
+    "search_after": (list,),
+    "rerank_depth": (int,),
+}
+# Accepted types of the items of the list options.
+_LIST_ITEMS = {"filters": dict, "source_includes": str, "source_excludes": str}
+
+
+class SearchService:
+    """Serves `search_hits` with a model and a client loaded once at startup.
+
+    Args:
+        client (Elasticsearch): elasticsearch client shared by all requests, or
+            the `VectorStore` to search.
+        model (SentenceTransformer): the model encoding the queries, or a
+            `QueryBatcher` wrapping it.
+        index_name (str): index searched when a request doesn't name one.
+        cache (EmbeddingCache): optional embedding cache for repeated queries.
+        runner (AsyncSearchRunner): asyncio client used to search several
+            indices concurrently; without it they are searched with `_msearch`.
+        reranker (Reranker): re-scores the kNN candidates of every request.
+        result_cache (ResultCache): optional cache of the results of repeated
+            or near-duplicate requests.
+        projection (Projection): projection of the vectors of every index
+            searched.  If not given, it is looked up for the indices of each
+            request, see `indices_projection`, which must all share it.
+    """
+
+    def __init__(
+        self,
+        client: Union["Elasticsearch", VectorStore],
+        model: "SentenceTransformer",
+        index_name: Optional[str] = None,
+        cache: Optional[EmbeddingCache] = None,
+        runner: Optional[AsyncSearchRunner] = None,
+        reranker: Optional[Reranker] = None,
+        result_cache: Optional[ResultCache] = None,
+        projection: Optional[Projection] = None,
+    ):
+        self.client = client
+        self.model = model
+        self.index_name = index_name
+        self.cache = cache
+        self.runner = runner
+        self.reranker = reranker
+        self.result_cache = result_cache
+        self.projection = projection
+        # Projection of the indices searched together, looked up on their first request.
+        self._projections: Dict[Tuple[str, ...], Optional[Projection]] = {}
+        self._projections_lock = threading.Lock()
+
+    def warm_up(self):
+        """Run a dummy encode, a cluster call and the projection lookup of the default indices."""
+        start = time.perf_counter()
+        self.model.encode("warm up")
+        logger.info(self.client.info())
+        if self.index_name:
+            self._projection(self._index_names({}))
+        logger.info(f"Warmed up in {(time.perf_counter() - start) * 1000:.1f}ms.")
+
+    def _index_names(self, request: dict) -> List[str]:
+        index_names = request.get("index", self.index_name)
+        if not index_names:
+            raise ValueError('"index" is required when the service has no default index')
+        if isinstance(index_names, str):
+            index_names = index_names.split(",")
+        if not isinstance(index_names, list) or not all(
+            isinstance(name, str) and name for name in index_names
+        ):
+            raise ValueError('"index" must be an index name or a list of index names')
+        return index_names
+
+    def _projection(self, index_names: List[str]) -> Optional[Projection]:
+        if self.projection is not None:
+            return self.projection
+        key = tuple(index_names)
+        with self._projections_lock:
+            if key not in self._projections:
+                self._projections[key] = indices_projection(as_vector_store(self.client), index_names)
+            return self._projections[key]
+
+    @staticmethod
+    def _search_options(request: dict) -> dict:
+        options = {}
+        for name, types in _SEARCH_OPTIONS.items():
+            if name not in request:
+                continue
+            value = request[name]
+            # bool is an int, don't accept it for numbers.
+            if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+                raise ValueError(f'"{name}" has an invalid value {value!r}')
+            if (
+                name in _LIST_ITEMS
+                and isinstance(value, list)
+                and not all(isinstance(item, _LIST_ITEMS[name]) for item in value)
+            ):
+                raise ValueError(f'"{name}" must be a list of {_LIST_ITEMS[name].__name__}')
+            options[name] = value
+        return options
+
+    @timed("request")
+    def search(self, request: dict) -> dict:
+        """Run a search request.
+
+        Args:
+            request (dict): {"query": str, "k": int, "index": str or List[str], "aggregation": str}
+                and the search mode, hybrid, filtering and paging options of
+                `search_hits`, only "query" is required.  Several indices are
+                searched concurrently and their hits merged by score.
+        """
+        query = request.get("query")
+        if not isinstance(query, str) or not query.strip():
+            raise ValueError('"query" must be a non-empty string')
+        k = request.get("k", 5)
+        if not isinstance(k, int) or k < 1:
+            raise ValueError('"k" must be a positive integer')
+        index_names = self._index_names(request)
+        aggregation = request.get("aggregation", constants.CHUNK_AGGREGATION)
+        options = self._search_options(request)
+        projection = self._projection(index_names)
+
+        start = time.perf_counter()
+
+        def search(query_emb=None):
+            return search_hits(
+                query,
+                client=self.client,
+                index_names=index_names,
+                model=self.model,
+                k=k,
+                cache=self.cache,
+                aggregation=aggregation,
+                # Several indices are searched concurrently from the event loop.
+                runner=self.runner if len(index_names) > 1 else None,
+                # The reranker re-scores kNN candidates, lexical requests skip it.
+                reranker=self.reranker if options.get("mode", constants.SEARCH_MODE) != "lexical" else None,
+                query_emb=query_emb,
+                projection=projection,
+                **options,
+            )
+
+        if self.result_cache is not None:
+            results = self.result_cache.search(
+                query,
+                index_names,
+                k,
+                aggregation,
+                options,
+                search,
+                encode=lambda text: encode_query(text, self.model, self.cache, projection),
+            )
+        else:
+            results = search()
+        return {
+            "results": [asdict(result) for result in results],
+            # Pass it as "search_after" to get the next page.
+            "next": results[-1].sort if len(results) == k else None,
+            "took_ms": (time.perf_counter() - start) * 1000,
+        }
+
+    def stats(self) -> dict:
+        """Query batching, embedding cache, reranking and result cache counters, and the stage timings."""
+        stats = {}
+        if isinstance(self.model, QueryBatcher):
+            stats["batcher"] = self.model.stats()
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        if self.reranker is not None:
+            stats["rerank"] = self.reranker.stats()
+        if self.result_cache is not None:
+            stats["result_cache"] = self.result_cache.stats()
+        if metrics.enabled:
+            stats["stages"] = metrics.summary()
+        return stats
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    """JSON API of the search service.
+
+    GET  /health : liveness check.
+    GET  /stats  : query batching, embedding cache, reranking and result cache counters, stage timings.
+    GET  /metrics: stage timing histograms in the Prometheus text format.
+    POST /search : body {"query": "...", "k": 5, "index": "es0"} or
+                   {"query": "...", "index": ["es0", "es1"]} to search several indices,
+                   {"query": "...", "mode": "hybrid", "fusion": "rrf"} for hybrid search,
+                   {"query": "...", "search_after": <"next" of the previous page>} for the next page.
+    """
+
+    # Set on the subclass built by `serve`.
+    service: SearchService = None
+    protocol_version = "HTTP/1.1"
+
+    def _send_json(self, status: HTTPStatus, body: dict):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_text(self, status: HTTPStatus, text: str, content_type: str = "text/plain; version=0.0.4"):
+        payload = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(HTTPStatus.OK, {"status": "ok"})
+        elif self.path == "/stats":
+            self._send_json(HTTPStatus.OK, self.service.stats())
+        elif self.path == "/metrics":
+            self._send_text(HTTPStatus.OK, metrics.prometheus_text())
+        else:
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/search":
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("The request body must be a JSON object")
+            response = self.service.search(request)
+        except ValueError as e:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+        except Exception as e:
+            request_logger.error(f"Could not perform the search due to error {e}")
+            request_logger.debug(traceback.format_exc())
+            self._send_json(HTTPStatus.BAD_GATEWAY, {"error": str(e)})
+        else:
+            self._send_json(HTTPStatus.OK, response)
+
+    def log_message(self, format, *args):
+        # Route the access log through our logger instead of stderr.
+        request_logger.debug(f"{self.address_string()} {format % args}")
+
+
+def serve(service: SearchService, host: str = constants.SERVICE_HOST, port: int = constants.SERVICE_PORT):
+    """Serve the search API until interrupted; every request runs in its own thread."""
+    handler = type("BoundSearchRequestHandler", (SearchRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    logger.info(f"Search service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping the search service.")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+
+    # Get the parser arguments
+    parser = argparse.ArgumentParser(
+        description="script to run the search service.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=textwrap.dedent(
+            ''''
+        Current arguments are:
+
+        --index_name="es0,es1"
+        --host="0.0.0.0"
+        --port=8000
+        --cache_dir=".cache/embeddings"
+        --batch_window_ms=3
+        --max_batch_size=32
+        --rerank="exact"
+        --rerank_depth=100
+        --result_cache_size=10000
+        --result_cache_ttl=300
+        --result_cache_mb=256
+        --semantic_threshold=0.97
+        --backend="elasticsearch"
+        --faiss_dir=".cache/faiss"
+
+        Example Usage
+        -------------
+        python %(prog)s --index_name=es0
+        python %(prog)s --index_name=es0 --port 8080
+        python %(prog)s --index_name=es0 --backend faiss
+        python %(prog)s --index_name=es0 --rerank exact --rerank_depth 100
+        python %(prog)s --index_name=es0 --result_cache_size 10000 --semantic_threshold 0.97
+        curl -XPOST localhost:8000/search -d '{"query": "semantic search", "k": 5}'
+
+        '''
+        ),
+    )
+    parser.add_argument(
+        '--index_name', help='elasticsearch index searched by default, comma separated for several.', type=str
+    )
+    parser.add_argument('--host', help='interface to listen on.', type=str, default=constants.SERVICE_HOST)
+    parser.add_argument('--port', help='port to listen on.', type=int, default=constants.SERVICE_PORT)
+    parser.add_argument('--cache_dir', help='embedding cache folder, no cache if not given.', type=str)
+    parser.add_argument(
+        '--batch_window_ms',
+        help='how long a query waits for others to be encoded with, 0 disables batching.',
+        type=float,
+        default=constants.QUERY_BATCH_WAIT_MS,
+    )
+    parser.add_argument(
+        '--max_batch_size',
+        help='maximum number of queries encoded together.',
+        type=int,
+        default=constants.QUERY_BATCH_SIZE,
+    )
+    parser.add_argument(
+        '--rerank', help='re-score the kNN candidates, no reranking if not given.', choices=RERANK_METHODS
+    )
+    parser.add_argument(
+        '--rerank_depth', help='kNN candidates re-scored.', type=int, default=constants.RERANK_DEPTH
+    )
+    parser.add_argument(
+        '--result_cache_size',
+        help='number of search results cached, 0 disables the result cache.',
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        '--result_cache_ttl',
+        help='seconds search results stay cached.',
+        type=float,
+        default=constants.RESULT_CACHE_TTL,
+    )
+    parser.add_argument(
+        '--result_cache_mb',
+        help='maximum size of the cached search results.',
+        type=float,
+        default=constants.RESULT_CACHE_MAX_BYTES / 1024**2,
+    )
+    parser.add_argument(
+        '--semantic_threshold',
+        help=f'serve the cached results of queries at least this cosine similar, e.g. '
+        f'{constants.SEMANTIC_CACHE_THRESHOLD}; exact matches only if not given.',
+        type=float,
+    )
+    parser.add_argument(
+        '--backend',
+        help='where the passages are searched.',
+        choices=BACKENDS,
+        default=constants.VECTOR_BACKEND,
+    )
+    parser.add_argument('--faiss_dir', help='folder of the faiss indices.', type=str)
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+    # Pick up changes of the logging configuration while running.
+    start_log_watcher()
+
+    logger.info(f'Opening the {args.backend} vector store.')
+    client = open_store(args.backend, faiss_dir=args.faiss_dir, mmap=True)
+    reranker = Reranker(args.rerank, depth=args.rerank_depth) if args.rerank else None
+    result_cache = None
+    if args.result_cache_size > 0:
+        result_cache = ResultCache(
+            max_entries=args.result_cache_size,
+            ttl=args.result_cache_ttl,
+            max_bytes=int(args.result_cache_mb * 1024**2),
+            semantic_threshold=args.semantic_threshold,
+            generation=client.generation,
+        )
+    cache = EmbeddingCache(args.cache_dir, constants.MAIN_EMBEDDING) if args.cache_dir else None
+
+    # Local stores search several indices in-process, only ES needs the asyncio client.
+    runner = AsyncSearchRunner() if args.backend == "elasticsearch" else None
+
+    model = get_model()
+    if args.batch_window_ms > 0:
+        model = QueryBatcher(model, max_batch_size=args.max_batch_size, max_wait_ms=args.batch_window_ms)
+
+    try:
+        service = SearchService(
+            client,
+            model,
+            index_name=args.index_name,
+            cache=cache,
+            runner=runner,
+            reranker=reranker,
+            result_cache=result_cache,
+        )
+        service.warm_up()
+        serve(service, host=args.host, port=args.port)
+    except Exception as e:
+        logger.error(f"Could not run the search service due to error {e}")
+        print(traceback.format_exc())
+    finally:
+        if runner is not None:
+            runner.close()
+        client.close()
+        if isinstance(model, QueryBatcher):
+            model.close()
+        if cache is not None:
+            cache.close()
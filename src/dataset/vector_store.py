@@ -0,0 +1,169 @@
+import uuid
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Optional, Tuple, Union
+
+from src.dataset.async_search import gather_searches
+from src.utils import constants
+from src.utils.logging import getLogger
+from src.utils.registry import get_es_client
+
+if TYPE_CHECKING:
+    from elasticsearch import Elasticsearch
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+BACKENDS = ("elasticsearch", "faiss")
+FAISS_INDEX_TYPES = ("flat", "ivfpq", "hnsw")
+
+
+class IndexNotFoundError(ValueError):
+    """The index searched doesn't exist in the store."""
+
+
+class VectorStore(ABC):
+    """Where passages are indexed and searched.
+
+    Requests and responses keep the shape of the ES APIs: `bulk` takes bulk
+    actions and yields their results, `search_many` takes search request
+    arguments and returns search responses.  This lets ingestion and search
+    run against ES or a local engine unchanged.
+    """
+
+    @abstractmethod
+    def bulk(
+        self,
+        actions: Iterable[dict],
+        chunk_size: int = constants.BULK_CHUNK_SIZE,
+        max_chunk_bytes: int = constants.BULK_MAX_BYTES,
+        inflight: int = constants.BULK_INFLIGHT,
+    ) -> Iterator[Tuple[bool, dict]]:
+        """Apply index and delete actions and yield their (ok, info) results in order."""
+
+    @abstractmethod
+    def search_many(self, searches: List[Tuple[str, dict]]) -> List[dict]:
+        """Run (index, body) searches and return their responses in order."""
+
+    def info(self) -> dict:
+        return {"backend": type(self).__name__}
+
+    def generation(self, index_name: str) -> Optional[str]:
+        """Ingestion generation of an index, changed by every ingestion into it; None if not tracked."""
+        return None
+
+    def bump_generation(self, index_name: str):
+        """Record that an ingestion changed the index, so results cached before it are dropped."""
+
+    def projection_file(self, index_name: str) -> Optional[str]:
+        """Projection file recorded when the index was created, None if its vectors are stored as encoded."""
+        return None
+
+    def flush(self):
+        """Persist what was indexed so far."""
+
+    def close(self):
+        pass
+
+
+class ElasticsearchStore(VectorStore):
+    """Passages indexed in Elasticsearch.
+
+    Args:
+        client (Elasticsearch): elasticsearch client
+        runner (AsyncSearchRunner): runs several searches concurrently
+            instead of in a single `_msearch` request.
+        close_client (bool): close the client with the store; shared clients
+            are closed by the registry at exit.
+    """
+
+    def __init__(self, client: "Elasticsearch", runner=None, close_client: bool = True):
+        self.client = client
+        self.runner = runner
+        self.close_client = close_client
+
+    def bulk(
+        self,
+        actions: Iterable[dict],
+        chunk_size: int = constants.BULK_CHUNK_SIZE,
+        max_chunk_bytes: int = constants.BULK_MAX_BYTES,
+        inflight: int = constants.BULK_INFLIGHT,
+    ) -> Iterator[Tuple[bool, dict]]:
+        """Send actions through the `_bulk` API.
+
+        Above 1 `inflight`, bulk requests are sent concurrently from a thread
+        pool sharing the client connections.
+        """
+        from elasticsearch import helpers
+
+        options = dict(chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes, raise_on_error=False)
+        if inflight > 1:
+            # parallel_bulk also keeps the results in the order of the actions.
+            return helpers.parallel_bulk(
+                self.client, actions, thread_count=inflight, queue_size=inflight, **options
+            )
+        return helpers.streaming_bulk(self.client, actions, **options)
+
+    def search_many(self, searches: List[Tuple[str, dict]]) -> List[dict]:
+        """One search is sent as is, several in one `_msearch` request or concurrently from the runner."""
+        if len(searches) == 1:
+            index_name, body = searches[0]
+            return [self.client.search(index=index_name, **body)]
+        if self.runner is not None:
+            return self.runner.run(gather_searches(self.runner.client, searches))
+        lines = []
+        for index_name, body in searches:
+            lines.extend([{"index": index_name}, body])
+        responses = self.client.msearch(searches=lines)["responses"]
+        for (index_name, _), response in zip(searches, responses):
+            if "error" in response:
+                raise RuntimeError(f"Search on {index_name} failed: {response['error']}")
+        return responses
+
+    def info(self) -> dict:
+        return self.client.info()
+
+    def generation(self, index_name: str) -> Optional[str]:
+        """The generations saved in the `_meta` of the indices behind a name or alias."""
+        mappings = self.client.indices.get_mapping(index=index_name)
+        generations = [
+            mapping["mappings"].get("_meta", {}).get("ingest_generation")
+            for _, mapping in sorted(mappings.items())
+        ]
+        return ",".join(generation or "" for generation in generations)
+
+    def bump_generation(self, index_name: str):
+        mappings = self.client.indices.get_mapping(index=index_name)
+        for name, mapping in mappings.items():
+            # `_meta` is replaced as a whole, keep the index profile.
+            meta = dict(mapping["mappings"].get("_meta", {}), ingest_generation=uuid.uuid4().hex)
+            self.client.indices.put_mapping(index=name, meta=meta)
+
+    def close(self):
+        if self.close_client:
+            self.client.close()
+
+
+def as_vector_store(client: Union["Elasticsearch", VectorStore], runner=None) -> VectorStore:
+    """Wrap an elasticsearch client in a store; other stores are returned as is.
+
+    An ES store without a runner is given the `runner`, on a wrapper sharing its client.
+    """
+    if isinstance(client, ElasticsearchStore) and runner is not None and client.runner is None:
+        return ElasticsearchStore(client.client, runner=runner, close_client=False)
+    if isinstance(client, VectorStore):
+        return client
+    return ElasticsearchStore(client, runner=runner)
+
+
+def open_store(
+    backend: str = constants.VECTOR_BACKEND, faiss_dir: str = None, **faiss_options
+) -> VectorStore:
+    """Open the store of a backend, connecting to ES or opening the local indices under `faiss_dir`."""
+    if backend == "elasticsearch":
+        return ElasticsearchStore(get_es_client(), close_client=False)
+    if backend == "faiss":
+        # Imported here so ES deployments don't load faiss.
+        from src.dataset.faiss_store import FaissStore
+
+        return FaissStore(faiss_dir or constants.FAISS_DIR, **faiss_options)
+    raise ValueError(f"Unknown vector store backend {backend}, expected one of {BACKENDS}")
@@ -9,6 +9,11 @@ load_dotenv(find_dotenv())
 SRC_DIR = Path(__file__).parent.parent
 PROJECT_DIR = SRC_DIR.parent
 PYTHON_LOG_CONFIG = SRC_DIR / "utils" / "logging.yaml"
+# asynchronous logging: unset follows the "async" key of logging.yaml
+LOG_ASYNC = {'true': True, 'false': False}.get(os.environ.get('LOG_ASYNC', '').lower())
+LOG_QUEUE_SIZE = 10_000
+# messages per second of the per-document and per-query logs
+LOG_RATE_LIMIT = 10.0
 
 # retrieve the credentials
 ES_PASSWORD = os.environ.get('ELASTIC_PASSWORD')
@@ -21,3 +26,133 @@ ES_CA_CERTS = os.environ.get('ES_CERTS')
 # embedding model
 MPNET_EMBEDDING = "sentence-transformers/all-mpnet-base-v2"
 MAIN_EMBEDDING = MPNET_EMBEDDING
+# local copy of the main model, loaded instead of the hub one when set
+EMBEDDING_MODEL_PATH = os.environ.get('EMBEDDING_MODEL_PATH')
+# hub cache folder of the models, the sentence-transformers default if not set
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR')
+# never contact the hub, models must already be cached
+MODEL_OFFLINE = os.environ.get('MODEL_OFFLINE', 'false').lower() == 'true'
+# "torch", "int8", "onnx" or "onnx_int8", see src/dataset/encoders.py
+ENCODER_BACKEND = os.environ.get('ENCODER_BACKEND', 'torch')
+ONNX_DIR = PROJECT_DIR / ".cache" / "onnx"
+ONNX_OPSET = 14
+# minimum cosine similarity of a backend's vectors to the torch ones
+ENCODER_MIN_COSINE = 0.99
+
+# ingestion defaults
+READ_CHUNK_SIZE = 256
+ENCODE_BATCH_SIZE = 32
+# token budget of an encode batch, padding included, and its maximum number of texts
+ENCODE_MAX_TOKENS = 8192
+ENCODE_MAX_BATCH_SIZE = 256
+BULK_CHUNK_SIZE = 500
+BULK_MAX_BYTES = 100 * 1024 * 1024
+PIPELINE_QUEUE_SIZE = 4
+ENCODER_WORKERS = 0
+THREADS_PER_WORKER = 1
+
+# embedding cache
+EMBEDDING_CACHE_DIR = PROJECT_DIR / ".cache" / "embeddings"
+EMBEDDING_CACHE_MAX_ENTRIES = 10_000_000
+EMBEDDING_CACHE_DTYPE = "float32"
+# Seconds a cache write waits for another process holding the sqlite write lock.
+EMBEDDING_CACHE_LOCK_TIMEOUT = 30
+
+# incremental sync
+MANIFEST_DIR = PROJECT_DIR / ".cache" / "manifests"
+
+# passage chunking
+CHUNK_STRATEGY = "none"
+CHUNK_SENTENCES = 3
+CHUNK_SIZE = 256
+CHUNK_OVERLAP = 32
+CHUNK_AGGREGATION = "max"
+CHUNK_OVERSAMPLE = 4
+INNER_HITS_SIZE = 3
+
+# search service
+SERVICE_HOST = "0.0.0.0"
+SERVICE_PORT = 8000
+QUERY_BATCH_SIZE = 32
+QUERY_BATCH_WAIT_MS = 3.0
+
+# elasticsearch client
+ES_CONNECTIONS_PER_NODE = int(os.environ.get('ES_CONNECTIONS_PER_NODE', 16))
+ES_REQUEST_TIMEOUT = float(os.environ.get('ES_REQUEST_TIMEOUT', 30))
+ES_MAX_RETRIES = int(os.environ.get('ES_MAX_RETRIES', 3))
+ES_HTTP_COMPRESS = os.environ.get('ES_HTTP_COMPRESS', 'false').lower() == 'true'
+BULK_INFLIGHT = 1
+
+# hybrid search
+SEARCH_MODE = "knn"
+FUSION_METHOD = "rrf"
+RRF_RANK_CONSTANT = 60
+LEXICAL_WEIGHT = 1.0
+VECTOR_WEIGHT = 1.0
+HYBRID_DEPTH = 50
+
+# search
+NUM_CANDIDATES = 100
+MAX_NUM_CANDIDATES = 10_000
+MAX_SEARCH_DEPTH = 1_000
+SOURCE_EXCLUDES = ("sentence_embedding",)
+
+# vector store backends
+VECTOR_BACKEND = "elasticsearch"
+FAISS_DIR = PROJECT_DIR / ".cache" / "faiss"
+FAISS_INDEX_TYPE = "hnsw"
+FAISS_HNSW_M = 32
+FAISS_HNSW_EF_CONSTRUCTION = 200
+FAISS_NLIST = 1024
+FAISS_PQ_M = 16
+FAISS_NPROBE = 16
+# seconds between two checks of whether a faiss index changed on disk
+FAISS_RELOAD_CHECK_INTERVAL = 1.0
+
+# reranking
+RERANK_METHOD = "exact"
+RERANK_DEPTH = 100
+CROSS_ENCODER = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+# search result cache
+RESULT_CACHE_MAX_ENTRIES = 10_000
+RESULT_CACHE_TTL = 300.0
+RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RESULT_CACHE_CHECK_INTERVAL = 5.0
+SEMANTIC_CACHE_THRESHOLD = 0.97
+
+# benchmarks
+BENCHMARK_DIR = PROJECT_DIR / ".cache" / "benchmarks"
+BENCHMARK_SAMPLE_DATA = PROJECT_DIR / "data" / "sample_data"
+BENCHMARK_SIZES = (1_000, 10_000)
+BENCHMARK_QUERIES = 200
+BENCHMARK_CONCURRENCY = (1, 4, 16)
+BENCHMARK_K = 10
+BENCHMARK_SEED = 0
+STUB_EMBEDDING_DIMS = 384
+
+# stage timing metrics
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '1.0'))
+METRICS_INTERVAL = 10.0
+METRICS_PREFIX = "semantic_search"
+
+# blue/green reindexing
+REINDEX_MAX_SEGMENTS = 1
+REINDEX_KEEP = 1
+REINDEX_HEALTH_TIMEOUT = "10m"
+REINDEX_MERGE_TIMEOUT = 3600
+
+# dimensionality reduction
+PROJECTION_DIR = PROJECT_DIR / ".cache" / "projections"
+PROJECTION_SAMPLE_SIZE = 20_000
+PROJECTION_EVAL_QUERIES = 500
+
+# document metadata
+SIDECAR_SUFFIX = ".json"
+
+# batch search
+BATCH_ENCODE_SIZE = 256
+MSEARCH_SIZE = 64
+MSEARCH_INFLIGHT = 4
+BATCH_PROGRESS_INTERVAL = 10.0
@@ -0,0 +1,37 @@
+from typing import Any, Dict
+
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+
+from src.utils import constants
+
+
+def client_options(**overrides) -> Dict[str, Any]:
+    """Connection settings shared by the sync and async clients.
+
+    Connections are pooled and kept alive per node, requests that time out or
+    hit an overloaded node (429, 502, 503, 504) are retried.  Every setting
+    can be tuned through the environment, see `constants`, or overridden.
+    """
+    options = {
+        "hosts": constants.ES_URL,
+        "ca_certs": constants.ES_CA_CERTS,
+        "basic_auth": (constants.ES_USER, constants.ES_PASSWORD),
+        "connections_per_node": constants.ES_CONNECTIONS_PER_NODE,
+        "request_timeout": constants.ES_REQUEST_TIMEOUT,
+        "max_retries": constants.ES_MAX_RETRIES,
+        "retry_on_timeout": True,
+        "retry_on_status": (429, 502, 503, 504),
+        "http_compress": constants.ES_HTTP_COMPRESS,
+    }
+    options.update(overrides)
+    return options
+
+
+def get_client(**overrides) -> Elasticsearch:
+    """Create an elasticsearch client; it is thread-safe and meant to be shared."""
+    return Elasticsearch(**client_options(**overrides))
+
+
+def get_async_client(**overrides) -> AsyncElasticsearch:
+    """Create an asyncio elasticsearch client; it must be used from a single event loop."""
+    return AsyncElasticsearch(**client_options(**overrides))
@@ -1,5 +1,7 @@
 """Configuration for all log messages under src."""
 
+import atexit
+import functools
 import inspect
 import json
 import logging
@@ -7,20 +9,46 @@ import logging.config
 import logging.handlers
 import os
 import os.path
+import queue
 import sys
+import threading
 import time
 import traceback
 
 import psutil
 import yaml
 from watchdog import events
-from watchdog.observers import Observer
 
 # src modules
-from src.utils.constants import PYTHON_LOG_CONFIG
-
-
-def getLogger(loggerName: str) -> logging.LoggerAdapter:
+from src.utils.constants import LOG_ASYNC, LOG_QUEUE_SIZE, PYTHON_LOG_CONFIG
+
+
+class RateLimiter:
+    """Token bucket letting `rate` messages a second through, in bursts of up to `burst`."""
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """(allowed, number of messages suppressed since the last allowed one)."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                self._suppressed += 1
+                return False, 0
+            self._tokens -= 1
+            suppressed, self._suppressed = self._suppressed, 0
+            return True, suppressed
+
+
+def getLogger(loggerName: str, rate_limit: float = None) -> logging.LoggerAdapter:
     """This is a weapper method.
 
     This is a wrapper around logging.getLogger(loggerName) that returns a
@@ -44,6 +72,12 @@ def getLogger(loggerName: str) -> logging.LoggerAdapter:
         logging.debug("Your number is {}.".format(3.14))
 
     Will not work.  Declare your own logger by calling getLogger instead.
+
+    Messages logged per document or per query can flood the handlers; give
+    their logger a `rate_limit` of messages per second.  The extra messages
+    are dropped, and the next one logged tells how many were:
+
+        document_logger = getLogger(__name__, rate_limit=10)
     """
 
     # This idea was adapted from the Python logging cookbook:
@@ -63,15 +97,23 @@ def getLogger(loggerName: str) -> logging.LoggerAdapter:
             return self.fmt.format(*self.args)
 
     class StyleAdapter(logging.LoggerAdapter):
-        def __init__(self, logger, extra=None):
+        def __init__(self, logger, extra=None, limiter=None):
             super(StyleAdapter, self).__init__(logger, extra or {})
+            self.limiter = limiter
 
         def log(self, level, msg, *args, **kwargs):
             if self.isEnabledFor(level):
+                if self.limiter is not None:
+                    allowed, suppressed = self.limiter.acquire()
+                    if not allowed:
+                        return
+                    if suppressed:
+                        msg = f"{msg} ({suppressed} similar messages suppressed)"
                 msg, kwargs = self.process(msg, kwargs)
                 self.logger._log(level, Message(msg, args), (), **kwargs)
 
-    return StyleAdapter(logging.getLogger(loggerName))
+    limiter = RateLimiter(rate_limit) if rate_limit else None
+    return StyleAdapter(logging.getLogger(loggerName), limiter=limiter)
 
 
 def current_function_name(frameIndex: int = 1) -> str:
@@ -181,13 +223,37 @@ def log_exception(e: BaseException = None, loggerName: str = None):
     logger.exception(f'{caller}{"()" if caller != "__main__" else ""} raised {e.__class__.__name__}: {e}')
 
 
+# One handler per profile log file, however many functions are profiled into it.
+_profilerHandlers = {}
+_profilerLock = threading.Lock()
+
+
+def _profilerHandler(log_file_path: str) -> logging.Handler:
+    with _profilerLock:
+        if log_file_path not in _profilerHandlers:
+            handler = logging.FileHandler(log_file_path)
+            handler.setFormatter(
+                logging.Formatter(
+                    '%(levelname)-8s | %(asctime)s | PID=%(process)d | '
+                    '%(filename)s:%(lineno)s [%(name)s]: %(message)s'
+                )
+            )
+            logging.getLogger('Profiler').addHandler(handler)
+            _profilerHandlers[log_file_path] = handler
+        return _profilerHandlers[log_file_path]
+
+
 def profiler(*args, **kwargs):
     '''
     this method profiles the time and memory of functions operation as per
-    Time : cpu clock time
+    Time : wall clock time
     RSS  : resident set size
     VMS  : virtual memory size
 
+    The time is also recorded in the `function:<name>` stage of
+    `src.utils.metrics`.  Memory is only measured when the Profiler logger
+    is enabled for debug messages; for hot paths prefer the metrics timers.
+
     Parameters
     -----------------
     log_file_path :str = filepath to store the profile info
@@ -199,16 +265,21 @@ def profiler(*args, **kwargs):
     '''
     # pop the data is needed here
     log_file_path = kwargs.pop('log_file_path', None)
-    if log_file_path is not None and log_file_path != '':
-        write_log_to_file = True
-    else:
-        write_log_to_file = False
 
     def inner(func):
-        def elapsed_since(start):
-            '''get lapsed cpu time'''
-            # return time.strftime("%H:%M:%S", time.gmtime(time.time() - start))
-            elapsed = time.time() - start
+        # Imported here, src.utils.metrics logs through this module.
+        from src.utils.metrics import metrics
+
+        logger = logging.getLogger('Profiler')
+        if log_file_path:
+            # Added once to the logger rather than on every call.  (True, the
+            # same could be accomplished by having the programmer edit
+            # logging.yaml instead, but the Principle of Least Surprise
+            # applies here: this is the way the DS code used to work.)
+            _profilerHandler(log_file_path)
+
+        def elapsed_since(elapsed):
+            '''format an elapsed time in seconds'''
             if elapsed < 1:
                 return str(round(elapsed * 1000, 2)) + "ms"
             if elapsed < 60:
@@ -220,8 +291,7 @@ def profiler(*args, **kwargs):
 
         def get_process_memory():
             '''get process memory'''
-            process = psutil.Process(os.getpid())
-            mi = process.memory_info()
+            mi = _process().memory_info()
             return mi.rss, mi.vms
 
         def format_bytes(bytes):
@@ -235,48 +305,29 @@ def profiler(*args, **kwargs):
             else:
                 return str(round(bytes / 1e9, 2)) + "GB"
 
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            report = logger.isEnabledFor(logging.DEBUG)
 
             # Measure before
-            rss_before, vms_before = get_process_memory()
-            start = time.time()
+            if report:
+                rss_before, vms_before = get_process_memory()
+            start = time.perf_counter_ns()
 
             # Run method
             retval = func(*args, **kwargs)
 
             # Measure after
-            elapsed_time = elapsed_since(start)
-            rss_after, vms_after = get_process_memory()
-            rss_mem = format_bytes(rss_after - rss_before)
-            vms_mem = format_bytes(vms_after - vms_before)
-
-            # Report
-            logger = logging.getLogger('Profiler')
-            if write_log_to_file:
-                # Add a FileHandler to the logger if write_log_to_file is
-                # True.  (True, the same could be accomplished by having the
-                # programmer edit logging.yaml instead, but the Principle of
-                # Least Surprise applies here: this is the way the DS code
-                # used to work.)
-                handler = logging.FileHandler(log_file_path)
-                formatter = logging.Formatter(
-                    '%(levelname)-8s | %(asctime)s | PID=%(process)d | \
-                        %(filename)s:%(lineno)s [%(name)s]: %(message)s'
+            elapsed = (time.perf_counter_ns() - start) / 1e9
+            metrics.observe(f'function:{func.__name__}', elapsed)
+            if report:
+                rss_after, vms_after = get_process_memory()
+                logger.debug(
+                    f'Time & Memory Profiling Report for {func.__name__}(). '
+                    f'Time : {elapsed_since(elapsed)} '
+                    f'RSS  : {format_bytes(rss_after - rss_before)} '
+                    f'VMS : {format_bytes(vms_after - vms_before)}'
                 )
-                handler.setFormatter(formatter)
-                logger.addHandler(handler)
-
-            logger.debug(f'Time & Memory Profiling Report for {func.__name__}().')
-            logger.debug(f'Time : {elapsed_time}')
-            logger.debug(f'RSS  : {rss_mem} VMS : {vms_mem}')
-
-            if write_log_to_file:
-                try:
-                    logger.debug(f'Time & Memory Profiling Report for {func.__name__}().')
-                    logger.debug(f'Time : {elapsed_time}')
-                    logger.debug(f'RSS  : {rss_mem} VMS : {vms_mem}')
-                except Exception:
-                    logger.debug('Warning: no process log file was identified.')
             return retval
 
         return wrapper
@@ -284,6 +335,55 @@ def profiler(*args, **kwargs):
     return inner
 
 
+_psutilProcess = None
+
+
+def _process():
+    '''The psutil handle of this process, created once per process.'''
+    global _psutilProcess
+    if _psutilProcess is None or _psutilProcess.pid != os.getpid():
+        _psutilProcess = psutil.Process(os.getpid())
+    return _psutilProcess
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queues records without ever blocking the logging thread.
+
+    Records arriving while the queue is full are dropped and counted, and a
+    warning with their number is queued once there is room again.
+    """
+
+    def __init__(self, recordQueue: queue.Queue):
+        super().__init__(recordQueue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(
+                    logging.LogRecord(
+                        __name__,
+                        logging.WARNING,
+                        __file__,
+                        0,
+                        f"Dropped {self.dropped} log records, the log queue was full.",
+                        None,
+                        None,
+                    )
+                )
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _DrainingQueueListener(logging.handlers.QueueListener):
+    """A listener whose `stop` waits for room in a full queue instead of failing."""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
 class LogConfigFileWatcher(events.PatternMatchingEventHandler):
     '''
     Watches for changes in our DS logging configuration YAML, and re-reads the
@@ -301,6 +401,13 @@ class LogConfigFileWatcher(events.PatternMatchingEventHandler):
     #                       changes to particular files, not directories.
     patterns = ["*/" + os.path.basename(PYTHON_LOG_CONFIG)]
     ignore_directories = True
+    pythonConfigPath = PYTHON_LOG_CONFIG
+
+    # In asynchronous mode, the root logger only queues records and this
+    # listener thread hands them to the configured handlers.
+    queueHandler = None
+    queueListener = None
+    _reloadLock = threading.Lock()
 
     @classmethod
     def _readLogitConfig(cls, logit_cfg_file_path, dictConfig):
@@ -349,6 +456,50 @@ class LogConfigFileWatcher(events.PatternMatchingEventHandler):
                         else:
                             pass
 
+    @classmethod
+    def _resolveLogFiles(cls, dictConfig):
+        '''
+        Handler file names are relative to this folder.  Make them absolute
+        and create their folders, rather than changing the working directory
+        of the whole process while the configuration is applied.
+        '''
+        configDirectory = os.path.dirname(os.path.abspath(__file__))
+        for handler in (dictConfig.get("handlers") or {}).values():
+            if "filename" in handler:
+                handler["filename"] = os.path.normpath(os.path.join(configDirectory, handler["filename"]))
+                os.makedirs(os.path.dirname(handler["filename"]), exist_ok=True)
+
+    @classmethod
+    def _startQueueListener(cls):
+        '''
+        Moves the handlers of the root logger behind a queue, so that logging
+        calls never wait for a slow disk or terminal.
+        '''
+        root = logging.getLogger()
+        handlers = list(root.handlers)
+        recordQueue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        cls.queueHandler = _DroppingQueueHandler(recordQueue)
+        cls.queueListener = _DrainingQueueListener(recordQueue, *handlers, respect_handler_level=True)
+        for handler in handlers:
+            root.removeHandler(handler)
+        root.addHandler(cls.queueHandler)
+        cls.queueListener.start()
+
+    @classmethod
+    def _stopQueueListener(cls):
+        '''
+        Writes out the queued records and gives the handlers back to the root
+        logger.
+        '''
+        if cls.queueListener is None:
+            return
+        root = logging.getLogger()
+        cls.queueListener.stop()
+        root.removeHandler(cls.queueHandler)
+        for handler in cls.queueListener.handlers:
+            root.addHandler(handler)
+        cls.queueHandler = cls.queueListener = None
+
     @classmethod
     def _reloadConfigFiles(cls):
         '''
@@ -358,30 +509,40 @@ class LogConfigFileWatcher(events.PatternMatchingEventHandler):
         This is a helper function for both _process() and initiateObserver().
         Both of them need to reload configurations -- one conditionally, and
         one unconditionally -- but the process is identical either way.
+
+        Logging is asynchronous when the `LOG_ASYNC` environment variable, or
+        else the `async` key of the configuration, is true.  The records
+        queued under the previous configuration are written out before its
+        handlers are replaced.
         '''
 
         dictConfig = {}
         if os.path.exists(cls.pythonConfigPath):
-            try:
-                with open(cls.pythonConfigPath, "r") as f:
-                    dictConfig = yaml.load(f, Loader=yaml.Loader)
-                    oldDir = os.getcwd()
-                    os.chdir(os.path.dirname(__file__))
+            with cls._reloadLock:
+                try:
+                    with open(cls.pythonConfigPath, "r") as f:
+                        dictConfig = yaml.load(f, Loader=yaml.Loader)
+                    useQueue = dictConfig.pop("async", False)
+                    if LOG_ASYNC is not None:
+                        useQueue = LOG_ASYNC
+                    cls._resolveLogFiles(dictConfig)
+                    cls._stopQueueListener()
                     logging.config.dictConfig(dictConfig)
-                    os.chdir(oldDir)
-            except Exception as e:
-                # Perhaps the yaml file is unreadable?  Perhaps it's
-                # broken?
-                #
-                # We could log this:
-                print(traceback.format_exc())
-
-                logging.error(
-                    "Could not reload config file {}: \
-                                {}".format(
-                        cls.pythonConfigPath, e
+                    if useQueue:
+                        cls._startQueueListener()
+                except Exception as e:
+                    # Perhaps the yaml file is unreadable?  Perhaps it's
+                    # broken?
+                    #
+                    # We could log this:
+                    print(traceback.format_exc())
+
+                    logging.error(
+                        "Could not reload config file {}: \
+                                    {}".format(
+                            cls.pythonConfigPath, e
+                        )
                     )
-                )
 
     def _process(self, event):
         '''
@@ -432,9 +593,11 @@ class LogConfigFileWatcher(events.PatternMatchingEventHandler):
         try:
             cls.logger = getLogger(cls.__name__)
             if not hasattr(cls, "observer"):
+                # Imported here, processes that don't watch the file don't load it.
+                from watchdog.observers import Observer
+
                 # Create the one file observation thread.
                 cls.currentDirectory = os.path.dirname(__file__)
-                cls.pythonConfigPath = PYTHON_LOG_CONFIG
                 cls.observer = Observer()
 
                 # Watch for logging.yaml.
@@ -472,5 +635,8 @@ class LogConfigFileWatcher(events.PatternMatchingEventHandler):
             cls.logger.error("ERROR occurred while stopping observer thread: {}".format(e))
 
 
-# Start the watcher.  Does nothing if the watcher is already started.
-LogConfigFileWatcher.initiateObserver()
+# Read the configuration once.  The watcher thread is only started by
+# long-running processes, see `registry.start_log_watcher`.
+LogConfigFileWatcher._reloadConfigFiles()
+# Write out the queued records before logging shuts its handlers down.
+atexit.register(LogConfigFileWatcher._stopQueueListener)
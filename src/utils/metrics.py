@@ -0,0 +1,287 @@
+"""Timers and latency histograms of the ingestion and search stages.
+
+Stages are timed with `perf_counter_ns` into fixed-bucket histograms, so
+recording costs a clock read, a bisect and a lock, whatever the traffic.
+Disabled, or outside the sampled share of calls, a timer is a shared no-op
+context manager.  Histograms are exported in the Prometheus text format or
+as JSON snapshots, periodically appended to a file by `SnapshotWriter`.
+
+Example:
+    with timer("encode"):
+        embeddings = model.encode(texts)
+
+    @timed("search")
+    def search_hits(...):
+        ...
+
+    print(metrics.prometheus_text())
+"""
+
+import bisect
+import functools
+import json
+import random
+import threading
+import time
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, Sequence, TypeVar
+
+from src.utils import constants
+from src.utils.logging import getLogger
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+T = TypeVar("T")
+
+# Upper bounds in seconds of the histogram buckets, from 100µs to 30s.
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+_NOOP = nullcontext()
+
+
+class Histogram:
+    """Counts of durations per bucket, with their sum and maximum."""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # The last count is for durations above the largest bound.
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._max = 0.0
+
+    def observe(self, seconds: float):
+        position = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self._counts[position] += 1
+            self._sum += seconds
+            if seconds > self._max:
+                self._max = seconds
+
+    def _quantile(self, counts: Sequence[int], total: int, q: float) -> float:
+        """Quantile interpolated within its bucket, as Prometheus' `histogram_quantile`."""
+        rank, cumulative = q * total, 0
+        for position, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[position - 1] if position > 0 else 0.0
+                upper = self.buckets[position] if position < len(self.buckets) else self._max
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts, total_seconds, maximum = list(self._counts), self._sum, self._max
+        count = sum(counts)
+        cumulative, buckets = 0, {}
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            buckets[bound] = cumulative
+        return {
+            "count": count,
+            "sum": total_seconds,
+            "mean": total_seconds / count if count else 0.0,
+            "max": maximum,
+            "p50": self._quantile(counts, count, 0.50),
+            "p95": self._quantile(counts, count, 0.95),
+            "p99": self._quantile(counts, count, 0.99),
+            "buckets": buckets,
+        }
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram: Histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe((time.perf_counter_ns() - self._start) / 1e9)
+        return False
+
+
+class Metrics:
+    """Latency histograms of named stages.
+
+    Args:
+        enabled (bool): record anything at all.
+        sample_rate (float): share of the timed calls that are recorded.
+        buckets (Sequence[float]): upper bounds of the histogram buckets, in seconds.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = constants.METRICS_ENABLED,
+        sample_rate: float = constants.METRICS_SAMPLE_RATE,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Histogram] = {}
+
+    def histogram(self, stage: str) -> Histogram:
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(stage, Histogram(self.buckets))
+        return histogram
+
+    def _sampled(self) -> bool:
+        return self.enabled and (self.sample_rate >= 1.0 or random.random() < self.sample_rate)
+
+    def timer(self, stage: str):
+        """Context manager recording the time spent in its block."""
+        if not self._sampled():
+            return _NOOP
+        return _Timer(self.histogram(stage))
+
+    def observe(self, stage: str, seconds: float):
+        """Record a duration measured by the caller."""
+        if self._sampled():
+            self.histogram(stage).observe(seconds)
+
+    def timed_iter(self, iterable: Iterable[T], stage: str) -> Iterator[T]:
+        """Yield the items of an iterable, recording the time taken to produce each one."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter_ns()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(stage, (time.perf_counter_ns() - start) / 1e9)
+            yield item
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Histogram summaries per stage."""
+        with self._lock:
+            histograms = dict(self._histograms)
+        return {stage: histogram.snapshot() for stage, histogram in sorted(histograms.items())}
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Count and mean, p50 and p99 milliseconds per stage, for logs."""
+        return {
+            stage: {
+                "count": stats["count"],
+                "total_s": round(stats["sum"], 3),
+                "mean_ms": round(stats["mean"] * 1000, 3),
+                "p50_ms": round(stats["p50"] * 1000, 3),
+                "p99_ms": round(stats["p99"] * 1000, 3),
+            }
+            for stage, stats in self.snapshot().items()
+        }
+
+    def prometheus_text(self, prefix: str = constants.METRICS_PREFIX) -> str:
+        """The histograms in the Prometheus text exposition format."""
+        name = f"{prefix}_stage_seconds"
+        lines = [
+            f"# HELP {name} Time spent in each ingestion and search stage.",
+            f"# TYPE {name} histogram",
+        ]
+        for stage, stats in self.snapshot().items():
+            for bound, count in stats["buckets"].items():
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {stats["count"]}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {stats["sum"]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {stats["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+class SnapshotWriter:
+    """Append a JSON snapshot of the metrics to a file every `interval` seconds, and once more on `close`.
+
+    Example:
+        writer = SnapshotWriter(".cache/metrics.jsonl", interval=10)
+        ...
+        writer.close()
+    """
+
+    def __init__(self, path: str, interval: float = constants.METRICS_INTERVAL, registry: "Metrics" = None):
+        """
+        Args:
+            path (str): JSON lines file the snapshots are appended to.
+            interval (float): seconds between two snapshots.
+            registry (Metrics): the metrics written, the process-wide ones by default.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.interval = interval
+        self.registry = registry if registry is not None else metrics
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-snapshots", daemon=True)
+        self._thread.start()
+
+    def write(self):
+        line = json.dumps({"time": time.time(), "stages": self.registry.snapshot()})
+        with open(self.path, "a") as f:
+            f.write(line + "\n")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logger.warning(f"Could not write the metrics snapshot to {self.path}: {e}")
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+
+# The process-wide metrics.
+metrics = Metrics()
+
+
+def timer(stage: str):
+    """Time a block into the process-wide metrics, see `Metrics.timer`."""
+    return metrics.timer(stage)
+
+
+def timed(stage: str) -> Callable:
+    """Decorator timing every call of a function into the process-wide metrics."""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_iter(iterable: Iterable[T], stage: str) -> Iterator[T]:
+    """Time the production of every item into the process-wide metrics, see `Metrics.timed_iter`."""
+    return metrics.timed_iter(iterable, stage)
@@ -0,0 +1,134 @@
+"""Process-wide registry of the heavy objects: models, clients and the log watcher.
+
+They are created on first use instead of at import time, so `--help` and tab
+completion don't pay for loading torch and the model, and every module of a
+process shares the same instances.  Shared instances are closed at exit.
+"""
+
+import atexit
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
+
+from src.utils import constants
+from src.utils.logging import getLogger
+
+if TYPE_CHECKING:
+    from elasticsearch import Elasticsearch
+    from sentence_transformers import SentenceTransformer
+    from transformers import PreTrainedTokenizerBase
+
+# Instantiate the logger
+logger = getLogger(__name__)
+
+# A factory may ask for other shared objects.
+_lock = threading.RLock()
+_instances: Dict[str, Any] = {}
+
+
+def shared(name: str, factory: Callable[[], Any]) -> Any:
+    """The instance registered under `name`, created with `factory` on first use."""
+    with _lock:
+        if name not in _instances:
+            _instances[name] = factory()
+        return _instances[name]
+
+
+def is_loaded(name: str) -> bool:
+    return name in _instances
+
+
+def _model_path(model_name: str) -> str:
+    """Local copy or hub id to load a model from, with the hub switched off under `MODEL_OFFLINE`."""
+    if constants.MODEL_OFFLINE:
+        # Read by huggingface_hub and transformers when they are imported.
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+    if model_name == constants.MAIN_EMBEDDING and constants.EMBEDDING_MODEL_PATH:
+        return constants.EMBEDDING_MODEL_PATH
+    return model_name
+
+
+def load_model(
+    model_name: str = constants.MAIN_EMBEDDING, device: Optional[str] = None
+) -> "SentenceTransformer":
+    """Load a sentence-transformers model, without sharing it.
+
+    The main embedding model is read from `EMBEDDING_MODEL_PATH` when it is
+    set, other models from the hub cache in `MODEL_CACHE_DIR`.  With
+    `MODEL_OFFLINE` the hub is never contacted and models must be cached.
+
+    Args:
+        model_name (str): hub id of the model.
+        device (str): torch device, picked by sentence-transformers if not given.
+    """
+    path = _model_path(model_name)
+    from sentence_transformers import SentenceTransformer
+
+    start = time.perf_counter()
+    model = SentenceTransformer(path, device=device, cache_folder=constants.MODEL_CACHE_DIR)
+    logger.info(f"Loaded {model_name} from {path} in {time.perf_counter() - start:.2f}s.")
+    return model
+
+
+def load_tokenizer(model_name: str = constants.MAIN_EMBEDDING) -> "PreTrainedTokenizerBase":
+    """Load the tokenizer of a model from where `load_model` loads the model, without the model.
+
+    Args:
+        model_name (str): hub id of the model.
+    """
+    path = _model_path(model_name)
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(path, cache_dir=constants.MODEL_CACHE_DIR)
+
+
+def get_model(
+    model_name: str = constants.MAIN_EMBEDDING, backend: str = constants.ENCODER_BACKEND
+) -> "SentenceTransformer":
+    """The shared embedding model, loaded on first use on the configured encoder backend.
+
+    See `load_model` and `src.dataset.encoders.load_encoder`.
+    """
+
+    def load():
+        from src.dataset.encoders import load_encoder
+
+        return load_encoder(backend, model_name)
+
+    return shared(f"model:{backend}:{model_name}", load)
+
+
+def get_es_client() -> "Elasticsearch":
+    """The shared elasticsearch client, connected on first use."""
+    from src.utils.es_client import get_client
+
+    return shared("es_client", get_client)
+
+
+def start_log_watcher():
+    """Reload the logging configuration when `logging.yaml` changes, for long-running processes."""
+    from src.utils.logging import LogConfigFileWatcher
+
+    def start():
+        LogConfigFileWatcher.initiateObserver()
+        return LogConfigFileWatcher
+
+    return shared("log_watcher", start)
+
+
+@atexit.register
+def close_all():
+    """Close the shared clients and stop the log watcher."""
+    with _lock:
+        instances = dict(_instances)
+        _instances.clear()
+    for name, instance in instances.items():
+        try:
+            if name == "log_watcher":
+                instance.stopObserver()
+            elif hasattr(instance, "close"):
+                instance.close()
+        except Exception as e:
+            logger.warning(f"Could not close {name}: {e}")
@@ -0,0 +1,30 @@
+from itertools import islice
+from typing import Iterable, Iterator, List, TypeVar
+
+import numpy as np
+
+T = TypeVar("T")
+
+
+def batched(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    """Split an iterable into lists of at most `size` items.
+
+    Args:
+        iterable (Iterable): the items to split.
+        size (int): the maximum number of items per batch.
+    """
+    if size < 1:
+        raise ValueError(f"Batch size must be at least 1, got {size}")
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def l2_normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scale vectors, or a single vector, to unit length; zero vectors are left as is."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
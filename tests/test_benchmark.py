@@ -0,0 +1,26 @@
+from src.dataset.benchmark import run_benchmark
+from src.utils import constants
+from src.utils.metrics import metrics
+
+
+def test_run_benchmark_finds_the_exact_neighbours_on_the_memory_backend(tmp_path):
+    report = run_benchmark(sizes=[50], queries=10, concurrency=[1, 2], corpus_dir=tmp_path)
+
+    assert report["config"]["backend"] == "memory"
+    (run,) = report["runs"]
+    assert run["documents"] == 50
+    assert run["indexed"] == 50
+    assert run[f"recall@{constants.BENCHMARK_K}"] == 1.0
+    assert [level["concurrency"] for level in run["search"]] == [1, 2]
+    assert all(level["queries"] == 10 for level in run["search"])
+
+
+def test_run_benchmark_reports_the_stage_timings_of_each_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", True)
+    monkeypatch.setattr(metrics, "sample_rate", 1.0)
+    report = run_benchmark(sizes=[20, 40], queries=5, concurrency=[1], corpus_dir=tmp_path)
+
+    first, second = report["runs"]
+    assert first["stages"]["encode"]["count"] > 0
+    # Timings are reset between sizes, not accumulated.
+    assert second["stages"]["search"]["count"] == first["stages"]["search"]["count"]
@@ -0,0 +1,69 @@
+import numpy as np
+
+from src.dataset.cache import EmbeddingCache
+
+
+def _vectors(*values) -> np.ndarray:
+    return np.array([[value, 1.0 - value] for value in values], dtype=np.float32)
+
+
+def test_put_then_get_returns_the_stored_vectors(tmp_path):
+    cache = EmbeddingCache(tmp_path, "model")
+    cache.put_many(["first text", "second text"], _vectors(0.25, 0.75))
+
+    first, second, missing = cache.get_many(["first text", "second text", "third text"])
+    np.testing.assert_array_equal(first, [0.25, 0.75])
+    np.testing.assert_array_equal(second, [0.75, 0.25])
+    assert missing is None
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+
+
+def test_entries_outlive_the_process_that_stored_them(tmp_path):
+    cache = EmbeddingCache(tmp_path, "model")
+    cache.put_many(["a text"], _vectors(0.5))
+    cache.close()
+
+    (vector,) = EmbeddingCache(tmp_path, "model").get_many(["a text"])
+    np.testing.assert_array_equal(vector, [0.5, 0.5])
+
+
+def test_encode_only_encodes_the_texts_not_cached(tmp_path):
+    cache = EmbeddingCache(tmp_path, "model")
+    cache.put_many(["cached"], _vectors(1.0))
+    encoded = []
+
+    def encode(texts):
+        encoded.extend(texts)
+        return _vectors(*[0.0] * len(texts))
+
+    vectors = cache.encode(["cached", "new", "new"], encode)
+    assert encoded == ["new"]
+    np.testing.assert_array_equal(vectors, _vectors(1.0, 0.0, 0.0))
+
+
+def test_the_least_recently_used_entries_are_evicted(tmp_path):
+    cache = EmbeddingCache(tmp_path, "model", max_entries=2)
+    cache.put_many(["old"], _vectors(0.1))
+    cache.put_many(["used"], _vectors(0.2))
+    cache.get_many(["old"])
+    cache.put_many(["new"], _vectors(0.3))
+
+    old, used, new = cache.get_many(["old", "used", "new"])
+    assert used is None
+    np.testing.assert_allclose(old, [0.1, 0.9])
+    np.testing.assert_allclose(new, [0.3, 0.7])
+    assert cache.stats()["evictions"] == 1 and cache.stats()["entries"] == 2
+
+
+def test_models_do_not_share_entries(tmp_path):
+    EmbeddingCache(tmp_path, "model").put_many(["a text"], _vectors(0.5))
+
+    assert EmbeddingCache(tmp_path, "other-model").get_many(["a text"]) == [None]
+
+
+def test_encoder_backends_do_not_share_entries(tmp_path):
+    EmbeddingCache(tmp_path, "model", backend="torch").put_many(["a text"], _vectors(0.5))
+
+    assert EmbeddingCache(tmp_path, "model", backend="onnx").get_many(["a text"]) == [None]
+    (vector,) = EmbeddingCache(tmp_path, "model", backend="torch").get_many(["a text"])
+    np.testing.assert_array_equal(vector, [0.5, 0.5])
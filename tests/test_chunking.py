@@ -0,0 +1,57 @@
+import re
+
+import pytest
+
+from src.dataset.chunking import Chunker, split_sentences
+
+TEXT = "One two three. Four five! Six seven eight nine? Ten."
+
+
+class WordTokenizer:
+    """Tokenizer of white space separated words, with the huggingface call interface."""
+
+    def __call__(self, text: str, **kwargs) -> dict:
+        return {"offset_mapping": [match.span() for match in re.finditer(r"\S+", text)]}
+
+
+def test_split_sentences():
+    assert split_sentences(TEXT) == ["One two three.", "Four five!", "Six seven eight nine?", "Ten."]
+
+
+def test_the_none_strategy_keeps_the_whole_document():
+    assert Chunker("none").split(TEXT) == [TEXT]
+
+
+def test_sentence_windows_overlap():
+    chunker = Chunker("sentences", chunk_size=2, overlap=1)
+
+    assert chunker.split(TEXT) == [
+        "One two three. Four five!",
+        "Four five! Six seven eight nine?",
+        "Six seven eight nine? Ten.",
+    ]
+
+
+def test_token_windows_overlap():
+    chunker = Chunker("tokens", tokenizer=WordTokenizer(), chunk_size=4, overlap=1)
+
+    assert chunker.split(TEXT) == ["One two three. Four", "Four five! Six seven", "seven eight nine? Ten."]
+
+
+def test_max_tokens_packs_whole_sentences_and_splits_the_longer_ones():
+    chunker = Chunker("max_tokens", tokenizer=WordTokenizer(), chunk_size=3, overlap=0)
+
+    assert chunker.split(TEXT) == ["One two three.", "Four five!", "Six seven eight", "nine?", "Ten."]
+
+
+def test_an_empty_document_still_has_a_passage():
+    assert Chunker("sentences").split("") == [""]
+
+
+def test_invalid_settings_are_rejected():
+    with pytest.raises(ValueError):
+        Chunker("paragraphs")
+    with pytest.raises(ValueError):
+        Chunker("tokens")
+    with pytest.raises(ValueError):
+        Chunker("sentences", chunk_size=2, overlap=2)
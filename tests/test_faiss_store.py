@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from src.dataset.projection import fit_projection, index_projection, projection_path
+from src.dataset.vector_store import IndexNotFoundError
+from src.utils import constants
+
+faiss_store = pytest.importorskip("src.dataset.faiss_store", exc_type=ImportError)
+
+
+def _action(doc_id: str, vector) -> dict:
+    return {
+        "_index": "es0",
+        "_id": doc_id,
+        "_source": {"content": doc_id, "sentence_embedding": np.asarray(vector, dtype=np.float32)},
+    }
+
+
+def _knn(vector) -> dict:
+    return {"knn": {"field": "sentence_embedding", "query_vector": vector, "k": 2}}
+
+
+def test_searching_an_unknown_index_raises_instead_of_creating_it(tmp_path):
+    store = faiss_store.FaissStore(tmp_path, index_type="flat")
+
+    with pytest.raises(IndexNotFoundError):
+        store.search("typo", _knn([1.0, 0.0]))
+    assert not (tmp_path / "typo").exists()
+
+
+def test_ingestion_creates_the_index(tmp_path):
+    store = faiss_store.FaissStore(tmp_path, index_type="flat")
+    list(store.bulk([_action("a", [1.0, 0.0]), _action("b", [0.0, 1.0])]))
+
+    hits = store.search("es0", _knn([1.0, 0.1]))["hits"]["hits"]
+    assert [hit["_id"] for hit in hits] == ["a", "b"]
+    store.close()
+    assert (tmp_path / "es0" / "docs.sqlite").exists()
+
+
+def test_a_search_store_reloads_an_index_ingested_into_by_another_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(constants, "FAISS_RELOAD_CHECK_INTERVAL", 0.0)
+    writer = faiss_store.FaissStore(tmp_path, index_type="flat")
+    list(writer.bulk([_action("a", [1.0, 0.0])]))
+    writer.flush()
+    writer.bump_generation("es0")
+    reader = faiss_store.FaissStore(tmp_path, mmap=True)
+    assert [hit["_id"] for hit in reader.search("es0", _knn([0.0, 1.0]))["hits"]["hits"]] == ["a"]
+
+    list(writer.bulk([_action("b", [0.0, 1.0])]))
+    writer.flush()
+    writer.bump_generation("es0")
+    assert reader.search("es0", _knn([0.0, 1.0]))["hits"]["hits"][0]["_id"] == "b"
+
+
+def test_the_projection_is_read_from_the_index_not_from_the_file_of_its_name(tmp_path, monkeypatch):
+    monkeypatch.setattr(constants, "PROJECTION_DIR", tmp_path / "projections")
+    vectors = np.random.default_rng(0).normal(size=(20, 4))
+    fit_projection(vectors, dims=2).save(projection_path("plain"))
+    recorded = tmp_path / "recorded.npz"
+    fit_projection(vectors, dims=3).save(recorded)
+    store = faiss_store.FaissStore(tmp_path / "faiss", index_type="flat")
+    store.create_index("plain", index_type="flat")
+    store.create_index("projected", index_type="flat", projection=str(recorded))
+    store.close()
+
+    store = faiss_store.FaissStore(tmp_path / "faiss", mmap=True)
+    assert index_projection(store, "plain") is None
+    assert index_projection(store, "projected").dims == 3
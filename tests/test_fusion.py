@@ -0,0 +1,66 @@
+import pytest
+
+from src.dataset.fusion import fuse, normalize_scores
+
+
+def _hits(ranking: str, *scored) -> list:
+    return [
+        {"_index": "es0", "_id": hit_id, "_score": score, "_source": {"ranking": ranking}}
+        for hit_id, score in scored
+    ]
+
+
+KNN = _hits("knn", ("a", 0.9), ("b", 0.8), ("c", 0.7))
+BM25 = _hits("bm25", ("c", 12.0), ("a", 6.0), ("d", 3.0))
+
+
+def _ids(hits: list) -> list:
+    return [hit["_id"] for hit in hits]
+
+
+def test_rrf_sums_the_reciprocal_ranks_of_every_ranking():
+    fused = fuse([KNN, BM25], size=4, method="rrf", rank_constant=60)
+
+    assert _ids(fused) == ["a", "c", "b", "d"]
+    assert [hit["_score"] for hit in fused] == pytest.approx(
+        [1 / 61 + 1 / 62, 1 / 63 + 1 / 61, 1 / 62, 1 / 63]
+    )
+
+
+def test_rrf_weights_favour_a_ranking():
+    fused = fuse([KNN, BM25], size=2, method="rrf", weights=[1.0, 3.0], rank_constant=60)
+
+    assert _ids(fused) == ["c", "a"]
+
+
+def test_weighted_fusion_sums_the_normalized_scores():
+    fused = fuse([KNN, BM25], size=4, method="weighted", weights=[1.0, 0.8])
+
+    assert _ids(fused) == ["a", "c", "b", "d"]
+    assert [hit["_score"] for hit in fused] == pytest.approx([1 + 0.8 / 3, 0.8, 0.5, 0.0])
+
+
+def test_fused_hits_keep_the_fields_of_their_first_ranking():
+    fused = fuse([KNN, BM25], size=4, method="rrf")
+
+    assert {hit["_id"]: hit["_source"]["ranking"] for hit in fused} == {
+        "a": "knn",
+        "b": "knn",
+        "c": "knn",
+        "d": "bm25",
+    }
+
+
+def test_the_size_cuts_the_fused_ranking():
+    assert _ids(fuse([KNN, BM25], size=1, method="weighted")) == ["a"]
+
+
+def test_normalize_scores():
+    assert normalize_scores(BM25) == pytest.approx([1.0, 1 / 3, 0.0])
+    assert normalize_scores(_hits("knn", ("a", 2.0), ("b", 2.0))) == [1.0, 1.0]
+    assert normalize_scores([]) == []
+
+
+def test_unknown_methods_are_rejected():
+    with pytest.raises(ValueError):
+        fuse([KNN, BM25], size=3, method="borda")
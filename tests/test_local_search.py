@@ -0,0 +1,53 @@
+import pytest
+
+from src.dataset.local_search import matches
+
+SOURCE = {
+    "sentence_text": "Revenue grew in the third quarter.",
+    "directory": "reports",
+    "file_size": 120,
+    "tags": ["finance", "quarterly"],
+    "metadata": {"tenant": "acme"},
+}
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        ({"match_all": {}}, True),
+        ({"term": {"directory": "reports"}}, True),
+        ({"term": {"directory": {"value": "notes"}}}, False),
+        ({"term": {"metadata.tenant.keyword": "acme"}}, True),
+        ({"term": {"tags": "finance"}}, True),
+        ({"terms": {"metadata.tenant": ["globex", "acme"]}}, True),
+        ({"terms": {"metadata.tenant": ["globex"]}}, False),
+        ({"range": {"file_size": {"gte": 100, "lt": 200}}}, True),
+        ({"range": {"file_size": {"gt": 120}}}, False),
+        ({"exists": {"field": "metadata.tenant"}}, True),
+        ({"exists": {"field": "metadata.owner"}}, False),
+        ({"match": {"sentence_text": "QUARTER results"}}, True),
+        ({"match": {"sentence_text": {"query": "costs fell"}}}, False),
+    ],
+)
+def test_leaf_queries(query, expected):
+    assert matches(SOURCE, query) is expected
+
+
+def test_bool_queries_combine_their_clauses():
+    assert matches(
+        SOURCE,
+        {
+            "bool": {
+                "filter": [{"term": {"directory": "reports"}}],
+                "must_not": {"term": {"metadata.tenant": "globex"}},
+                "should": [{"term": {"tags": "legal"}}, {"range": {"file_size": {"lte": 120}}}],
+            }
+        },
+    )
+    assert not matches(SOURCE, {"bool": {"should": [{"term": {"tags": "legal"}}]}})
+    assert not matches(SOURCE, {"bool": {"must_not": [{"exists": {"field": "tags"}}]}})
+
+
+def test_unsupported_queries_are_rejected():
+    with pytest.raises(ValueError):
+        matches(SOURCE, {"wildcard": {"directory": "rep*"}})
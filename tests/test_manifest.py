@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+from src.dataset.manifest import Manifest
+
+
+def _sync(manifest: Manifest, data_path) -> list:
+    """Run a sync, recording the changed files as indexed, and return their names."""
+    manifest.begin_sync()
+    changed = list(manifest.changed_files(str(data_path)))
+    manifest.record(changed)
+    manifest.commit()
+    return sorted(document.name for document in changed)
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    data_path = tmp_path / "data"
+    (data_path / "notes").mkdir(parents=True)
+    (data_path / "a.txt").write_text("first document")
+    (data_path / "notes" / "b.txt").write_text("second document")
+    return data_path
+
+
+def test_the_first_sync_reports_every_file(tmp_path, corpus):
+    manifest = Manifest(tmp_path / "manifest.sqlite")
+
+    assert _sync(manifest, corpus) == ["a.txt", os.path.join("notes", "b.txt")]
+    assert manifest.changed == 2
+
+
+def test_unchanged_files_are_not_reported_again(tmp_path, corpus):
+    _sync(Manifest(tmp_path / "manifest.sqlite"), corpus)
+    manifest = Manifest(tmp_path / "manifest.sqlite")
+
+    assert _sync(manifest, corpus) == []
+    assert manifest.unchanged == 2
+
+
+def test_only_files_whose_content_changed_are_reported(tmp_path, corpus):
+    manifest = Manifest(tmp_path / "manifest.sqlite")
+    _sync(manifest, corpus)
+    (corpus / "a.txt").write_text("first document, edited")
+    # Touched with the same content.
+    stat = os.stat(corpus / "notes" / "b.txt")
+    os.utime(corpus / "notes" / "b.txt", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    (corpus / "c.txt").write_text("third document")
+
+    assert _sync(manifest, corpus) == ["a.txt", "c.txt"]
+    assert manifest.unchanged == 1
+
+
+def test_removed_files_are_reported_as_deleted_with_their_document_id(tmp_path, corpus):
+    manifest = Manifest(tmp_path / "manifest.sqlite")
+    manifest.begin_sync()
+    documents = {document.name: document for document in manifest.changed_files(str(corpus))}
+    manifest.record(documents.values())
+    manifest.commit()
+    (corpus / "a.txt").unlink()
+
+    assert _sync(manifest, corpus) == []
+    assert manifest.deleted_files() == [("a.txt", documents["a.txt"].doc_id, 0)]
+    manifest.remove(["a.txt"])
+    assert manifest.deleted_files() == []
@@ -0,0 +1,115 @@
+import pytest
+
+from src.dataset.benchmark import StubEncoder
+from src.dataset.embeddings import local_text_embedding
+from src.dataset.memory_store import MemoryStore
+from src.dataset.search import perform_search
+
+DOCUMENTS = {
+    "reports/q3.txt": "Revenue grew strongly in the third quarter.",
+    "reports/q2.txt": "Costs fell in the second quarter.",
+    "notes/cats.txt": "Cats sleep most of the day.",
+}
+
+
+def _write(data_path, documents: dict):
+    for name, content in documents.items():
+        (data_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (data_path / name).write_text(content)
+
+
+@pytest.fixture
+def encoder():
+    return StubEncoder(dims=64)
+
+
+@pytest.fixture
+def store(tmp_path, encoder):
+    _write(tmp_path / "data", DOCUMENTS)
+    store = MemoryStore()
+    local_text_embedding(store, "es0", str(tmp_path / "data"), model=encoder)
+    return store
+
+
+def _names(results) -> list:
+    return [result.document_name for result in results]
+
+
+def test_ingested_documents_are_found_by_their_text(store, encoder):
+    assert store.info()["indices"] == {"es0": len(DOCUMENTS)}
+    for name, content in DOCUMENTS.items():
+        (result,) = perform_search(content, store, "es0", encoder, k=1)
+        assert result.document_name == name
+        assert result.text == content
+        assert result.score == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize("mode", ["knn", "lexical", "hybrid"])
+def test_every_search_mode_ranks_the_matching_document_first(store, encoder, mode):
+    results = perform_search("revenue in the third quarter", store, "es0", encoder, k=3, mode=mode)
+
+    assert _names(results)[0] == "reports/q3.txt"
+
+
+def test_lexical_search_only_returns_documents_sharing_a_term(store, encoder):
+    results = perform_search("sleeping cats", store, "es0", encoder, k=3, mode="lexical")
+
+    assert _names(results) == ["notes/cats.txt"]
+
+
+def test_search_after_pages_through_tied_scores_without_gaps_nor_repeats(tmp_path, encoder):
+    _write(tmp_path / "data", {f"copy{i}.txt": "The same words in every file." for i in range(7)})
+    store = MemoryStore()
+    local_text_embedding(store, "es0", str(tmp_path / "data"), model=encoder)
+    everything = perform_search("same words", store, "es0", encoder, k=7)
+
+    pages, search_after = [], None
+    while True:
+        page = perform_search("same words", store, "es0", encoder, k=3, search_after=search_after)
+        if not page:
+            break
+        pages.append(_names(page))
+        search_after = page[-1].sort
+    assert len({result.score for result in everything}) == 1
+    assert [name for page in pages for name in page] == _names(everything)
+    assert [len(page) for page in pages] == [3, 3, 1]
+
+
+@pytest.fixture
+def tenants_store(tmp_path, encoder):
+    _write(tmp_path / "data", DOCUMENTS)
+    _write(
+        tmp_path / "data",
+        {
+            "reports/q3.json": '{"tenant": "acme", "year": 2023}',
+            "reports/q2.json": '{"tenant": "globex", "year": 2024}',
+        },
+    )
+    store = MemoryStore()
+    local_text_embedding(store, "es0", str(tmp_path / "data"), model=encoder)
+    return store
+
+
+@pytest.mark.parametrize(
+    "filters, expected",
+    [
+        ({"metadata.tenant": "globex"}, ["reports/q2.txt"]),
+        ({"metadata.tenant": ["acme", "globex"]}, ["reports/q2.txt", "reports/q3.txt"]),
+        ({"metadata.year": {"lt": 2024}}, ["reports/q3.txt"]),
+        ({"directory": "notes"}, ["notes/cats.txt"]),
+        ([{"bool": {"must_not": [{"exists": {"field": "metadata"}}]}}], ["notes/cats.txt"]),
+    ],
+)
+@pytest.mark.parametrize("mode", ["knn", "hybrid"])
+def test_metadata_filters_restrict_the_searched_passages(tenants_store, encoder, mode, filters, expected):
+    results = perform_search("the quarter", tenants_store, "es0", encoder, k=3, mode=mode, filters=filters)
+
+    assert sorted(_names(results)) == expected
+
+
+def test_metadata_filters_apply_to_lexical_searches(tenants_store, encoder):
+    results = perform_search(
+        "quarter", tenants_store, "es0", encoder, k=3, mode="lexical", filters={"metadata.tenant": "acme"}
+    )
+
+    assert _names(results) == ["reports/q3.txt"]